@@ -0,0 +1,116 @@
+"""Sweeps model replica and thread counts for multi-process inference.
+
+For each configuration, scores random id batches from --callers threads
+for --seconds and reports URLs/s and per-batch latency percentiles, then
+prints the best throughput and the best p95 latency configuration for
+this machine. "0" replicas is the single in-process model with the
+INFERENCE_INTRA_OP_THREADS/INFERENCE_INTER_OP_THREADS of the environment
+(TensorFlow's defaults unless set), as the scorer runs without a pool.
+
+    python bench_inference.py --replicas 0,1,2,4 --intra 1,2,4 --affinity auto
+    INFERENCE_REPLICAS=2 INFERENCE_INTRA_OP_THREADS=2 INFERENCE_CPU_AFFINITY=auto python evaluating_url.py
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import evaluating_url
+from evaluating_url import BATCH_BUCKETS, SEQUENCE_LENGTH, get_predictor
+from inference_pool import InferencePool
+
+
+def run_load(predict, batches, callers, seconds):
+    """Calls predict from several threads; returns (URLs/s, latencies in ms)."""
+    latencies = []
+    urls = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def caller(offset):
+        i = offset
+        while time.perf_counter() < deadline:
+            batch = batches[i % len(batches)]
+            start = time.perf_counter()
+            predict(batch)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                urls[0] += len(batch)
+            i += callers
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=caller, args=(offset,)) for offset in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return urls[0] / (time.perf_counter() - start), latencies
+
+
+def parse_ints(spec):
+    return [int(value) for value in spec.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", default="0,1,2,4", help="replica counts, 0 = in-process model")
+    parser.add_argument("--intra", default="1,2,4", help="intra-op threads per replica")
+    parser.add_argument("--inter", type=int, default=1, help="inter-op threads per replica")
+    parser.add_argument("--affinity", default="auto", help='INFERENCE_CPU_AFFINITY for the pools ("" for none)')
+    parser.add_argument("--batch", type=int, default=max(BATCH_BUCKETS), help="URLs per predict call")
+    parser.add_argument("--callers", type=int, default=1, help="threads calling predict")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    cores = evaluating_url.usable_cores()
+    configs = []
+    for replicas in parse_ints(args.replicas):
+        if replicas == 0:
+            configs.append((0, None))
+            continue
+        for intra in parse_ints(args.intra):
+            if replicas * intra <= max(cores, intra):
+                configs.append((replicas, intra))
+    print(f"{cores} usable cores, batches of {args.batch}, {args.callers} caller(s), "
+          f"{args.seconds:.0f}s per configuration", flush=True)
+
+    rng = np.random.default_rng(args.seed)
+    batches = None
+    results = []
+    for replicas, intra in configs:
+        pool = None
+        if replicas == 0:
+            predict, table = get_predictor()
+            label = "in-process"
+        else:
+            pool = InferencePool(replicas, intra, args.inter, args.affinity, max_rows=max(BATCH_BUCKETS),
+                                 sequence_length=SEQUENCE_LENGTH, log=lambda msg: None)
+            predict, table = pool, pool.table
+            label = f"{replicas} x {intra} intra"
+        if predict is None:
+            raise SystemExit("Model not available.")
+        if batches is None:
+            batches = [rng.integers(2, table.max() + 1, size=(args.batch, SEQUENCE_LENGTH)).astype(np.int32)
+                       for _ in range(8)]
+        try:
+            run_load(predict, batches, args.callers, min(1.0, args.seconds))
+            throughput, latencies = run_load(predict, batches, args.callers, args.seconds)
+        finally:
+            if pool is not None:
+                pool.close()
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        results.append((label, throughput, p50, p95, p99))
+        print(f"{label:<26}{throughput:>10,.0f} URL/s  p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms",
+              flush=True)
+
+    best_throughput = max(results, key=lambda result: result[1])
+    best_latency = min(results, key=lambda result: result[3])
+    print(f"\nBest throughput: {best_throughput[0]} ({best_throughput[1]:,.0f} URL/s)")
+    print(f"Best p95 latency: {best_latency[0]} ({best_latency[3]:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
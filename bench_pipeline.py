@@ -0,0 +1,597 @@
+"""End-to-end throughput/latency benchmark with local stand-ins.
+
+Replays certificate traffic through the real producer and scorer code,
+with every cloud service replaced by a local stand-in:
+
+    replay WebSocket -> producer.run -> in-memory Pub/Sub -> scorer -> fake BigQuery sink
+
+The replay server plays recorded certstream messages (--certstream, one
+JSON message per line as saved by the record command), crt.sh responses
+recorded with crtsh_stub.py (--crtsh), or synthetic certificates, at --rate
+certificates per second. Domains get a per-loop prefix when the source is
+replayed more than once, so each loop is new traffic. The producer and the
+scorer run in their own processes; the scorer is process_pubsub (the Cloud
+Function) or run_worker (--scorer worker). The sink waits
+--sink-latency-ms per batch to stand in for the Storage Write API.
+
+Reports end-to-end latency (first send of a domain until its row is
+written) p50/p95/p99, URLs/s, and CPU time and peak RSS per stage, and
+writes them as JSON so runs can be compared across commits:
+
+    python bench_pipeline.py record --count 5000 --out certstream.jsonl
+    python bench_pipeline.py run --certstream certstream.jsonl --rate 100 --duration 60
+    python bench_pipeline.py run --rate 100 --compare bench_results/<previous>.json
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import websockets
+
+from crtsh_stub import synthetic_certs
+from domains import clean_domains
+
+RESULTS_DIR = "bench_results"
+TOPIC_PATH = "projects/bench/topics/urlstream"
+SYNTHETIC_TERMS = ("%.com", "%.net", "%.org", "%.io")
+# README targets: < 500 ms average latency, ~200 URL/s
+TARGET_MEAN_LATENCY_MS = 500
+TARGET_URLS_PER_SECOND = 200
+
+
+def certstream_message(domains):
+    return json.dumps({"message_type": "certificate_update", "data": {"leaf_cert": {"all_domains": domains}}})
+
+
+def load_certstream(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_crtsh(directory):
+    messages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                for cert in json.load(f):
+                    messages.append(certstream_message(cert["name_value"].split("\n")))
+    return messages
+
+
+def synthetic_messages(count, seed):
+    per_term = -(-count // len(SYNTHETIC_TERMS))
+    certs = [cert for term in SYNTHETIC_TERMS for cert in synthetic_certs(term, per_term, seed)]
+    return [certstream_message(cert["name_value"].split("\n")) for cert in certs[:count]]
+
+
+def prefixed(domain, prefix):
+    if domain.startswith("*."):
+        return "*." + prefix + domain[2:]
+    return prefix + domain
+
+
+def build_schedule(messages, count):
+    """(message text, cleaned domains) for count certificates, looping over messages."""
+    schedule = []
+    for i in range(count):
+        loop, index = divmod(i, len(messages))
+        text = messages[index]
+        msg = json.loads(text)
+        if msg.get("message_type") != "certificate_update":
+            continue
+        domains = msg["data"]["leaf_cert"]["all_domains"]
+        if loop:
+            domains = [prefixed(d, f"r{loop}-") for d in domains]
+            msg["data"]["leaf_cert"]["all_domains"] = domains
+            text = json.dumps(msg)
+        schedule.append((text, clean_domains(domains)))
+    return schedule
+
+
+def usage(since=None):
+    """CPU seconds and peak RSS of this process, CPU counted from since."""
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = r.ru_utime + r.ru_stime
+    return {"cpu_seconds": cpu - (since or {}).get("cpu_seconds", 0.0), "max_rss_mb": r.ru_maxrss / 1024}
+
+
+class InMemoryPubSub:
+    """Publisher stand-in: messages go on a multiprocessing queue with their publish time."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.published = 0
+
+    def publish(self, topic_path, data, **attributes):
+        self.messages.put((data, time.time(), attributes))
+        self.published += 1
+        future = Future()
+        future.set_result(str(self.published))
+        return future
+
+
+class FakeBigQuerySink:
+    """Sink stand-in that reports the written URLs and their write time."""
+
+    def __init__(self, results, latency):
+        self.results = results
+        self.latency = latency
+        self.thread_id = None
+        self.batches = 0
+
+    def write_batch(self, columns):
+        self.thread_id = threading.get_ident()
+        if self.latency:
+            time.sleep(self.latency)
+        self.batches += 1
+        self.results.put(("written", columns["url"].tolist(), time.time()))
+
+    def thread_cpu(self):
+        """CPU seconds of the writer thread, while it is alive."""
+        if self.thread_id is None:
+            return 0.0
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(self.thread_id))
+        except (OSError, AttributeError):
+            return 0.0
+
+    def close(self):
+        pass
+
+
+def producer_main(ws_url, messages, results, stop, settings, log_path):
+    """Producer process: producer.run() from the replay server to the in-memory Pub/Sub."""
+    with open(log_path, "a", encoding="utf-8") as log_file, contextlib.redirect_stdout(log_file):
+        import producer
+        from payloads import DomainBatcher
+
+        baseline = usage()
+        publisher = InMemoryPubSub(messages)
+        stats = producer.ProducerStats()
+        batcher = DomainBatcher(settings["payload_max_urls"], settings["payload_max_bytes"],
+                                settings["linger_ms"] / 1000, settings["compression"])
+
+        async def main():
+            task = asyncio.create_task(producer.run(
+                publisher, TOPIC_PATH, ws_url=ws_url, queue_size=settings["queue_size"],
+                workers=settings["publishers"], policy=settings["policy"], rate=settings["publish_rate"],
+                burst=max(int(settings["publish_rate"]), 1), batcher=batcher, stats=stats,
+            ))
+            await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(main())
+    counters = {"certs": stats.received, "domains": stats.domains, "filtered": batcher.filtered,
+                "payloads": stats.published, "dropped": stats.dropped, "failed": stats.failed}
+    results.put(("usage", "producer", usage(baseline), counters))
+
+
+class TimedMessage:
+    """Worker inbox message that reports its Pub/Sub and scoring times once acked."""
+
+    def __init__(self, data, attributes, published_at, delivered_at, results):
+        self.data = data
+        self.attributes = attributes
+        self.published_at = published_at
+        self.delivered_at = delivered_at
+        self.results = results
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
+        self.results.put(("message", self.published_at, self.delivered_at, time.time()))
+
+    def nack(self):
+        self.nacked = True
+        self.results.put(("message", self.published_at, self.delivered_at, time.time()))
+
+
+def scorer_main(messages, results, stop, settings, log_path):
+    """Scorer process: process_pubsub or run_worker into the fake sink."""
+    with open(log_path, "a", encoding="utf-8") as log_file, contextlib.redirect_stdout(log_file):
+        import evaluating_url
+        from sinks import BufferedWriter
+
+        sink = FakeBigQuerySink(results, settings["sink_latency_ms"] / 1000)
+        predict, _ = evaluating_url.get_predictor()
+        if predict is None:
+            results.put(("error", "scorer", "model not available"))
+            return
+        evaluating_url.get_verdict_cache()
+        evaluating_url.get_prefilter()
+        results.put(("ready", "scorer"))
+        baseline = usage()
+
+        if settings["scorer"] == "worker":
+            inbox = queue.Queue()
+            worker_stop = threading.Event()
+            worker = threading.Thread(target=evaluating_url.run_worker, kwargs={
+                "inbox": inbox, "sink": sink, "stop_event": worker_stop, "report_interval": 3600,
+            })
+            worker.start()
+            while not (stop.is_set() and messages.empty()):
+                try:
+                    data, published_at, attributes = messages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                message = TimedMessage(data, attributes, published_at, time.time(), results)
+                evaluating_url.enqueue(inbox, message)
+            while not inbox.empty():
+                time.sleep(0.05)
+            worker_stop.set()
+            worker.join()
+            sink_cpu = sink.thread_cpu()
+            writer_stats = {}
+        else:
+            evaluating_url.writer = BufferedWriter(
+                sink, max_rows=evaluating_url.SINK_MAX_ROWS, max_latency=evaluating_url.SINK_MAX_LATENCY_MS / 1000,
+                dead_letter_path=evaluating_url.DEAD_LETTER_PATH, log=evaluating_url.log,
+            )
+            while not (stop.is_set() and messages.empty()):
+                try:
+                    data, published_at, attributes = messages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                delivered_at = time.time()
+                evaluating_url.process_pubsub({"data": base64.b64encode(data), "attributes": attributes}, None)
+                results.put(("message", published_at, delivered_at, time.time()))
+            sink_cpu = sink.thread_cpu()
+            writer_stats = evaluating_url.writer.stats()
+    scorer_usage = usage(baseline)
+    results.put(("usage", "sink", {"cpu_seconds": sink_cpu}, {"batches": sink.batches}))
+    results.put(("usage", "scorer", scorer_usage, writer_stats))
+
+
+class Collector:
+    """Reads the results queue of both processes in the main process."""
+
+    def __init__(self, results, sent_at):
+        self.results = results
+        self.sent_at = sent_at
+        self.end_to_end = []
+        self.pubsub_queue = []
+        self.score_and_write = []
+        self.urls_written = 0
+        self.last_write = None
+        self.usage = {}
+        self.counters = {}
+        self.events = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="collector", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            kind = item[0]
+            if kind == "written":
+                _, urls, written_at = item
+                self.urls_written += len(urls)
+                self.last_write = written_at
+                for url in urls:
+                    sent = self.sent_at.pop(url, None)
+                    if sent is not None:
+                        self.end_to_end.append((written_at - sent) * 1000)
+            elif kind == "message":
+                _, published_at, delivered_at, done_at = item
+                self.pubsub_queue.append((delivered_at - published_at) * 1000)
+                self.score_and_write.append((done_at - delivered_at) * 1000)
+            elif kind == "usage":
+                _, stage, stage_usage, counters = item
+                self.usage[stage] = stage_usage
+                self.counters[stage] = counters
+                self.events.put(item)
+            else:
+                self.events.put(item)
+
+
+def start_replay_server(schedule, rate, sent_at):
+    """Serves the schedule to the first WebSocket client from a background thread.
+
+    Returns (url, finished event, replay stats dict).
+    """
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    finished = threading.Event()
+    stats = {}
+    address = {}
+
+    async def handler(ws):
+        if stats:
+            # The producer reconnected; the traffic was already sent
+            await ws.wait_closed()
+            return
+        stats["started_at"] = time.time()
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+        for i, (text, keys) in enumerate(schedule):
+            if rate > 0:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            now = time.time()
+            for key in keys:
+                sent_at.setdefault(key, now)
+            await ws.send(text)
+        stats["finished_at"] = time.time()
+        stats["cpu_seconds"] = time.thread_time() - cpu_start
+        finished.set()
+        await ws.wait_closed()
+
+    async def main():
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            address["port"] = server.sockets[0].getsockname()[1]
+            started.set()
+            await asyncio.Future()
+
+    threading.Thread(target=loop.run_until_complete, args=(main(),), name="replay", daemon=True).start()
+    started.wait()
+    return f"ws://127.0.0.1:{address['port']}/", finished, stats
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1),
+            "mean": round(float(np.mean(values)), 1), "max": round(float(np.max(values)), 1),
+            "count": len(values)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_for(events, kind, stage, process, timeout):
+    """Waits for a (kind, stage) event from process; exits if it dies or times out."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            item = events.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                raise SystemExit(f"{stage} exited with code {process.exitcode}")
+            if time.monotonic() > deadline:
+                raise SystemExit(f"Timed out waiting for {stage}")
+            continue
+        if item[0] == "error":
+            raise SystemExit(f"{item[1]} failed: {item[2]}")
+        if item[0] == kind and item[1] == stage:
+            return item
+
+
+def run(args):
+    if args.certstream:
+        messages = load_certstream(args.certstream)
+    elif args.crtsh:
+        messages = load_crtsh(args.crtsh)
+    else:
+        messages = synthetic_messages(args.synthetic, args.seed)
+    if not messages:
+        raise SystemExit("No traffic to replay.")
+    count = args.count or (int(args.rate * args.duration) if args.rate > 0 else len(messages))
+    schedule = build_schedule(messages, count)
+    urls_sent = len({key for _, keys in schedule for key in keys})
+
+    stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline-{stamp}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    log_path = os.path.splitext(output)[0] + ".log"
+    print(f"Replaying {len(schedule)} certificates ({urls_sent} distinct domains) at "
+          f"{args.rate:g} certs/s through the {args.scorer} scorer; logs in {log_path}", flush=True)
+
+    context = multiprocessing.get_context("spawn")
+    pubsub = context.Queue()
+    results = context.Queue()
+    stop_producer = context.Event()
+    stop_scorer = context.Event()
+    sent_at = {}
+    collector = Collector(results, sent_at)
+
+    scorer_settings = {"scorer": args.scorer, "sink_latency_ms": args.sink_latency_ms}
+    scorer = context.Process(target=scorer_main, name="scorer",
+                             args=(pubsub, results, stop_scorer, scorer_settings, log_path))
+    scorer.start()
+    wait_for(collector.events, "ready", "scorer", scorer, args.startup_timeout)
+
+    ws_url, replay_finished, replay_stats = start_replay_server(schedule, args.rate, sent_at)
+    producer_settings = {
+        "payload_max_urls": args.payload_max_urls, "payload_max_bytes": args.payload_max_bytes,
+        "linger_ms": args.linger_ms, "compression": args.compression, "queue_size": args.queue_size,
+        "publishers": args.publishers, "policy": args.policy, "publish_rate": args.publish_rate,
+    }
+    producer_process = context.Process(target=producer_main, name="producer",
+                                       args=(ws_url, pubsub, results, stop_producer, producer_settings, log_path))
+    producer_process.start()
+
+    replay_finished.wait()
+    # Drain: until every sent domain is written or nothing was written for a while
+    idle_since = time.monotonic()
+    written = collector.urls_written
+    while sent_at and time.monotonic() - idle_since < args.drain_timeout:
+        time.sleep(0.1)
+        if collector.urls_written != written:
+            written = collector.urls_written
+            idle_since = time.monotonic()
+
+    stop_producer.set()
+    wait_for(collector.events, "usage", "producer", producer_process, 60)
+    producer_process.join()
+    stop_scorer.set()
+    wait_for(collector.events, "usage", "scorer", scorer, 120)
+    scorer.join()
+    results.put(None)
+    collector.thread.join()
+
+    first_sent = replay_stats["started_at"]
+    elapsed = max((collector.last_write or time.time()) - first_sent, 1e-9)
+    stages = {
+        "replay": {"cpu_seconds": replay_stats["cpu_seconds"]},
+        "producer": collector.usage["producer"],
+        "scorer": collector.usage["scorer"],
+        "sink": collector.usage["sink"],
+    }
+    for stage in stages.values():
+        stage["cpu_seconds"] = round(stage["cpu_seconds"], 3)
+        stage["cpu_percent"] = round(stage["cpu_seconds"] / elapsed * 100, 1)
+        if "max_rss_mb" in stage:
+            stage["max_rss_mb"] = round(stage["max_rss_mb"], 1)
+    latency = {
+        "end_to_end": percentiles(collector.end_to_end),
+        "pubsub_queue": percentiles(collector.pubsub_queue),
+        "score_and_write": percentiles(collector.score_and_write),
+    }
+    urls_per_second = collector.urls_written / elapsed
+    replay_seconds = max(replay_stats["finished_at"] - first_sent, 1e-9)
+    offered = sum(len(keys) for _, keys in schedule) / replay_seconds
+    report = {
+        "benchmark": "pipeline",
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "commit": git_commit(),
+        "host": {"cores": os.cpu_count(), "platform": platform.platform(), "python": platform.python_version()},
+        "config": {name: value for name, value in vars(args).items() if name not in ("command", "compare")},
+        "certs_sent": len(schedule),
+        "urls_sent": urls_sent,
+        "urls_written": collector.urls_written,
+        "urls_unwritten": len(sent_at),
+        "duration_seconds": round(elapsed, 3),
+        "urls_per_second": round(urls_per_second, 1),
+        "offered_urls_per_second": round(offered, 1),
+        "latency_ms": latency,
+        "stages": stages,
+        "producer": collector.counters["producer"],
+        "writer": collector.counters["scorer"],
+        "targets": {
+            "mean_latency_under_500ms": bool(latency["end_to_end"])
+            and latency["end_to_end"]["mean"] < TARGET_MEAN_LATENCY_MS,
+            "throughput_over_200_urls_per_second": urls_per_second >= TARGET_URLS_PER_SECOND,
+        },
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+    print_report(report)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if compare(previous, report, args.tolerance):
+            sys.exit(1)
+
+
+def print_report(report):
+    print(f"\n{report['urls_written']} rows written for {report['urls_sent']} distinct domains in "
+          f"{report['duration_seconds']:.1f}s: {report['urls_per_second']:.1f} URL/s "
+          f"(offered {report['offered_urls_per_second']:.1f} URL/s)")
+    for name, p in report["latency_ms"].items():
+        if p:
+            print(f"  {name:<16} p50={p['p50']}ms p95={p['p95']}ms p99={p['p99']}ms mean={p['mean']}ms")
+    for name, stage in report["stages"].items():
+        rss = f", peak RSS {stage['max_rss_mb']:.0f} MiB" if "max_rss_mb" in stage else ""
+        print(f"  {name:<16} CPU {stage['cpu_seconds']:.2f}s ({stage['cpu_percent']:.0f}%){rss}")
+    for target, met in report["targets"].items():
+        print(f"  target {target}: {'met' if met else 'MISSED'}")
+
+
+def compare(previous, current, tolerance):
+    """Prints the change from a previous run; returns True on a regression beyond tolerance."""
+    print(f"\nCompared with {previous.get('commit') or 'previous run'} ({previous.get('timestamp')}):")
+    checks = [("URL/s", previous["urls_per_second"], current["urls_per_second"], True)]
+    for name in ("p50", "p95", "p99"):
+        before = previous["latency_ms"]["end_to_end"].get(name)
+        after = current["latency_ms"]["end_to_end"].get(name)
+        if before is not None and after is not None:
+            checks.append((f"end-to-end {name} ms", before, after, False))
+    regressed = False
+    for label, before, after, higher_is_better in checks:
+        change = (after - before) / before if before else 0.0
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        regressed |= worse
+        print(f"  {label:<18}{before:>10.1f} -> {after:>10.1f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+    return regressed
+
+
+def record(args):
+    """Saves certificate_update messages from a live certstream server."""
+    async def main():
+        saved = 0
+        async with websockets.connect(args.url, ping_interval=None) as ws:
+            with open(args.out, "w", encoding="utf-8") as f:
+                async for message in ws:
+                    if json.loads(message).get("message_type") != "certificate_update":
+                        continue
+                    f.write(message.strip() + "\n")
+                    saved += 1
+                    if saved >= args.count:
+                        break
+        print(f"Recorded {saved} certificate updates to {args.out}")
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="save live certstream traffic")
+    record_parser.add_argument("--url", default=os.environ.get("WS_URL", "ws://localhost:8080/"))
+    record_parser.add_argument("--count", type=int, default=5000)
+    record_parser.add_argument("--out", default="certstream.jsonl")
+
+    run_parser = commands.add_parser("run", help="run the benchmark")
+    source = run_parser.add_mutually_exclusive_group()
+    source.add_argument("--certstream", help="recorded certstream messages, one per line")
+    source.add_argument("--crtsh", help="directory of crt.sh recordings (crtsh_stub.py record)")
+    source.add_argument("--synthetic", type=int, default=5000, help="synthetic certificates to generate")
+    run_parser.add_argument("--rate", type=float, default=50, help="certificates per second, 0 = as fast as possible")
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds of traffic at --rate")
+    run_parser.add_argument("--count", type=int, help="certificates to replay (overrides --duration)")
+    run_parser.add_argument("--scorer", choices=("pubsub", "worker"), default="pubsub")
+    run_parser.add_argument("--sink-latency-ms", type=float, default=20)
+    run_parser.add_argument("--payload-max-urls", type=int, default=500)
+    run_parser.add_argument("--payload-max-bytes", type=int, default=64 * 1024)
+    run_parser.add_argument("--linger-ms", type=float, default=200)
+    run_parser.add_argument("--compression", default="none")
+    run_parser.add_argument("--queue-size", type=int, default=1000)
+    run_parser.add_argument("--publishers", type=int, default=4)
+    run_parser.add_argument("--policy", default="block")
+    run_parser.add_argument("--publish-rate", type=float, default=0, help="producer payloads/s, 0 = unlimited")
+    run_parser.add_argument("--drain-timeout", type=float, default=10)
+    run_parser.add_argument("--startup-timeout", type=float, default=300)
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--output", help=f"results JSON (default {RESULTS_DIR}/pipeline-<time>.json)")
+    run_parser.add_argument("--compare", help="previous results JSON to compare with")
+    run_parser.add_argument("--tolerance", type=float, default=0.1,
+                            help="relative change counted as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
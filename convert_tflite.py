@@ -0,0 +1,186 @@
+"""Converts url_classifier_model.keras into a quantized TFLite model.
+
+Dynamic-range INT8 quantization by default, float16 with --float16. The
+converted model reads the same int32 id matrix as the SavedModel, so the
+scorer can run it with INFERENCE_BACKEND=tflite.
+
+When --eval-benign/--eval-malicious URL lists are given, a sample of them is
+scored with both the Keras and the TFLite model and the accuracy/AUC
+difference is reported against the numbers saved in src_model/results. The
+figures are only held-out results if the lists were kept out of training.
+
+    python convert_tflite.py --eval-benign benign_eval.txt --eval-malicious malicious_eval.txt
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import evaluating_url
+from evaluating_url import (
+    SEQUENCE_LENGTH,
+    THRESHOLD,
+    BucketedPredictor,
+    TFLiteModel,
+    encode_urls,
+    export_serving_model,
+    get_encoder,
+    tflite_lookup_table_path,
+)
+
+RESULTS_DIR = os.path.join("src_model", "results")
+
+
+def convert(float16=False):
+    """Returns the serialized TFLite model for the id-input serving model."""
+    with tempfile.TemporaryDirectory() as export_dir:
+        # Converting from the SavedModel freezes the Keras variables into constants
+        export_serving_model(export_dir)
+        converter = tf.lite.TFLiteConverter.from_saved_model(export_dir, signature_keys=["serve"])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if float16:
+            converter.target_spec.supported_types = [tf.float16]
+        # Folding the BatchNormalization scale into the following dense kernel
+        # before quantizing it collapses every score to the same value. The
+        # switch is a private converter attribute (present up to at least TF
+        # 2.21); if a release drops it, check the converted scores still vary.
+        if hasattr(converter, "_experimental_disable_fuse_mul_and_fc"):
+            converter._experimental_disable_fuse_mul_and_fc = True
+        else:
+            print("Warning: this TensorFlow cannot disable mul/fc fusion; "
+                  "check the converted model's scores.", flush=True)
+        return converter.convert()
+
+
+def load_reference_metrics(results_dir=RESULTS_DIR):
+    """Reads the accuracy, recall and AUC of the saved test-set evaluation."""
+    with open(os.path.join(results_dir, "evaluation_summary.csv"), encoding="utf-8") as f:
+        counts = {row["Category"]: int(row["Count"]) for row in csv.DictReader(f)}
+    with open(os.path.join(results_dir, "model_metrics.csv"), encoding="utf-8") as f:
+        metrics = {row["Metric"]: float(row["Value"]) for row in csv.DictReader(f)}
+    confusion = ("True Positives", "True Negatives", "False Positives", "False Negatives")
+    tp, tn, fp, fn = (counts[name] for name in confusion)
+    return {"accuracy": (tp + tn) / (tp + tn + fp + fn), "recall": tp / (tp + fn), "auc": metrics["AUC-ROC"]}
+
+
+def sample_lines(path, size, rng):
+    """Reservoir-samples non-empty lines, holding only the sample in memory.
+
+    Lines already in the sample are skipped, so it holds distinct URLs; a
+    URL repeated in the file is slightly more likely to be picked.
+    """
+    sample = []
+    in_sample = set()
+    count = 0
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            url = line.strip()
+            if not url or url in in_sample:
+                continue
+            count += 1
+            if len(sample) < size:
+                sample.append(url)
+                in_sample.add(url)
+            else:
+                j = rng.randrange(count)
+                if j < size:
+                    in_sample.discard(sample[j])
+                    sample[j] = url
+                    in_sample.add(url)
+    return sample
+
+
+def roc_auc(labels, scores):
+    """Area under the ROC curve from the Mann-Whitney U statistic."""
+    order = np.argsort(scores, kind="mergesort")
+    sorted_scores = scores[order]
+    ranks = np.empty(len(scores), dtype=np.float64)
+    ranks[order] = np.arange(1, len(scores) + 1)
+    # Average the ranks of tied scores
+    _, first, counts = np.unique(sorted_scores, return_index=True, return_counts=True)
+    for start, count in zip(first[counts > 1], counts[counts > 1]):
+        ranks[order[start:start + count]] = start + (count + 1) / 2
+    positives = labels == 1
+    n_pos, n_neg = positives.sum(), (~positives).sum()
+    return (ranks[positives].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def evaluate(predict, encoded, labels):
+    scores = predict(encoded)[:, 0]
+    accuracy = float(((scores > THRESHOLD) == (labels == 1)).mean())
+    return {"accuracy": accuracy, "auc": float(roc_auc(labels, scores))}
+
+
+def time_predict(predict, encoded, repeats=20):
+    """Median milliseconds per call."""
+    predict(encoded)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(encoded)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=evaluating_url.TFLITE_MODEL_PATH)
+    parser.add_argument("--float16", action="store_true", help="float16 weights instead of dynamic-range INT8")
+    parser.add_argument("--eval-benign", help="benign URL list kept out of training, one per line")
+    parser.add_argument("--eval-malicious", help="malicious URL list kept out of training, one per line")
+    parser.add_argument("--sample", type=int, default=20000, help="URLs sampled per class")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    encoded_model, table = get_encoder()
+    if encoded_model is None:
+        raise SystemExit("Model not available.")
+
+    mode = "float16" if args.float16 else "dynamic-range INT8"
+    print(f"Converting to TFLite ({mode})...", flush=True)
+    with open(args.output, "wb") as f:
+        f.write(convert(float16=args.float16))
+    np.save(tflite_lookup_table_path(args.output), table)
+    keras_size = os.path.getsize(evaluating_url.MODEL_PATH) / 1024
+    tflite_size = os.path.getsize(args.output) / 1024
+    print(f"Saved {args.output}: {tflite_size:.0f} KiB (Keras archive: {keras_size:.0f} KiB)", flush=True)
+
+    keras_predict = BucketedPredictor(tf.function(lambda ids: encoded_model(ids, training=False)))
+    tflite_predict = BucketedPredictor(TFLiteModel(args.output))
+
+    if args.eval_benign and args.eval_malicious:
+        rng = random.Random(args.seed)
+        benign = sample_lines(args.eval_benign, args.sample, rng)
+        malicious = sample_lines(args.eval_malicious, args.sample, rng)
+        labels = np.array([0] * len(benign) + [1] * len(malicious))
+        encoded = encode_urls(benign + malicious, table)
+
+        reference = load_reference_metrics()
+        keras_metrics = evaluate(keras_predict, encoded, labels)
+        tflite_metrics = evaluate(tflite_predict, encoded, labels)
+        print(f"\nEvaluation sample: {len(benign)} benign / {len(malicious)} malicious URLs")
+        print(f"{'':<10}{'saved':>10}{'keras':>10}{'tflite':>10}{'delta':>10}")
+        for metric in ("accuracy", "auc"):
+            delta = tflite_metrics[metric] - keras_metrics[metric]
+            print(f"{metric:<10}{reference[metric]:>10.4f}{keras_metrics[metric]:>10.4f}"
+                  f"{tflite_metrics[metric]:>10.4f}{delta:>+10.4f}")
+    else:
+        print("No --eval-benign/--eval-malicious lists given, timing only.", flush=True)
+        rng = np.random.default_rng(args.seed)
+        shape = (max(evaluating_url.BATCH_BUCKETS), SEQUENCE_LENGTH)
+        encoded = rng.integers(2, table.max() + 1, size=shape).astype(np.int32)
+
+    batch = encoded[:max(evaluating_url.BATCH_BUCKETS)]
+    keras_ms = time_predict(keras_predict, batch)
+    tflite_ms = time_predict(tflite_predict, batch)
+    print(f"\nBatch of {len(batch)}: keras {keras_ms:.1f} ms, tflite {tflite_ms:.1f} ms "
+          f"({keras_ms / tflite_ms:.2f}x, {evaluating_url.TFLITE_NUM_THREADS} threads)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Parallel, resumable crt.sh backfill.
+
+Each search term (e.g. "%.com") has its own cursor: the highest certificate
+ID already handed to the caller. Terms are polled concurrently by a small
+thread pool sharing one pooled requests.Session and one global token
+bucket. Responses are streamed and their JSON array is parsed one
+certificate at a time, so a huge response never sits in memory as a whole.
+
+A term's cursor only moves once all of its certificates have been handled
+and flushed, and cursors are checkpointed atomically (write, fsync,
+rename). A crash therefore resumes from the last completed poll,
+re-delivering at most that poll's certificates.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CRTSH_URL = "https://crt.sh/"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
+HANDLE_CHUNK = 500
+DELIMITERS = ",]} \t\r\n"
+
+
+class TokenBucket:
+    """Thread-safe token bucket: rate requests per second, bursts of up to capacity."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now; a negative balance queues the callers up
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        # Sleep without the lock, so other callers can reserve their turn
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CursorStore:
+    """Per-term certificate ID cursors, checkpointed atomically to a JSON file.
+
+    A file from the single-cursor producer ({"max_cert_id": N}) seeds every
+    term with N, since crt.sh certificate IDs are global.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cursors = {}
+        self.default = None
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.cursors = {term: int(cert_id) for term, cert_id in data.get("cursors", {}).items()}
+            self.default = data.get("max_cert_id")
+
+    def get(self, term):
+        with self.lock:
+            return self.cursors.get(term, self.default)
+
+    def advance(self, term, cert_id):
+        with self.lock:
+            current = self.cursors.get(term, self.default)
+            if current is not None and cert_id <= current:
+                return
+            self.cursors[term] = cert_id
+            self.save()
+
+    def save(self):
+        cursors = dict(self.cursors)
+        data = {"cursors": cursors, "max_cert_id": max(cursors.values(), default=self.default)}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def iter_json_array(chunks):
+    """Yields the elements of a JSON array arriving as an iterable of text chunks.
+
+    Only the element being decoded and the unparsed tail are buffered.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+    exhausted = False
+
+    def fill():
+        nonlocal buffer, pos, exhausted
+        for chunk in chunks:
+            if chunk:
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                return True
+        exhausted = True
+        return False
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return
+
+    skip_whitespace()
+    if pos >= len(buffer) or buffer[pos] != "[":
+        raise ValueError(f"Expected a JSON array, got {buffer[pos:pos + 80]!r}")
+    pos += 1
+    expect_value = True
+    while True:
+        skip_whitespace()
+        if pos >= len(buffer):
+            raise ValueError("Truncated JSON array")
+        char = buffer[pos]
+        if char == "]":
+            return
+        if char == "," and not expect_value:
+            pos += 1
+            expect_value = True
+            continue
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # A number is only complete once a delimiter follows it
+                if exhausted or not isinstance(value, (int, float)) or (
+                        end < len(buffer) and buffer[end] in DELIMITERS):
+                    break
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            if not fill():
+                continue
+        pos = end
+        expect_value = False
+        yield value
+
+
+def create_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+class CrtShBackfill:
+    """Polls crt.sh for every search term, each from its own cursor.
+
+    handle(certs) receives lists of certificate dicts from the worker
+    threads, one call at a time. flush() is called after a poll's last
+    certificate is handled and before its cursor is checkpointed; if it
+    returns False, the cursor stays put and the term is polled again.
+    """
+
+    def __init__(self, terms, cursors, handle, flush=None, base_url=CRTSH_URL, workers=4,
+                 rate=1.0, burst=2, timeout=60, log=print):
+        self.terms = list(terms)
+        self.cursors = cursors
+        self.handle = handle
+        self.flush = flush
+        self.base_url = base_url
+        self.workers = workers
+        self.timeout = timeout
+        self.log = log
+        self.bucket = TokenBucket(rate, burst)
+        self.session = create_session(workers)
+        self.handle_lock = threading.Lock()
+        self.next_due = {term: 0.0 for term in self.terms}
+        self.empty_polls = {term: 0 for term in self.terms}
+
+    def hand_off(self, certs):
+        with self.handle_lock:
+            self.handle(certs)
+
+    def fetch(self, term):
+        """Streams one query for term; returns (HTTP status, certificates handled, highest ID)."""
+        params = {"Identity": term, "output": "json"}
+        cursor = self.cursors.get(term)
+        if cursor is not None:
+            params["minCertID"] = cursor + 1
+
+        self.bucket.acquire()
+        with self.session.get(self.base_url, params=params, timeout=self.timeout, stream=True) as response:
+            if response.status_code != 200:
+                return response.status_code, 0, None
+            response.encoding = response.encoding or "utf-8"
+            count = 0
+            max_id = None
+            pending = []
+            for cert in iter_json_array(response.iter_content(chunk_size=64 * 1024, decode_unicode=True)):
+                cert_id = cert.get("id")
+                # The cursor only moves forward, even if minCertID was ignored
+                if cert_id is None or (cursor is not None and cert_id <= cursor):
+                    continue
+                max_id = cert_id if max_id is None else max(max_id, cert_id)
+                pending.append(cert)
+                if len(pending) >= HANDLE_CHUNK:
+                    self.hand_off(pending)
+                    count += len(pending)
+                    pending = []
+            if pending:
+                self.hand_off(pending)
+                count += len(pending)
+            return 200, count, max_id
+
+    def poll(self, term):
+        """Runs one query for term and schedules its next one."""
+        delay = 2
+        try:
+            status, count, max_id = self.fetch(term)
+            if status == 200:
+                if count:
+                    flushed = True
+                    if self.flush is not None:
+                        with self.handle_lock:
+                            flushed = self.flush() is not False
+                    if flushed:
+                        self.cursors.advance(term, max_id)
+                        self.empty_polls[term] = 0
+                        self.log(f"{term}: {count} certificates, cursor now {max_id}")
+                    else:
+                        delay = 10
+                        self.log(f"{term}: {count} certificates not all published, "
+                                 f"cursor kept, retrying in {delay}s...")
+                else:
+                    self.empty_polls[term] += 1
+                    delay = min(60 * self.empty_polls[term], 300)
+                    self.log(f"{term}: no new certs, next query in {delay}s")
+            elif status == 429:
+                delay = 60
+                self.log(f"{term}: rate limited, waiting {delay}s...")
+            elif status == 404:
+                delay = 5
+                self.log(f"{term}: no results found")
+            else:
+                delay = 10
+                self.log(f"{term}: HTTP {status}, retrying in {delay}s...")
+        except (requests.RequestException, ValueError) as e:
+            delay = 10
+            self.log(f"{term}: request failed ({e}), retrying in {delay}s...")
+        self.next_due[term] = time.monotonic() + delay
+
+    def run(self, stop_event=None, passes=None):
+        """Polls due terms concurrently until stop_event is set, or for the
+        given number of passes over all terms."""
+        stop_event = stop_event or threading.Event()
+        polls = {term: 0 for term in self.terms}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crtsh") as pool:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                busy = set(running.values())
+                for term in self.terms:
+                    if len(running) >= self.workers:
+                        break
+                    if term in busy or self.next_due[term] > now:
+                        continue
+                    if passes is not None and polls[term] >= passes:
+                        continue
+                    polls[term] += 1
+                    running[pool.submit(self.poll, term)] = term
+
+                if not running:
+                    if passes is not None and all(n >= passes for n in polls.values()):
+                        break
+                    stop_event.wait(max(min(self.next_due.values()) - now, 0.1))
+                    continue
+                done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    future.result()
+            wait(running)
@@ -0,0 +1,164 @@
+"""Local stand-in for crt.sh, for testing the backfill without the network.
+
+Serves recorded crt.sh JSON responses from a directory, one file per
+search term, honouring the Identity and minCertID query parameters and
+streaming the body in chunks like the real server:
+
+    python crtsh_stub.py record --term %.com --out crtsh_recordings
+    python crtsh_stub.py serve --dir crtsh_recordings --port 8081
+    CRTSH_URL=http://localhost:8081/ python reserved_producer.py
+
+`serve --synthetic N` generates N fake certificates per term instead of
+reading recordings.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from crtsh import CRTSH_URL, USER_AGENT
+
+
+def recording_path(directory, term):
+    return os.path.join(directory, urllib.parse.quote(term, safe="") + ".json")
+
+
+def synthetic_certs(term, count, seed=0):
+    rng = random.Random(f"{seed}:{term}")
+    suffix = term.lstrip("%")
+    certs = []
+    cert_id = 1_000_000
+    for i in range(count):
+        cert_id += rng.randint(1, 50)
+        name = f"host{rng.randrange(count * 4)}{suffix}"
+        certs.append({
+            "issuer_ca_id": 1,
+            "issuer_name": "C=US, O=Stub CA, CN=Stub",
+            "common_name": name,
+            "name_value": f"{name}\nwww.{name}",
+            "id": cert_id,
+            "entry_timestamp": "2026-01-01T00:00:00.000",
+            "not_before": "2026-01-01T00:00:00",
+            "not_after": "2026-04-01T00:00:00",
+            "serial_number": f"{cert_id:032x}",
+        })
+    return certs
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory=None, synthetic=0, chunk_size=16 * 1024, delay=0.0):
+        super().__init__(address, StubHandler)
+        self.directory = directory
+        self.synthetic = synthetic
+        self.chunk_size = chunk_size
+        self.delay = delay
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def certs_for(self, term):
+        with self.lock:
+            self.requests += 1
+            if term not in self.cache:
+                if self.synthetic:
+                    self.cache[term] = synthetic_certs(term, self.synthetic)
+                else:
+                    path = recording_path(self.directory, term)
+                    self.cache[term] = None
+                    if os.path.exists(path):
+                        with open(path, "r", encoding="utf-8") as f:
+                            self.cache[term] = json.load(f)
+            return self.cache[term]
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-stream are expected in tests
+        pass
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        term = query.get("Identity", [""])[0]
+        min_id = int(query.get("minCertID", ["0"])[0])
+        certs = self.server.certs_for(term)
+        if certs is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps([cert for cert in certs if cert["id"] >= min_id]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(body), self.server.chunk_size):
+            chunk = body[start:start + self.server.chunk_size]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            if self.server.delay:
+                time.sleep(self.server.delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory=None, port=8081, synthetic=0, chunk_size=16 * 1024, delay=0.0):
+    """Starts the stub in a background thread and returns the server."""
+    server = StubServer(("127.0.0.1", port), directory, synthetic, chunk_size, delay)
+    threading.Thread(target=server.serve_forever, name="crtsh-stub", daemon=True).start()
+    return server
+
+
+def record(term, out, min_cert_id=None):
+    params = {"Identity": term, "output": "json"}
+    if min_cert_id:
+        params["minCertID"] = min_cert_id
+    response = requests.get(CRTSH_URL, params=params, headers={"User-Agent": USER_AGENT}, timeout=120)
+    response.raise_for_status()
+    os.makedirs(out, exist_ok=True)
+    path = recording_path(out, term)
+    with open(path, "wb") as f:
+        f.write(response.content)
+    print(f"Recorded {term} to {path} ({len(response.content)} bytes)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="save a live crt.sh response")
+    record_parser.add_argument("--term", action="append", required=True)
+    record_parser.add_argument("--out", default="crtsh_recordings")
+    record_parser.add_argument("--min-cert-id", type=int)
+    serve_parser = commands.add_parser("serve", help="serve recorded responses")
+    serve_parser.add_argument("--dir", default="crtsh_recordings")
+    serve_parser.add_argument("--port", type=int, default=8081)
+    serve_parser.add_argument("--synthetic", type=int, default=0, help="fake certificates per term")
+    serve_parser.add_argument("--chunk-size", type=int, default=16 * 1024)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        for term in args.term:
+            record(term, args.out, args.min_cert_id)
+        return
+    server = serve(args.dir, args.port, args.synthetic, args.chunk_size)
+    print(f"crt.sh stub listening on http://127.0.0.1:{args.port}/", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
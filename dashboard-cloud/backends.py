@@ -0,0 +1,253 @@
+"""Where the dashboard's queries run.
+
+The queries in dashboard.py, rollups.py and recent.py are written once; a
+backend runs them and supplies the few parts that differ between SQL
+dialects:
+
+    table           what FROM reads
+    table_since(t)  what FROM reads for rows from time t on; a subset of
+                    table where the storage is partitioned by time
+                    (a coroutine, it may list files)
+    minute(column)  a timestamp truncated to the minute
+    day(column)     the UTC date of a timestamp
+    domain(column)  the host of a URL, NULL when there is none
+
+Parameters are named @name in the SQL and passed as a dict. run_query
+returns a list of rows with attribute access, and insert_rows(rows) writes
+ingested rows, returning per-row errors as BigQuery's insert_rows_json does.
+
+BigQueryBackend queries the classified_urls table. DuckDBBackend queries the
+Parquet segments the scorer writes (SINK=parquet:///..., see sinks.py) with
+an embedded DuckDB, so the dashboard runs without network round trips,
+per-query billing or a Google project:
+
+    root/date=YYYY-MM-DD/hour=HH/<writer>-<sequence>.parquet
+
+Queries on recent rows only list and open the hour directories from their
+start on, and each file is sorted by time_added, so row group statistics
+let DuckDB skip the rest of a file. Ingested rows are written there as
+segments as well, merged per hour once the hour is over (see segments.py).
+"""
+import asyncio
+import collections
+import datetime
+import functools
+import glob
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import shared  # noqa: F401 (puts segments.py on sys.path)
+from segments import SegmentWriter
+
+DOMAIN_PATTERN = r"(?:https?://)?(?:www\.)?([^/]+)"
+PARAMETER = re.compile(r"@(\w+)")
+EMPTY_TABLE = """(SELECT * FROM (VALUES (NULL::VARCHAR, NULL::DOUBLE, NULL::VARCHAR, NULL::TIMESTAMPTZ,
+        NULL::VARCHAR)) AS empty(url, score, classification, time_added, trace_id) WHERE false)"""
+# BigQuery parameter types by Python type; datetime before date, its base class
+PARAMETER_TYPES = (
+    (bool, "BOOL"),
+    (int, "INT64"),
+    (float, "FLOAT64"),
+    (str, "STRING"),
+    (datetime.datetime, "TIMESTAMP"),
+    (datetime.date, "DATE"),
+)
+
+
+class BigQueryBackend:
+    """Queries and streams into a BigQuery table."""
+
+    name = "bigquery"
+
+    def __init__(self, table_id, max_concurrency=8, insert_concurrency=4, poll_initial=0.05, poll_max=1.0):
+        from google.cloud import bigquery
+
+        self.bigquery = bigquery
+        self.table_id = table_id
+        self.table = f"`{table_id}`"
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.client = bigquery.Client()
+        # Client calls are blocking HTTP requests; they run here, off the event
+        # loop and off the threadpool FastAPI uses for sync handlers
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="bigquery")
+        self.insert_executor = ThreadPoolExecutor(max_workers=insert_concurrency,
+                                                  thread_name_prefix="bigquery-insert")
+        self.slots = asyncio.Semaphore(max_concurrency)
+
+    async def table_since(self, since):
+        # The table is partitioned by day; BigQuery prunes on the WHERE clause
+        return self.table
+
+    def minute(self, column):
+        return f"TIMESTAMP_TRUNC({column}, MINUTE)"
+
+    def day(self, column):
+        return f"DATE({column})"
+
+    def domain(self, column):
+        return f"REGEXP_EXTRACT({column}, r'{DOMAIN_PATTERN}')"
+
+    def parameter(self, name, value):
+        for kind, type_name in PARAMETER_TYPES:
+            if isinstance(value, kind):
+                return self.bigquery.ScalarQueryParameter(name, type_name, value)
+        raise TypeError(f"No BigQuery type for parameter {name!r} of type {type(value).__name__}")
+
+    async def run_query(self, sql, parameters=None, timeout=60):
+        """Runs a query and returns its rows as a list.
+
+        No thread waits on the job: it is started, polled with a backoff and
+        read, each step a short call in the executor. Raises
+        asyncio.TimeoutError, after cancelling the job, when it takes longer
+        than timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        job_config = self.bigquery.QueryJobConfig(query_parameters=[
+            self.parameter(name, value) for name, value in (parameters or {}).items()
+        ])
+        async with self.slots:
+            deadline = loop.time() + timeout
+            job = await loop.run_in_executor(self.executor,
+                                             functools.partial(self.client.query, sql, job_config=job_config))
+            try:
+                delay = self.poll_initial
+                while not await loop.run_in_executor(self.executor, job.done):
+                    if loop.time() + delay > deadline:
+                        raise asyncio.TimeoutError(f"Query {job.job_id} exceeded {timeout:g}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.poll_max)
+                return await loop.run_in_executor(self.executor, lambda: list(job.result()))
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                self.executor.submit(job.cancel)
+                raise
+
+    async def insert_rows(self, rows):
+        """Streams rows into the table; returns BigQuery's per-row errors."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.insert_executor, functools.partial(
+            self.client.insert_rows_json, self.table_id, rows))
+
+
+def quote(text):
+    return "'" + text.replace("'", "''") + "'"
+
+
+def parse_time(value):
+    moment = datetime.datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+
+
+class DuckDBBackend:
+    """Queries Parquet segments under root with an in-process DuckDB."""
+
+    name = "duckdb"
+
+    def __init__(self, root, max_concurrency=2, threads=None, compact_after=300, log=print):
+        import duckdb
+        import pyarrow
+
+        self.duckdb = duckdb
+        self.pa = pyarrow
+        self.root = root
+        self.log = log
+        self.database = duckdb.connect()
+        self.database.execute("SET TimeZone = 'UTC'")
+        # Segments are immutable once renamed into place, so their footers
+        # can be kept between queries
+        self.database.execute("SET parquet_metadata_cache = true")
+        if threads:
+            self.database.execute(f"SET threads = {int(threads)}")
+        self.table = f"read_parquet({quote(os.path.join(root, '**', '*.parquet'))})"
+        # DuckDB releases the GIL while it runs, and parallelizes each query
+        # itself; more queries at once than this would only contend for cores
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="duckdb")
+        self.insert_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="parquet-insert")
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.segments = SegmentWriter(root, "ingest", compact_after)
+
+    async def table_since(self, since):
+        """The files of the hours from since on, listed off the event loop."""
+        return await asyncio.to_thread(self.list_since, since)
+
+    def list_since(self, since):
+        first = os.path.join(f"date={since.astimezone(datetime.timezone.utc):%Y-%m-%d}",
+                             f"hour={since.astimezone(datetime.timezone.utc):%H}")
+        paths = []
+        days = sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+        for day in days:
+            if day < first[:len(day)]:
+                continue
+            for hour in sorted(os.listdir(os.path.join(self.root, day))):
+                if os.path.join(day, hour) >= first:
+                    paths += sorted(glob.glob(os.path.join(self.root, day, hour, "*.parquet")))
+        if not paths:
+            return EMPTY_TABLE
+        return f"read_parquet([{', '.join(map(quote, paths))}])"
+
+    def minute(self, column):
+        return f"date_trunc('minute', {column})"
+
+    def day(self, column):
+        return f"CAST({column} AS DATE)"
+
+    def domain(self, column):
+        # What DOMAIN_PATTERN extracts from a URL with a host, but with string
+        # functions, several times faster than the regex here
+        stripped = (f"CASE WHEN starts_with({column}, 'https://') THEN {column}[9:] "
+                    f"WHEN starts_with({column}, 'http://') THEN {column}[8:] ELSE {column} END")
+        return (f"NULLIF(split_part(CASE WHEN starts_with({stripped}, 'www.') THEN ({stripped})[5:] "
+                f"ELSE {stripped} END, '/', 1), '')")
+
+    def execute(self, cursor, sql, parameters):
+        try:
+            cursor.execute(sql, parameters)
+            Row = collections.namedtuple("Row", [column[0] for column in cursor.description], rename=True)
+            return [Row(*values) for values in cursor.fetchall()]
+        except self.duckdb.IOException as e:
+            # Nothing written yet; BigQuery returns no rows from an empty table
+            if "No files found" in str(e):
+                return []
+            raise
+        finally:
+            cursor.close()
+
+    async def run_query(self, sql, parameters=None, timeout=60):
+        """Runs a query and returns its rows as a list; interrupts it and
+        raises asyncio.TimeoutError after timeout seconds."""
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            cursor = self.database.cursor()
+            future = loop.run_in_executor(self.executor, self.execute, cursor, PARAMETER.sub(r"$\1", sql),
+                                          parameters or {})
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                cursor.interrupt()
+                raise
+
+    async def insert_rows(self, rows):
+        """Writes rows as Parquet segments; a failure fails them all."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.insert_executor, self.write_segments, rows)
+        return []
+
+    def write_segments(self, rows):
+        by_hour = collections.defaultdict(list)
+        for row in rows:
+            moment = parse_time(row["time_added"])
+            by_hour[moment.replace(minute=0, second=0, microsecond=0)].append({**row, "time_added": moment})
+        for hour, hour_rows in by_hour.items():
+            hour_rows.sort(key=lambda row: row["time_added"])
+            self.segments.write(self.pa.Table.from_pylist(hour_rows, schema=self.segments.schema), hour)
+        self.compact()
+
+    def compact(self):
+        """Merges our segments of the hours that are over.
+
+        Runs on the insert thread, so it never races our own writes.
+        """
+        _, failed = self.segments.compact()
+        for hour, error in failed:
+            self.log(f"Merging the segments of {hour:%Y-%m-%d %H}:00 failed: {error!r}")
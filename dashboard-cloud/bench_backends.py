@@ -0,0 +1,164 @@
+"""Endpoint latency of the dashboard's query backends on a synthetic table.
+
+Writes --rows synthetic classified rows spread over --days as hourly
+Parquet files in the layout of SINK=parquet:/// (one merged file per
+hour), then runs dashboard.app in a process per backend with the response
+cache off, so every request runs its queries: the rollup endpoints refresh
+the rollups incrementally, top-domains and top-malicious scan the table.
+Reports the initial rollup build and per endpoint latency percentiles:
+
+    python bench_backends.py --rows 20000000 --days 30
+    python bench_backends.py --skip-generate --backends duckdb bigquery --table my_dataset.synthetic
+
+For BigQuery on the same data, load the generated files into a table with
+    bq load --source_format=PARQUET --time_partitioning_field=time_added \\
+        --clustering_fields=classification my_dataset.synthetic "<root>/*"
+(one hour directory per load, or a GCS copy of the tree), and pass --table.
+"""
+import argparse
+import asyncio
+import datetime
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+ENDPOINTS = (
+    "/api/stats",
+    "/api/realtime-metrics",
+    "/api/confidence-distribution",
+    "/api/timeline",
+    "/api/detection-rate",
+    "/api/url-length",
+    "/api/data",
+    "/api/top-domains",
+    "/api/top-malicious",
+)
+TLDS = np.array([".com", ".net", ".org", ".xyz", ".info", ".top", ".io", ".shop"], dtype=object)
+PATHS = np.array(["/", "/login", "/verify/account", "/secure/update?id=", "/wp-admin/", "/signin/v2/identifier",
+                  "/index.php?session=", "/a/b/c/d/e/f"], dtype=object)
+
+
+def generate(root, rows, days, seed=0):
+    """Writes rows over the last days, one sorted file per hour."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(seed)
+    shutil.rmtree(root, ignore_errors=True)
+    names = np.array([f"site{n}-{rng.integers(1 << 30):x}" for n in range(50000)], dtype=object)
+    domains = pa.array((names + TLDS[rng.integers(len(TLDS), size=len(names))]).tolist())
+    paths = pa.array(PATHS.tolist())
+    end = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    hours = days * 24
+    per_hour = rows // hours
+    start = time.perf_counter()
+    for h in range(hours, -1, -1):
+        hour = end - datetime.timedelta(hours=h)
+        # The current hour only up to now
+        span = 3600 * 1000000 if h else int((time.time() - hour.timestamp()) * 1000000)
+        count = per_hour * span // (3600 * 1000000)
+        if not count:
+            continue
+        # Zipf-like domain popularity, a few very frequent ones
+        domain_index = np.minimum(rng.zipf(1.3, size=count) - 1, len(names) - 1)
+        score = rng.beta(0.4, 0.4, size=count)
+        scheme = np.where(rng.random(count) < 0.8, "https://", "http://").astype(object)
+        url = pc.binary_join_element_wise(
+            pa.array(scheme.tolist()),
+            pc.if_else(pa.array(rng.random(count) < 0.3), "www.", ""),
+            pc.take(domains, pa.array(domain_index)),
+            pc.take(paths, pa.array(rng.integers(len(PATHS), size=count))),
+            pa.array(rng.integers(1 << 20, size=count)).cast(pa.string()),
+            "",
+        )
+        offsets = np.sort(rng.integers(0, span, size=count))
+        micros = int(hour.timestamp()) * 1000000 + offsets
+        table = pa.table({
+            "url": url,
+            "score": score,
+            "classification": pa.array(np.where(score >= 0.5, "MALICIOUS", "BENIGN").tolist()),
+            "time_added": pa.array(micros, pa.timestamp("us", tz="UTC")),
+            "trace_id": pa.nulls(count, pa.string()),
+        })
+        directory = os.path.join(root, f"date={hour:%Y-%m-%d}", f"hour={hour:%H}")
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(table, os.path.join(directory, "synthetic-00000001.parquet"))
+    size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+    print(f"Wrote {per_hour * hours:,} rows in {hours + 1} hourly files ({size / (1 << 20):,.0f} MiB) in "
+          f"{time.perf_counter() - start:.0f}s", flush=True)
+
+
+def measure(backend, args, results):
+    """Server side: imports the dashboard with the cache off and times its endpoints."""
+    os.environ.update({
+        "DASHBOARD_BACKEND": backend,
+        "PARQUET_ROOT": args.root,
+        "ROLLUP_REFRESH_INTERVAL": "0",
+        "CACHE_TTL_TOP_DOMAINS": "0",
+        "CACHE_TTL_TOP_MALICIOUS": "0",
+        "CACHE_TTL_DATA": "0",
+        "CACHE_STALE_SECONDS": "0",
+        "WIDGET_TIMEOUT": "600",
+    })
+    if args.table:
+        os.environ["BIGQUERY_TABLE_ID"] = args.table
+    import httpx
+    import dashboard
+
+    dashboard.rollups.log = lambda msg: None
+
+    async def run():
+        start = time.perf_counter()
+        await dashboard.rollups.refresh()
+        timings = {"rollup build": [time.perf_counter() - start]}
+        transport = httpx.ASGITransport(app=dashboard.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://dashboard") as client:
+            for endpoint in ENDPOINTS:
+                timings[endpoint] = []
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    response = await client.get(endpoint)
+                    timings[endpoint].append(time.perf_counter() - start)
+                    response.raise_for_status()
+        return timings
+
+    results[backend] = asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--root", default="bench_results/parquet", help="where the Parquet files go")
+    parser.add_argument("--skip-generate", action="store_true", help="reuse the files under --root")
+    parser.add_argument("--backends", nargs="+", choices=("duckdb", "bigquery"), default=["duckdb"])
+    parser.add_argument("--table", help="BigQuery table for the bigquery backend")
+    parser.add_argument("--requests", type=int, default=20, help="requests per endpoint")
+    args = parser.parse_args()
+
+    if not args.skip_generate:
+        generate(args.root, args.rows, args.days)
+    context = multiprocessing.get_context("spawn")
+    results = context.Manager().dict()
+    for backend in args.backends:
+        process = context.Process(target=measure, args=(backend, args, results))
+        process.start()
+        process.join()
+        if process.exitcode:
+            raise SystemExit(f"{backend} run failed")
+
+    print(f"\n{'':32}" + "".join(f"{backend + ' p50/p95 ms':>26}" for backend in args.backends))
+    for name in ("rollup build",) + ENDPOINTS:
+        cells = []
+        for backend in args.backends:
+            p50, p95 = np.percentile(results[backend][name], [50, 95]) * 1000
+            cells.append(f"{p50:12.1f} / {p95:9.1f}")
+        print(f"{name:32}" + "".join(f"{cell:>26}" for cell in cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Load test for the WebSocket fan-out with local clients.
+
+Starts a server process with a broadcast.Hub behind /ws that publishes
+--rate rows/s, each stamped with its publish time, then connects --clients
+WebSocket clients from this process. --slow of them connect but never read,
+to check that they do not hold back the others (the hub's slow_disconnects
+and dropped_frames show how they were handled). Reports the publish to
+receive latency seen by --measure of the reading clients, frames received,
+and what the hub dropped or disconnected:
+
+    python bench_broadcast.py --clients 2000 --slow 50 --rate 500 --seconds 30
+    python bench_broadcast.py --clients 2000 --slow 50 --policy disconnect
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import time
+import urllib.request
+
+import numpy as np
+
+from broadcast import POLICIES, Hub
+
+
+def serve(port, args):
+    """Server process: the hub, a publisher and /stats."""
+    import uvicorn
+    from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+    app = FastAPI()
+    hub = Hub(queue_size=args.queue, policy=args.policy, interval=args.interval, log=lambda msg: None)
+
+    @app.websocket("/ws")
+    async def websocket_endpoint(websocket: WebSocket):
+        client = await hub.connect(websocket)
+        try:
+            while True:
+                await websocket.receive_text()
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            hub.disconnect(client)
+
+    @app.get("/stats")
+    def stats():
+        return hub.stats()
+
+    async def publish():
+        # Submissions arrive in small groups, as from several scorer instances
+        tick = 0.02
+        per_tick = args.rate * tick
+        owed = 0.0
+        sequence = 0
+        while True:
+            await asyncio.sleep(tick)
+            owed += per_tick
+            rows = []
+            while owed >= 1:
+                owed -= 1
+                sequence += 1
+                rows.append({"url": f"https://example-{sequence}.test/login", "classification": "MALICIOUS",
+                             "score": 0.97, "time_added": "2025-01-01T00:00:00+00:00", "sent": time.time()})
+            if rows:
+                hub.publish(rows)
+
+    @app.on_event("startup")
+    async def start_publisher():
+        asyncio.ensure_future(publish())
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", ws_per_message_deflate=False)
+
+
+def fetch_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=10) as response:
+        return json.loads(response.read())
+
+
+async def run_clients(args):
+    import websockets
+
+    url = f"ws://127.0.0.1:{args.port}/ws"
+    latencies = []
+    frames = []
+    closed = [0]
+    failed_connects = 0
+    deadline = None
+
+    async def reader(connection, measure):
+        count = 0
+        try:
+            async for message in connection:
+                count += 1
+                if measure:
+                    now = time.time()
+                    latencies.extend(now - row["sent"] for row in json.loads(message))
+                if time.monotonic() >= deadline:
+                    break
+        except websockets.ConnectionClosed:
+            closed[0] += 1
+        frames.append(count)
+
+    async def idle(connection):
+        # Never reads, so the server's sends to it stall
+        connection.transport.pause_reading()
+        await connection.wait_closed()
+
+    async def connect(slow):
+        sock = None
+        if slow:
+            # A small receive buffer, set before connecting so the window stays
+            # small: backpressure reaches the server within the run instead of
+            # after megabytes of kernel buffering
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", args.port))
+        # Uncompressed, as the dashboard serves it (see Dockerfile)
+        return await websockets.connect(url, sock=sock, max_queue=4, open_timeout=30,
+                                        ping_interval=None, compression=None)
+
+    connections = []
+    for start in range(0, args.clients, 100):
+        attempts = [connect(i < args.slow) for i in range(start, min(start + 100, args.clients))]
+        for result in await asyncio.gather(*attempts, return_exceptions=True):
+            if isinstance(result, Exception):
+                failed_connects += 1
+            else:
+                connections.append(result)
+    print(f"{len(connections)} clients connected ({failed_connects} failed)", flush=True)
+
+    deadline = time.monotonic() + args.seconds
+    slow = connections[:args.slow]
+    fast = connections[args.slow:]
+    tasks = [asyncio.ensure_future(idle(connection)) for connection in slow]
+    tasks += [asyncio.ensure_future(reader(connection, i < args.measure)) for i, connection in enumerate(fast)]
+    await asyncio.sleep(args.seconds)
+    stats = await asyncio.get_running_loop().run_in_executor(None, fetch_stats, args.port)
+    await asyncio.wait(tasks, timeout=5)
+    for task in tasks:
+        task.cancel()
+    for connection in connections:
+        connection.transport.abort()
+    return latencies, frames, closed, failed_connects, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--slow", type=int, default=0, help="clients that never read")
+    parser.add_argument("--measure", type=int, default=100, help="reading clients that record latency")
+    parser.add_argument("--rate", type=float, default=200, help="rows published per second")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--queue", type=int, default=64, help="frames queued per client")
+    parser.add_argument("--policy", choices=POLICIES, default="drop-oldest")
+    parser.add_argument("--interval", type=float, default=0.25, help="seconds between batched frames")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(args.port, args), daemon=True)
+    server.start()
+    for _ in range(100):
+        try:
+            fetch_stats(args.port)
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        raise SystemExit("Server did not start.")
+
+    try:
+        latencies, frames, closed, failed_connects, stats = asyncio.run(run_clients(args))
+    finally:
+        server.terminate()
+        server.join()
+
+    expected_frames = args.seconds / args.interval
+    print(f"\n{args.clients} clients ({args.slow} not reading), {args.rate:g} rows/s for {args.seconds:g}s, "
+          f"policy {args.policy}")
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print(f"Latency over {len(latencies)} rows: p50={p50:.0f}ms p95={p95:.0f}ms p99={p99:.0f}ms "
+              f"max={max(latencies) * 1000:.0f}ms")
+    if frames:
+        print(f"Frames per reading client: mean {np.mean(frames):.1f}, min {min(frames)} "
+              f"(about {expected_frames:.0f} sent)")
+    print(f"Reading clients closed by the server: {closed[0]}")
+    print(f"Hub: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Load test for POST /api/ingest with a local stand-in for BigQuery.
+
+Runs dashboard.app in a server process where bigquery.Client is replaced
+by LocalBigQuery, whose insert_rows_json only sleeps --insert-latency
+seconds, then posts gzip NDJSON batches of --batch rows from --concurrency
+clients for --seconds. Reports acknowledged rows/s, response latency
+percentiles, 503s, and the rows/s the background writer got through:
+
+    python bench_ingest.py --batch 1000 --concurrency 16 --seconds 30
+    python bench_ingest.py --batch 100 --no-gzip
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import multiprocessing
+import time
+
+import numpy as np
+
+
+class LocalBigQuery:
+    """Accepts streaming inserts after a fixed delay; the dashboard makes no queries here."""
+
+    insert_latency = 0.05
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def insert_rows_json(self, table, rows):
+        time.sleep(self.insert_latency)
+        return []
+
+
+def serve(port, insert_latency):
+    from google.cloud import bigquery
+
+    LocalBigQuery.insert_latency = insert_latency
+    bigquery.Client = LocalBigQuery
+    import uvicorn
+    import dashboard
+
+    dashboard.writer.log = lambda msg: None
+    uvicorn.run(dashboard.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def make_bodies(batch, count, compress):
+    bodies = []
+    for n in range(count):
+        lines = "".join(
+            json.dumps({"url": f"https://login-{n}-{i}.example.test/verify", "score": 0.93,
+                        "classification": "MALICIOUS", "time_added": "2025-01-01T00:00:00+00:00"}) + "\n"
+            for i in range(batch)
+        ).encode("utf-8")
+        bodies.append(gzip.compress(lines, compresslevel=1) if compress else lines)
+    return bodies
+
+
+async def run_load(args, bodies):
+    import httpx
+
+    url = f"http://127.0.0.1:{args.port}"
+    headers = {"Content-Type": "application/x-ndjson"}
+    if not args.no_gzip:
+        headers["Content-Encoding"] = "gzip"
+    latencies = []
+    counts = {"rows": 0, "rejected": 0, "unavailable": 0, "errors": 0}
+    deadline = time.perf_counter() + args.seconds
+
+    async def worker(client, offset):
+        i = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = await client.post(f"{url}/api/ingest", content=bodies[i % len(bodies)], headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code == 202:
+                result = response.json()
+                counts["rows"] += result["accepted"]
+                counts["rejected"] += result["rejected"]
+            elif response.status_code == 503:
+                counts["unavailable"] += 1
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+            else:
+                counts["errors"] += 1
+            i += args.concurrency
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, offset) for offset in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        # Let the writer catch up with what was acknowledged
+        drain_start = time.perf_counter()
+        while True:
+            stats = (await client.get(f"{url}/api/ingest-stats")).json()
+            if stats["written_rows"] + stats["failed_rows"] >= stats["accepted_rows"] or \
+                    time.perf_counter() - drain_start > 120:
+                break
+            await asyncio.sleep(0.2)
+        written_elapsed = time.perf_counter() - start
+    return latencies, counts, elapsed, stats, written_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=1000, help="rows per request")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--insert-latency", type=float, default=0.05, help="seconds per stand-in insert call")
+    parser.add_argument("--no-gzip", action="store_true")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    bodies = make_bodies(args.batch, 16, not args.no_gzip)
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(args.port, args.insert_latency),
+                                                          daemon=True)
+    server.start()
+    try:
+        import httpx
+
+        for _ in range(200):
+            try:
+                httpx.get(f"http://127.0.0.1:{args.port}/api/ingest-stats", timeout=1)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        else:
+            raise SystemExit("Server did not start.")
+        latencies, counts, elapsed, stats, written_elapsed = asyncio.run(run_load(args, bodies))
+    finally:
+        server.terminate()
+        server.join()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    print(f"{len(latencies)} requests of {args.batch} rows ({'NDJSON' if args.no_gzip else 'gzip NDJSON'}, "
+          f"{np.mean([len(body) for body in bodies]) / 1024:.0f} KiB), {args.concurrency} in flight")
+    print(f"Acknowledged: {counts['rows'] / elapsed:,.0f} rows/s, latency p50={p50:.1f}ms p95={p95:.1f}ms "
+          f"p99={p99:.1f}ms")
+    print(f"503 (writer behind): {counts['unavailable']}, other errors: {counts['errors']}, "
+          f"rejected rows: {counts['rejected']}")
+    print(f"Written: {stats['written_rows']:,} rows, {stats['written_rows'] / written_elapsed:,.0f} rows/s "
+          f"including the drain; writer {stats}")
+
+
+if __name__ == "__main__":
+    main()
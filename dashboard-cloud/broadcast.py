@@ -0,0 +1,131 @@
+"""WebSocket fan-out for new classifications.
+
+Hub.publish() only appends rows to a pending batch and returns. A flush task
+turns the batch into one JSON array every interval seconds (sooner once
+max_batch rows are waiting), serializes it once and queues the same text
+frame for every client. Each client has its own writer task and a bounded
+queue, so clients are sent to concurrently and a slow one only delays
+itself. When its queue is full, the "drop-oldest" policy discards its
+oldest frame and "disconnect" closes it; a send taking longer than
+send_timeout seconds closes it too.
+"""
+import asyncio
+import json
+from collections import deque
+
+POLICIES = ("drop-oldest", "disconnect")
+# Close code for clients dropped for not keeping up ("try again later")
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+
+class Client:
+    def __init__(self, websocket, queue_size):
+        self.websocket = websocket
+        self.queue = deque(maxlen=queue_size)
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.writer = None
+
+
+class Hub:
+    def __init__(self, queue_size=64, policy="drop-oldest", interval=0.25, max_batch=1000,
+                 send_timeout=10.0, log=print):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow client policy {policy!r}, expected one of {POLICIES}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.interval = interval
+        self.max_batch = max_batch
+        self.send_timeout = send_timeout
+        self.log = log
+        self.clients = set()
+        self.pending = []
+        self.flush_now = asyncio.Event()
+        self.flusher = None
+        self.counts = {"published_rows": 0, "frames": 0, "dropped_frames": 0, "slow_disconnects": 0,
+                       "send_errors": 0}
+
+    def start(self):
+        if self.flusher is None or self.flusher.done():
+            # A fresh event, in case the last flusher ran on another loop
+            self.flush_now = asyncio.Event()
+            self.flusher = asyncio.ensure_future(self.flush_loop())
+
+    async def connect(self, websocket):
+        await websocket.accept()
+        self.start()
+        client = Client(websocket, self.queue_size)
+        client.writer = asyncio.ensure_future(self.write_loop(client))
+        self.clients.add(client)
+        return client
+
+    def disconnect(self, client):
+        """Forgets a client; safe to call more than once."""
+        if client in self.clients:
+            self.clients.discard(client)
+            client.writer.cancel()
+
+    def publish(self, rows):
+        """Queues rows for the next frame; never waits on clients."""
+        self.start()
+        self.pending.extend(rows)
+        self.counts["published_rows"] += len(rows)
+        if len(self.pending) >= self.max_batch:
+            self.flush_now.set()
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_now.clear()
+            while self.pending:
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+                self.send_all(json.dumps(batch, default=str))
+
+    def send_all(self, frame):
+        self.counts["frames"] += 1
+        for client in list(self.clients):
+            if len(client.queue) == self.queue_size:
+                if self.policy == "disconnect":
+                    self.counts["slow_disconnects"] += 1
+                    self.drop(client)
+                    continue
+                # The deque's maxlen discards the oldest frame on append
+                client.dropped += 1
+                self.counts["dropped_frames"] += 1
+            client.queue.append(frame)
+            client.wakeup.set()
+
+    def drop(self, client):
+        self.disconnect(client)
+        asyncio.ensure_future(self.close(client, SLOW_CLIENT_CLOSE_CODE))
+
+    async def close(self, client, code):
+        try:
+            await asyncio.wait_for(client.websocket.close(code=code), self.send_timeout)
+        except Exception:
+            pass
+
+    async def write_loop(self, client):
+        try:
+            while True:
+                await client.wakeup.wait()
+                client.wakeup.clear()
+                while client.queue:
+                    frame = client.queue.popleft()
+                    await asyncio.wait_for(client.websocket.send_text(frame), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.counts["slow_disconnects"] += 1
+            self.drop(client)
+        except Exception:
+            # Closed underneath us; the endpoint's receive loop notices too
+            self.counts["send_errors"] += 1
+            self.disconnect(client)
+
+    def stats(self):
+        return {**self.counts, "clients": len(self.clients), "pending_rows": len(self.pending),
+                "queued_frames": sum(len(client.queue) for client in self.clients)}
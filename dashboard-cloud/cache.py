@@ -0,0 +1,78 @@
+"""Response cache for the dashboard endpoints.
+
+Every widget of every open dashboard polls the API, so most requests ask
+for a result another viewer fetched a moment ago. QueryCache keeps one
+value per key:
+
+- fresher than its TTL, it is returned as is;
+- up to stale seconds past its TTL, it is returned at once while a single
+  background refresh runs (stale-while-revalidate);
+- missing or older, the first caller runs the loader and concurrent callers
+  for the same key wait for that result instead of starting their own
+  query (single-flight).
+
+A failed refresh keeps serving the stale value; a failed load raises to
+every caller waiting on it and is not cached.
+"""
+import asyncio
+import time
+
+
+class QueryCache:
+    """Cache of async loaders, for use from one event loop."""
+
+    def __init__(self, log=print):
+        self.log = log
+        # key -> (value, monotonic time it was loaded)
+        self.entries = {}
+        # key -> task running the loader
+        self.flights = {}
+        self.counts = {"hit": 0, "stale": 0, "miss": 0, "coalesced": 0, "error": 0}
+
+    async def get(self, key, loader, ttl, stale=0):
+        entry = self.entries.get(key)
+        age = time.monotonic() - entry[1] if entry else None
+        if entry and age < ttl:
+            self.counts["hit"] += 1
+            return entry[0]
+        flight = self.flights.get(key)
+        if entry and age < ttl + stale:
+            self.counts["stale"] += 1
+            if flight is None:
+                self.start(key, loader)
+            return entry[0]
+        if flight is None:
+            self.counts["miss"] += 1
+            flight = self.start(key, loader)
+        else:
+            self.counts["coalesced"] += 1
+        # A caller giving up (timeout, disconnect) does not cancel the load
+        # the others wait on
+        return await asyncio.shield(flight)
+
+    def start(self, key, loader):
+        flight = self.flights[key] = asyncio.ensure_future(self.load(key, loader))
+        # Background refreshes have no one awaiting them; their errors are logged in load
+        flight.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return flight
+
+    async def load(self, key, loader):
+        try:
+            value = await loader()
+            self.entries[key] = (value, time.monotonic())
+            return value
+        except Exception as e:
+            self.counts["error"] += 1
+            self.log(f"Refreshing {key} failed: {e!r}")
+            raise
+        finally:
+            self.flights.pop(key, None)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        return {**self.counts, "entries": len(self.entries), "in_flight": len(self.flights)}
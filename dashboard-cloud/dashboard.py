@@ -1,17 +1,162 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from google.cloud import bigquery
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
+import asyncio
+import datetime
+import hashlib
 import os
 import uvicorn
 from typing import List, Dict, Any
 
-
-BIGQUERY_TABLE_ID = "big_data_uet_dataset.classified_urls"
+from backends import BigQueryBackend, DuckDBBackend
+from broadcast import Hub
+from cache import QueryCache
+from ingest import IngestError, IngestWriter, WriterFull, read_ndjson, validate_row_ignoring_unknown
+from recent import RecentRows
+from rollups import COUNT, LOW_CONFIDENCE, SCORE_SUM, SCORED, Rollups, utcnow
+from sketches import WINDOWS, SketchReader
+
+
+BIGQUERY_TABLE_ID = os.environ.get("BIGQUERY_TABLE_ID", "big_data_uet_dataset.classified_urls")
+
+# Where queries run (see backends.py): "bigquery", or "duckdb" over the
+# Parquet segments the scorer writes under PARQUET_ROOT (SINK=parquet:///...)
+DASHBOARD_BACKEND = os.environ.get("DASHBOARD_BACKEND", "bigquery")
+PARQUET_ROOT = os.environ.get("PARQUET_ROOT", "data/classified_urls")
+# DuckDB queries running at once and the threads each may use (0: one per core)
+DUCKDB_MAX_CONCURRENCY = int(os.environ.get("DUCKDB_MAX_CONCURRENCY", 2))
+DUCKDB_THREADS = int(os.environ.get("DUCKDB_THREADS", 0))
+# Where the scorers snapshot their domain sketches (SKETCH_DIR in
+# evaluating_url.py), read for the last hour and last day domain widgets
+SKETCH_DIR = os.environ.get("SKETCH_DIR", "sketches")
+
+# Response cache (see cache.py): seconds a result is served as is, and how
+# long past that it is still served while one request refreshes it
+CACHE_TTLS = {
+    "rollups": float(os.environ.get("ROLLUP_REFRESH_INTERVAL", 10)),
+    "top-domains": float(os.environ.get("CACHE_TTL_TOP_DOMAINS", 300)),
+    "top-malicious": float(os.environ.get("CACHE_TTL_TOP_MALICIOUS", 30)),
+    "data": float(os.environ.get("CACHE_TTL_DATA", 5)),
+    "sketches": float(os.environ.get("CACHE_TTL_SKETCHES", 30)),
+}
+CACHE_STALE_SECONDS = float(os.environ.get("CACHE_STALE_SECONDS", 120))
+
+# Bulk ingestion (see ingest.py): request limits, rows per background flush
+# and per insert call, inserts running at once, and rows waiting to be
+# written before /api/ingest answers 503
+INGEST_MAX_BYTES = int(os.environ.get("INGEST_MAX_BYTES", 64 << 20))
+INGEST_MAX_ROWS = int(os.environ.get("INGEST_MAX_ROWS", 100000))
+INGEST_FLUSH_ROWS = int(os.environ.get("INGEST_FLUSH_ROWS", 5000))
+INGEST_FLUSH_INTERVAL = float(os.environ.get("INGEST_FLUSH_INTERVAL", 1.0))
+INGEST_INSERT_ROWS = int(os.environ.get("INGEST_INSERT_ROWS", 500))
+INGEST_INSERT_CONCURRENCY = int(os.environ.get("INGEST_INSERT_CONCURRENCY", 4))
+INGEST_MAX_PENDING_ROWS = int(os.environ.get("INGEST_MAX_PENDING_ROWS", 200000))
+
+# Rows kept for /api/data and its deltas (see recent.py), and the most rows
+# a delta returns before the client is told to reset
+RECENT_ROWS = int(os.environ.get("RECENT_ROWS", 1000))
+RECENT_LIMIT = 100
+
+# Rollups (see rollups.py) behind stats, realtime metrics, distributions,
+# timeline and detection rate
+ROLLUP_MINUTES = int(os.environ.get("ROLLUP_MINUTES", 120))
+ROLLUP_SETTLE_SECONDS = float(os.environ.get("ROLLUP_SETTLE_SECONDS", 120))
+ROLLUP_RESYNC_INTERVAL = float(os.environ.get("ROLLUP_RESYNC_INTERVAL", 6 * 3600))
+
+# Query limits: BigQuery jobs running at once, seconds before a query is
+# cancelled, and seconds a widget may take before its endpoint answers 504
+# (the query keeps running and fills the cache for the next poll)
+BIGQUERY_MAX_CONCURRENCY = int(os.environ.get("BIGQUERY_MAX_CONCURRENCY", 8))
+QUERY_TIMEOUT = float(os.environ.get("QUERY_TIMEOUT", 60))
+ROLLUP_QUERY_TIMEOUT = float(os.environ.get("ROLLUP_QUERY_TIMEOUT", 300))
+WIDGET_TIMEOUT = float(os.environ.get("WIDGET_TIMEOUT", 10))
+# Seconds between job status checks, doubling up to the maximum
+POLL_INITIAL = 0.05
+POLL_MAX = 1.0
+
+# WebSocket fan-out (see broadcast.py): frames queued per client, what to do
+# when a client's queue is full ("drop-oldest" or "disconnect"), seconds
+# between batched frames and the most rows in one frame
+WS_CLIENT_QUEUE = int(os.environ.get("WS_CLIENT_QUEUE", 64))
+WS_SLOW_CLIENT_POLICY = os.environ.get("WS_SLOW_CLIENT_POLICY", "drop-oldest")
+WS_FLUSH_INTERVAL = float(os.environ.get("WS_FLUSH_INTERVAL", 0.25))
+WS_MAX_BATCH = int(os.environ.get("WS_MAX_BATCH", 1000))
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", 10))
 
 
 app = FastAPI()
-client = bigquery.Client()
+if DASHBOARD_BACKEND == "bigquery":
+    backend = BigQueryBackend(BIGQUERY_TABLE_ID, max_concurrency=BIGQUERY_MAX_CONCURRENCY,
+                              insert_concurrency=INGEST_INSERT_CONCURRENCY, poll_initial=POLL_INITIAL,
+                              poll_max=POLL_MAX)
+elif DASHBOARD_BACKEND == "duckdb":
+    backend = DuckDBBackend(PARQUET_ROOT, max_concurrency=DUCKDB_MAX_CONCURRENCY, threads=DUCKDB_THREADS)
+else:
+    raise ValueError(f"Unknown DASHBOARD_BACKEND {DASHBOARD_BACKEND!r}, expected bigquery or duckdb")
+
+
+async def run_query(sql, parameters=None, timeout=QUERY_TIMEOUT):
+    return await backend.run_query(sql, parameters, timeout=timeout)
+
+
+cache = QueryCache()
+rollups = Rollups(backend, minutes=ROLLUP_MINUTES, settle_seconds=ROLLUP_SETTLE_SECONDS,
+                  resync_interval=ROLLUP_RESYNC_INTERVAL, query_timeout=ROLLUP_QUERY_TIMEOUT)
+recent = RecentRows(backend, size=RECENT_ROWS, settle_seconds=ROLLUP_SETTLE_SECONDS)
+sketch_reader = SketchReader(SKETCH_DIR)
+
+
+def cached(key, loader, ttl_key=None):
+    return cache.get(key, loader, CACHE_TTLS[ttl_key or key], CACHE_STALE_SECONDS)
+
+
+def current_rollups():
+    return cached("rollups", rollups.refresh)
+
+
+def current_recent():
+    return cached("data", recent.refresh)
+
+
+async def widget(view, *args):
+    """Runs one widget's view for its endpoint, mapping failures to HTTP errors."""
+    try:
+        return await asyncio.wait_for(view(*args), WIDGET_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"{view.__name__} timed out")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def etag_matches(etag, if_none_match):
+    """Whether an If-None-Match header value lists etag or is "*"; weak
+    tags (W/"...") match their strong form."""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+@app.middleware("http")
+async def etag_middleware(request: Request, call_next):
+    """Tags GET /api JSON responses with a hash of their body and answers
+    304 when the client already has it, so unchanged polls cost no payload.
+    Other responses (streams, NDJSON) pass through unbuffered."""
+    response = await call_next(request)
+    if request.method != "GET" or not request.url.path.startswith("/api/") or response.status_code != 200:
+        return response
+    if response.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+    headers = {name: value for name, value in response.headers.items() if name.lower() != "content-length"}
+    headers["ETag"] = etag
+    headers["Cache-Control"] = "no-cache"
+    if etag_matches(etag, request.headers.get("if-none-match", "")):
+        headers.pop("content-type", None)
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, status_code=200, headers=headers, media_type=response.media_type)
 
 
 app.add_middleware(
@@ -23,33 +168,25 @@ app.add_middleware(
 )
 
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, data: Dict[str, Any]):
-        for connection in self.active_connections:
-            await connection.send_json(data)
-
-manager = ConnectionManager()
+hub = Hub(queue_size=WS_CLIENT_QUEUE, policy=WS_SLOW_CLIENT_POLICY, interval=WS_FLUSH_INTERVAL,
+          max_batch=WS_MAX_BATCH, send_timeout=WS_SEND_TIMEOUT)
+# Rows reach the dashboards once they are written
+writer = IngestWriter(backend.insert_rows, flush_rows=INGEST_FLUSH_ROWS, flush_interval=INGEST_FLUSH_INTERVAL,
+                      insert_rows_per_call=INGEST_INSERT_ROWS, max_pending_rows=INGEST_MAX_PENDING_ROWS,
+                      on_written=hub.publish)
 
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    client = await hub.connect(websocket)
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
+    finally:
+        hub.disconnect(client)
 
 
 
@@ -58,154 +195,138 @@ def read_root():
     return FileResponse('index.html')
 
 
-QUERY_GET_STATS = f"""
-    SELECT 
-        COUNT(*) as total_urls,
-        SUM(CASE WHEN classification = 'MALICIOUS' THEN 1 ELSE 0 END) as total_malicious,
-        AVG(CASE WHEN classification = 'MALICIOUS' THEN score END) as avg_malicious_score,
-        AVG(CASE WHEN classification = 'BENIGN' THEN score END) as avg_benign_score,
-        SUM(CASE WHEN classification = 'MALICIOUS' AND score < 0.7 THEN 1 ELSE 0 END) as low_confidence_malicious,
-        SUM(CASE WHEN classification = 'BENIGN' AND score > 0.3 THEN 1 ELSE 0 END) as low_confidence_benign
-    FROM `{BIGQUERY_TABLE_ID}`
-"""
+async def stats():
+    groups = (await current_rollups()).group(("classification",))
+    empty = [0, 0, 0.0, 0]
+    malicious = groups.get(("MALICIOUS",), empty)
+    benign = groups.get(("BENIGN",), empty)
+    total_urls = sum(values[COUNT] for values in groups.values())
+    total_malicious = malicious[COUNT]
+    return {
+        "total_urls": total_urls,
+        "total_malicious": total_malicious,
+        "total_benign": total_urls - total_malicious,
+        "malicious_rate": round(total_malicious / total_urls * 100, 2) if total_urls > 0 else 0,
+        "benign_rate": round((total_urls - total_malicious) / total_urls * 100, 2) if total_urls > 0 else 0,
+        "avg_malicious_confidence": round(malicious[SCORE_SUM] / malicious[SCORED], 3) if malicious[SCORED] else 0,
+        "avg_benign_confidence": round(benign[SCORE_SUM] / benign[SCORED], 3) if benign[SCORED] else 0,
+        "low_confidence_malicious": malicious[LOW_CONFIDENCE],
+        "low_confidence_benign": benign[LOW_CONFIDENCE],
+        "false_positive_rate": round(benign[LOW_CONFIDENCE] / total_urls * 100, 2) if total_urls > 0 else 0
+    }
+
 
 @app.get("/api/stats")
-def get_stats():
-    try:
-        rows = client.query(QUERY_GET_STATS).result()
-        row = next(rows)
-        return {
-            "total_urls": row.total_urls,
-            "total_malicious": row.total_malicious,
-            "total_benign": row.total_urls - row.total_malicious,
-            "malicious_rate": round(row.total_malicious / row.total_urls * 100, 2) if row.total_urls > 0 else 0,
-            "benign_rate": round((row.total_urls - row.total_malicious) / row.total_urls * 100, 2) if row.total_urls > 0 else 0,
-            "avg_malicious_confidence": round(float(row.avg_malicious_score or 0), 3),
-            "avg_benign_confidence": round(float(row.avg_benign_score or 0), 3),
-            "low_confidence_malicious": row.low_confidence_malicious,
-            "low_confidence_benign": row.low_confidence_benign,
-            "false_positive_rate": round(row.low_confidence_benign / row.total_urls * 100, 2) if row.total_urls > 0 else 0
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_stats():
+    return await widget(stats)
 
 
 
-QUERY_GET_REALTIME_METRICS = f"""
-    SELECT 
-        COUNT(*) as total_last_hour,
-        SUM(CASE WHEN classification = 'MALICIOUS' THEN 1 ELSE 0 END) as malicious_last_hour,
-        MAX(time_added) as latest_detection
-    FROM `{BIGQUERY_TABLE_ID}`
-    WHERE time_added >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 1 HOUR)
-"""
+async def realtime_metrics():
+    current = await current_rollups()
+    since = utcnow() - datetime.timedelta(hours=1)
+    groups = current.group(("classification",), since=since)
+    latest = current.latest(since)
+    return {
+        "total_last_hour": sum(values[COUNT] for values in groups.values()),
+        "malicious_last_hour": groups.get(("MALICIOUS",), [0])[COUNT],
+        "latest_detection": latest.isoformat() if latest else None
+    }
+
 
 @app.get("/api/realtime-metrics")
-def get_realtime_metrics():
-    try:
-        rows = client.query(QUERY_GET_REALTIME_METRICS).result()
-        row = next(rows)
-        return {
-            "total_last_hour": row.total_last_hour,
-            "malicious_last_hour": row.malicious_last_hour,
-            "latest_detection": row.latest_detection.isoformat() if row.latest_detection else None
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_realtime_metrics():
+    return await widget(realtime_metrics)
     
 
 
-QUERY_GET_CONFIDENCE_DIST = f"""
-    SELECT 
-        classification,
-        CASE 
-            WHEN score >= 0.9 THEN '0.9-1.0'
-            WHEN score >= 0.7 THEN '0.7-0.9'
-            WHEN score >= 0.5 THEN '0.5-0.7'
-            WHEN score >= 0.3 THEN '0.3-0.5'
-            WHEN score >= 0.1 THEN '0.1-0.3'
-            ELSE '0.0-0.1'
-        END as score_range,
-        COUNT(*) as count
-    FROM `{BIGQUERY_TABLE_ID}`
-    GROUP BY classification, score_range
-    ORDER BY classification, score_range DESC
-"""
+async def confidence_distribution():
+    groups = (await current_rollups()).group(("classification", "score_range"))
+    # ORDER BY classification, score_range DESC
+    keys = sorted(groups, key=lambda key: key[1], reverse=True)
+    keys.sort(key=lambda key: key[0])
+    data = [{
+        "classification": 1 if classification == "MALICIOUS" else 0,
+        "confidence_range": score_range,
+        "count": groups[(classification, score_range)][COUNT]
+    } for classification, score_range in keys]
+    return data
+
 
 @app.get("/api/confidence-distribution")
-def get_confidence_distribution():
-    try:
-        rows = client.query(QUERY_GET_CONFIDENCE_DIST).result()
-        data = [{
-            "classification": 1 if row.classification == "MALICIOUS" else 0,
-            "confidence_range": row.score_range,
-            "count": row.count
-        } for row in rows]
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_confidence_distribution():
+    return await widget(confidence_distribution)
     
 
 
-QUERY_GET_TIMELINE = f"""
-    SELECT 
-        TIMESTAMP_TRUNC(time_added, MINUTE) as time_bucket,
-        classification,
-        COUNT(*) as count
-    FROM `{BIGQUERY_TABLE_ID}`
-    WHERE time_added >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 MINUTE)
-    GROUP BY time_bucket, classification
-    ORDER BY time_bucket ASC
-"""
+async def timeline():
+    counts = (await current_rollups()).timeline(utcnow() - datetime.timedelta(minutes=30))
+    data = [{
+        "time_bucket": time_bucket.isoformat(),
+        "classification": 1 if classification == "MALICIOUS" else 0,
+        "count": count
+    } for (time_bucket, classification), count in sorted(counts.items())]
+    return data
+
 
 @app.get("/api/timeline")
-def get_timeline():
-    try:
-        rows = client.query(QUERY_GET_TIMELINE).result()
-        data = [{
-            "time_bucket": row.time_bucket.isoformat() if row.time_bucket else None,
-            "classification": 1 if row.classification == "MALICIOUS" else 0,
-            "count": row.count
-        } for row in rows]
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_timeline():
+    return await widget(timeline)
+
+
+async def timeline_delta(revision):
+    current = await current_rollups()
+    window_start = utcnow() - datetime.timedelta(minutes=30)
+    counts = current.timeline_changes(window_start, revision)
+    return {
+        "buckets": [{
+            "time_bucket": time_bucket.isoformat(),
+            "classification": 1 if classification == "MALICIOUS" else 0,
+            "count": count
+        } for (time_bucket, classification), count in sorted(counts.items())],
+        "revision": current.revision,
+        "window_start": window_start.replace(second=0, microsecond=0).isoformat()
+    }
+
+
+@app.get("/api/timeline/delta")
+async def get_timeline_delta(revision: int = 0):
+    """Timeline minutes changed since revision (every minute for 0); the
+    client replaces those minutes and drops the ones before window_start."""
+    return await widget(timeline_delta, revision)
     
 
 
-QUERY_GET_DETECTION_RATE = f"""
-    SELECT 
-        DATE(time_added) as date,
-        ROUND(SUM(CASE WHEN classification = 'MALICIOUS' THEN 1 ELSE 0 END) * 100.0 / COUNT(*), 2) as detection_rate,
-        COUNT(*) as total_urls
-    FROM `{BIGQUERY_TABLE_ID}`
-    WHERE time_added >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 7 DAY)
-    GROUP BY date
-    ORDER BY date ASC
-"""
+async def detection_rate():
+    # Whole days: the first of the 7 is not cut at the current time of day
+    since = (utcnow() - datetime.timedelta(days=7)).date()
+    totals = {}
+    for (date, classification), count in (await current_rollups()).daily(since).items():
+        entry = totals.setdefault(date, [0, 0])
+        entry[0] += count
+        if classification == "MALICIOUS":
+            entry[1] += count
+    data = [{
+        "date": date.isoformat(),
+        "detection_rate": round(malicious * 100.0 / total, 2),
+        "total_urls": total
+    } for date, (total, malicious) in sorted(totals.items())]
+    return data
+
 
 @app.get("/api/detection-rate")
-def get_detection_rate():
-    try:
-        rows = client.query(QUERY_GET_DETECTION_RATE).result()
-        data = [{
-            "date": row.date.isoformat() if row.date else None,
-            "detection_rate": float(row.detection_rate),
-            "total_urls": row.total_urls
-        } for row in rows]
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_detection_rate():
+    return await widget(detection_rate)
 
 
 
 QUERY_GET_TOP_DOMAINS = f"""
     WITH domain_extracted AS (
         SELECT 
-            REGEXP_EXTRACT(url, r'(?:https?://)?(?:www\.)?([^/]+)') as domain,
+            {backend.domain("url")} as domain,
             classification,
             score
-        FROM `{BIGQUERY_TABLE_ID}`
+        FROM {backend.table}
         WHERE classification = 'MALICIOUS'
     )
     SELECT 
@@ -213,119 +334,237 @@ QUERY_GET_TOP_DOMAINS = f"""
         COUNT(*) as count,
         AVG(score) as avg_score
     FROM domain_extracted
-    WHERE domain IS NOT NULL
     GROUP BY domain
     ORDER BY count DESC
-    LIMIT 15
+    LIMIT 16
 """
 
+async def load_top_domains():
+    rows = await run_query(QUERY_GET_TOP_DOMAINS)
+    # URLs without a host group under NULL. Dropped here rather than with
+    # WHERE domain IS NOT NULL, which DuckDB evaluates by extracting every
+    # domain a second time
+    return [{
+        "domain": row.domain,
+        "count": row.count,
+        "avg_confidence": float(row.avg_score)
+    } for row in rows if row.domain is not None][:15]
+
+
+async def top_domains():
+    return await cached("top-domains", load_top_domains)
+
+
+def sketch_window(window):
+    """The merged sketches of a window; reading the snapshots is file IO, so off the loop."""
+    async def load():
+        return await asyncio.get_running_loop().run_in_executor(None, sketch_reader.window, window)
+
+    return cached(f"sketches-{window}", load, "sketches")
+
+
+async def windowed_top_domains(window):
+    return (await sketch_window(window))["top"]
+
+
+async def distinct_domains(window):
+    summary = await sketch_window(window)
+    return {key: value for key, value in summary.items() if key != "top"}
+
+
+def check_window(window):
+    if window not in WINDOWS:
+        raise HTTPException(status_code=400, detail=f"Unknown window {window!r}, expected one of {list(WINDOWS)}")
+
+
 @app.get("/api/top-domains")
-def get_top_domains():
-    try:
-        rows = client.query(QUERY_GET_TOP_DOMAINS).result()
-        data = [{
-            "domain": row.domain,
-            "count": row.count,
-            "avg_confidence": float(row.avg_score)
-        } for row in rows]
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_top_domains(window: str = None):
+    """All time from the table, or the last hour or day from the scorers'
+    sketches with window=hour|day, where counts may overestimate by "error"."""
+    if window is None:
+        return await widget(top_domains)
+    check_window(window)
+    return await widget(windowed_top_domains, window)
 
 
+@app.get("/api/distinct-domains")
+async def get_distinct_domains(window: str = "day"):
+    """Estimated distinct domains, all and malicious, and row counts over a window."""
+    check_window(window)
+    return await widget(distinct_domains, window)
+
+
+
+async def url_length():
+    groups = (await current_rollups()).group(("length_range", "classification"))
+    data = [{
+        "length_range": length_range,
+        "is_phishing": 1 if classification == "MALICIOUS" else 0,
+        "count": groups[(length_range, classification)][COUNT]
+    } for length_range, classification in sorted(groups)]
+    return data
 
-QUERY_GET_URL_LENGTH = f"""
-    SELECT 
-        CASE 
-            WHEN LENGTH(url) < 30 THEN '0-30'
-            WHEN LENGTH(url) < 50 THEN '30-50'
-            WHEN LENGTH(url) < 75 THEN '50-75'
-            WHEN LENGTH(url) < 100 THEN '75-100'
-            ELSE '100+'
-        END as length_range,
-        classification,
-        COUNT(*) as count
-    FROM `{BIGQUERY_TABLE_ID}`
-    GROUP BY length_range, classification
-    ORDER BY length_range
-"""
 
 @app.get("/api/url-length")
-def get_url_length():
-    try:
-        rows = client.query(QUERY_GET_URL_LENGTH).result()
-        data = [{
-            "length_range": row.length_range,
-            "is_phishing": 1 if row.classification == "MALICIOUS" else 0,
-            "count": row.count
-        } for row in rows]
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_url_length():
+    return await widget(url_length)
     
 
 
-QUERY_GET_RECENT_100 = f"""
-    SELECT time_added, url, classification, score
-    FROM `{BIGQUERY_TABLE_ID}`
-    ORDER BY time_added DESC
-    LIMIT 100
-"""
+async def recent_data():
+    return (await current_recent()).latest(RECENT_LIMIT)
+
 
 @app.get("/api/data")
-def get_recent_data():
-    try:
-        rows = client.query(QUERY_GET_RECENT_100).result()
-        data = [{
-            "timestamp": row.time_added.isoformat() if row.time_added else None,
-            "url": row.url,
-            "classification": row.classification,
-            "score": float(row.score) if row.score else 0.0
-        } for row in rows]
-        return list(reversed(data))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_recent_data():
+    return await widget(recent_data)
+
+
+def parse_cursor_time(value):
+    moment = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+
+
+async def recent_delta(since_time, since_url):
+    current = await current_recent()
+    if since_time is None:
+        rows, reset = current.latest(RECENT_LIMIT), True
+    else:
+        rows, reset = current.since((parse_cursor_time(since_time), since_url), RECENT_LIMIT)
+    return {"rows": rows, "reset": reset, "cursor": current.cursor()}
+
+
+@app.get("/api/data/delta")
+async def get_recent_delta(since_time: str = None, since_url: str = ""):
+    """Rows after the cursor (time_added, url) of the newest row the client
+    has, oldest first. With "reset" the client replaces its rows instead."""
+    if since_time is not None:
+        try:
+            parse_cursor_time(since_time)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid since_time {since_time!r}")
+    return await widget(recent_delta, since_time, since_url)
 
 
 
 QUERY_GET_TOP_MALICIOUS = f"""
     SELECT url, score, time_added
-    FROM `{BIGQUERY_TABLE_ID}`
+    FROM {backend.table}
     WHERE classification = 'MALICIOUS'
     ORDER BY score DESC, time_added DESC
     LIMIT 20
 """
 
+async def load_top_malicious():
+    rows = await run_query(QUERY_GET_TOP_MALICIOUS)
+    return [{
+        "url": row.url,
+        "confidence": float(row.score),
+        "timestamp": row.time_added.isoformat() if row.time_added else None
+    } for row in rows]
+
+
+async def top_malicious():
+    return await cached("top-malicious", load_top_malicious)
+
+
 @app.get("/api/top-malicious")
-def get_top_malicious():
+async def get_top_malicious():
+    return await widget(top_malicious)
+
+
+
+# Widgets the page needs first, fetched with one request
+OVERVIEW_WIDGETS = {
+    "stats": stats,
+    "realtime_metrics": realtime_metrics,
+    "timeline": timeline,
+    "data": recent_data,
+}
+
+
+@app.get("/api/overview")
+async def get_overview():
+    """The OVERVIEW_WIDGETS at once; a widget that fails or times out is null
+    and named in "errors" while the others are still returned."""
+    names = list(OVERVIEW_WIDGETS)
+    results = await asyncio.gather(
+        *(asyncio.wait_for(OVERVIEW_WIDGETS[name](), WIDGET_TIMEOUT) for name in names),
+        return_exceptions=True,
+    )
+    overview = {"errors": {}}
+    for name, result in zip(names, results):
+        if isinstance(result, asyncio.TimeoutError):
+            overview[name] = None
+            overview["errors"][name] = "timed out"
+        elif isinstance(result, Exception):
+            overview[name] = None
+            overview["errors"][name] = str(result)
+        else:
+            overview[name] = result
+    return overview
+
+
+
+@app.get("/api/cache-stats")
+def get_cache_stats():
+    return cache.stats()
+
+
+
+@app.get("/api/ws-stats")
+def get_ws_stats():
+    return hub.stats()
+
+
+
+@app.post("/api/ingest", status_code=202)
+async def ingest(request: Request):
+    """Accepts NDJSON rows (gzip with Content-Encoding: gzip) for background
+    writing. Answers with the batch ID, or 503 with Retry-After when the
+    writer is behind."""
+    gzip = request.headers.get("content-encoding", "").lower() == "gzip"
     try:
-        rows = client.query(QUERY_GET_TOP_MALICIOUS).result()
-        data = [{
-            "url": row.url,
-            "confidence": float(row.score),
-            "timestamp": row.time_added.isoformat() if row.time_added else None
-        } for row in rows]
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        rows, rejected, errors = await read_ndjson(request.stream(), gzip, INGEST_MAX_BYTES, INGEST_MAX_ROWS)
+        batch_id = writer.submit(rows) if rows else None
+    except IngestError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except WriterFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return {"batch_id": batch_id, "accepted": len(rows), "rejected": rejected, "errors": errors}
+
+
+
+@app.get("/api/ingest/{batch_id}")
+def get_ingest_status(batch_id: str):
+    status = writer.status(batch_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired batch")
+    return status
+
+
+
+@app.get("/api/ingest-stats")
+def get_ingest_stats():
+    return writer.stats()
 
 
 
 @app.post("/api/submit_url")
 async def submit_url(data: List[Dict[str, Any]]):
+    """Writes the rows, then answers; fields outside the schema are ignored
+    and any invalid row rejects the request. Use /api/ingest for bulk loads."""
     try:
-        errors = client.insert_rows_json(BIGQUERY_TABLE_ID, data)
-        if errors:
-            print(f"Error inserting into BigQuery: {errors}")
-            raise HTTPException(status_code=500, detail="Error writing to BigQuery")
-        
-        await manager.broadcast(data)
-        return {"status": "success", "data": data}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        rows = [validate_row_ignoring_unknown(row) for row in data]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    failed = await writer.write(rows)
+    if failed:
+        raise HTTPException(status_code=500, detail=f"Error writing {len(failed)} of {len(rows)} rows")
+    return {"status": "success", "data": data}
 
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port, ws_per_message_deflate=False)
\ No newline at end of file
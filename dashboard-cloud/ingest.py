@@ -0,0 +1,284 @@
+"""Bulk ingestion of classified rows.
+
+POST /api/ingest takes newline-delimited JSON, optionally gzip-compressed
+(Content-Encoding: gzip), and reads it as it streams in: each line is
+decoded and checked by a validator compiled once from SCHEMA, and the
+decompressed size is capped so a small gzip body cannot expand without
+bound. Valid rows are handed to IngestWriter and the request is answered
+at once with a batch ID; invalid lines are counted and the first few
+reported, they do not fail the batch.
+
+IngestWriter collects batches into flushes of up to flush_rows rows, inserts
+each flush in chunks of insert_rows with retries, and only then passes the
+written rows on (to the WebSocket hub). Its pending rows are bounded; a
+full writer makes the endpoint answer 503 with Retry-After.
+"""
+import asyncio
+import datetime
+import json
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+
+# (name, type, required); the classified_urls columns written by the scorer
+SCHEMA = (
+    ("url", "STRING", True),
+    ("score", "FLOAT", True),
+    ("classification", "STRING", True),
+    ("time_added", "TIMESTAMP", False),
+    ("trace_id", "STRING", False),
+)
+CLASSIFICATIONS = ("MALICIOUS", "BENIGN")
+MAX_URL_LENGTH = 2048
+# Invalid lines reported back per request
+MAX_REPORTED_ERRORS = 20
+READ_CHUNK = 1 << 16
+
+
+class IngestError(Exception):
+    """The request as a whole can't be accepted; carries the HTTP status."""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def check_string(value):
+    if not isinstance(value, str):
+        raise ValueError("expected a string")
+    return value
+
+
+def check_float(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("expected a number")
+    return float(value)
+
+
+def check_timestamp(value):
+    if not isinstance(value, str):
+        raise ValueError("expected an ISO 8601 timestamp")
+    moment = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.isoformat()
+
+
+CHECKS = {"STRING": check_string, "FLOAT": check_float, "TIMESTAMP": check_timestamp}
+
+
+def compile_schema(schema, ignore_unknown=False):
+    """Returns validate(row) -> the row to insert, raising ValueError.
+
+    The per-field checks are looked up once here, not per row. Fields not
+    in the schema are rejected, or left out of the row with ignore_unknown.
+    """
+    fields = tuple((name, CHECKS[kind], required) for name, kind, required in schema)
+    names = frozenset(name for name, _, _ in schema)
+
+    def validate(row):
+        if not isinstance(row, dict):
+            raise ValueError("expected a JSON object")
+        unknown = row.keys() - names
+        if unknown and not ignore_unknown:
+            raise ValueError(f"unknown field {sorted(unknown)[0]!r}")
+        clean = {}
+        for name, check, required in fields:
+            value = row.get(name)
+            if value is None:
+                if required:
+                    raise ValueError(f"missing {name!r}")
+                continue
+            try:
+                clean[name] = check(value)
+            except ValueError as e:
+                raise ValueError(f"{name!r}: {e}") from None
+        if clean["classification"] not in CLASSIFICATIONS:
+            raise ValueError(f"'classification' must be one of {CLASSIFICATIONS}")
+        if not 0.0 <= clean["score"] <= 1.0:
+            raise ValueError("'score' must be between 0 and 1")
+        if len(clean["url"]) > MAX_URL_LENGTH:
+            raise ValueError(f"'url' longer than {MAX_URL_LENGTH} characters")
+        if "time_added" not in clean:
+            clean["time_added"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return clean
+
+    return validate
+
+
+validate_row = compile_schema(SCHEMA)
+# /api/submit_url has always accepted extra fields
+validate_row_ignoring_unknown = compile_schema(SCHEMA, ignore_unknown=True)
+
+
+async def decoded_chunks(stream, gzip):
+    """Body chunks, gunzipped in bounded pieces when gzip is set."""
+    if not gzip:
+        async for chunk in stream:
+            yield chunk
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        async for chunk in stream:
+            data = decompressor.decompress(chunk, READ_CHUNK)
+            while True:
+                yield data
+                if not decompressor.unconsumed_tail:
+                    break
+                data = decompressor.decompress(decompressor.unconsumed_tail, READ_CHUNK)
+        yield decompressor.flush()
+    except zlib.error as e:
+        raise IngestError(400, f"Invalid gzip body: {e}")
+
+
+async def read_ndjson(stream, gzip=False, max_bytes=64 << 20, max_rows=100000):
+    """Validates an NDJSON body as it arrives; returns (rows, rejected, errors)."""
+    rows = []
+    rejected = 0
+    errors = []
+    total = 0
+    line_number = 0
+    pending = b""
+
+    def handle(line):
+        nonlocal rejected
+        if not line.strip():
+            return
+        try:
+            rows.append(validate_row(json.loads(line)))
+        except ValueError as e:
+            rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line_number, "error": str(e)})
+        if len(rows) > max_rows:
+            raise IngestError(413, f"More than {max_rows} rows in one request")
+
+    async for chunk in decoded_chunks(stream, gzip):
+        total += len(chunk)
+        if total > max_bytes:
+            raise IngestError(413, f"Body larger than {max_bytes} bytes")
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line_number += 1
+            handle(line)
+    if pending:
+        line_number += 1
+        handle(pending)
+    return rows, rejected, errors
+
+
+class WriterFull(Exception):
+    pass
+
+
+class IngestWriter:
+    """Writes accepted batches in the background through insert_rows(rows) -> row errors."""
+
+    def __init__(self, insert_rows, flush_rows=5000, flush_interval=1.0, insert_rows_per_call=500,
+                 max_pending_rows=200000, retries=5, on_written=None, log=print, statuses_kept=10000):
+        self.insert_rows = insert_rows
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.insert_rows_per_call = insert_rows_per_call
+        self.max_pending_rows = max_pending_rows
+        self.retries = retries
+        self.on_written = on_written
+        self.log = log
+        self.statuses_kept = statuses_kept
+        self.pending = deque()
+        self.pending_rows = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.statuses = OrderedDict()
+        self.counts = {"accepted_rows": 0, "written_rows": 0, "failed_rows": 0, "flushes": 0,
+                       "insert_retries": 0}
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def submit(self, rows):
+        """Queues rows as one batch and returns its ID; raises WriterFull."""
+        self.start()
+        if self.pending_rows + len(rows) > self.max_pending_rows:
+            raise WriterFull(f"{self.pending_rows} rows waiting to be written")
+        batch_id = uuid.uuid4().hex
+        self.pending.append((batch_id, rows))
+        self.pending_rows += len(rows)
+        self.counts["accepted_rows"] += len(rows)
+        self.statuses[batch_id] = {"status": "queued", "rows": len(rows), "written": 0, "failed": 0,
+                                   "received_at": time.time()}
+        while len(self.statuses) > self.statuses_kept:
+            self.statuses.popitem(last=False)
+        if self.pending_rows >= self.flush_rows:
+            self.wakeup.set()
+        return batch_id
+
+    def status(self, batch_id):
+        return self.statuses.get(batch_id)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            while self.pending:
+                await self.flush()
+
+    async def flush(self):
+        batches = []
+        rows = []
+        while self.pending and (not rows or len(rows) + len(self.pending[0][1]) <= self.flush_rows):
+            batch_id, batch_rows = self.pending.popleft()
+            self.pending_rows -= len(batch_rows)
+            batches.append((batch_id, len(batch_rows)))
+            rows.extend(batch_rows)
+        self.counts["flushes"] += 1
+        failed_rows = await self.write(rows)
+
+        offset = 0
+        for batch_id, size in batches:
+            failed = sum(1 for index in range(offset, offset + size) if index in failed_rows)
+            offset += size
+            status = self.statuses.get(batch_id)
+            if status is not None:
+                status.update(written=size - failed, failed=failed,
+                              status="written" if not failed else "failed" if failed == size else "partial")
+
+    async def write(self, rows):
+        """Inserts rows now, in chunks with retries, and passes the written
+        ones on; returns the indexes of the rows that failed."""
+        step = self.insert_rows_per_call
+        results = await asyncio.gather(*(self.insert_chunk(rows[i:i + step]) for i in range(0, len(rows), step)))
+        failed_rows = set()
+        for start, failed in zip(range(0, len(rows), step), results):
+            failed_rows.update(start + index for index in failed)
+        written = [row for index, row in enumerate(rows) if index not in failed_rows]
+        self.counts["written_rows"] += len(written)
+        self.counts["failed_rows"] += len(failed_rows)
+        if written and self.on_written is not None:
+            self.on_written(written)
+        return failed_rows
+
+    async def insert_chunk(self, rows):
+        """Inserts rows with retries; returns the indexes of the rows that failed."""
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            try:
+                errors = await self.insert_rows(rows)
+                return {error["index"] for error in errors}
+            except Exception as e:
+                if attempt == self.retries:
+                    self.log(f"Insert of {len(rows)} rows failed after {attempt + 1} attempts: {e!r}")
+                    return set(range(len(rows)))
+                self.counts["insert_retries"] += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    def stats(self):
+        return {**self.counts, "pending_rows": self.pending_rows, "pending_batches": len(self.pending)}
@@ -0,0 +1,106 @@
+"""The most recent classified_urls rows, kept in memory for delta polling.
+
+Rows are ordered by their cursor, (time_added, url): the url breaks ties
+between rows written in the same batch, which share a time_added. The
+first refresh reads the newest `size` rows; later ones only read rows from
+the newest time_added seen minus settle_seconds (today's partition), which
+also picks up rows that became visible late. A client holding a cursor is
+sent the rows after it, or told to reset when they no longer all fit in
+the buffer. A late row sorting before a client's cursor is not sent to
+that client.
+
+The first refresh tries the last FIRST_LOAD_WINDOW first and only sorts the
+whole table when that holds fewer than `size` rows.
+"""
+import bisect
+import datetime
+
+FIRST_LOAD_WINDOW = datetime.timedelta(hours=1)
+
+QUERY_RECENT = """
+    SELECT time_added, url, classification, score
+    FROM {table}
+    {where}
+    ORDER BY time_added DESC, url DESC
+    LIMIT {limit}
+"""
+
+
+def row_key(row):
+    return (row.time_added, row.url)
+
+
+def format_row(row):
+    return {
+        "timestamp": row.time_added.isoformat() if row.time_added else None,
+        "url": row.url,
+        "classification": row.classification,
+        "score": float(row.score) if row.score else 0.0
+    }
+
+
+def format_cursor(key):
+    return {"time": key[0].isoformat(), "url": key[1]} if key else None
+
+
+class RecentRows:
+    def __init__(self, backend, size=1000, settle_seconds=120, log=print):
+        self.backend = backend
+        self.size = size
+        self.settle = datetime.timedelta(seconds=settle_seconds)
+        self.log = log
+        # Ascending by row_key; rows without a time_added never sort into a cursor
+        self.keys = []
+        self.rows = []
+        # False once a row older than the buffer is known to exist
+        self.complete = True
+        self.loaded = False
+
+    async def refresh(self):
+        """Merges the newest rows into the buffer; returns self so it can be cached."""
+        if self.keys:
+            fetched = await self.query_since(self.keys[-1][0] - self.settle)
+        else:
+            fetched = await self.query_since(datetime.datetime.now(datetime.timezone.utc) - FIRST_LOAD_WINDOW)
+            if len(fetched) < self.size:
+                sql = QUERY_RECENT.format(table=self.backend.table, where="WHERE time_added IS NOT NULL",
+                                          limit=self.size)
+                fetched = await self.backend.run_query(sql)
+        if not self.loaded and len(fetched) == self.size:
+            self.complete = False
+        self.loaded = True
+        merged = dict(zip(self.keys, self.rows))
+        for row in fetched:
+            merged[row_key(row)] = row
+        keys = sorted(merged)
+        if len(keys) > self.size:
+            keys = keys[-self.size:]
+            self.complete = False
+        self.keys = keys
+        self.rows = [merged[key] for key in keys]
+        return self
+
+    async def query_since(self, since):
+        sql = QUERY_RECENT.format(table=await self.backend.table_since(since), where="WHERE time_added >= @since",
+                                  limit=self.size)
+        return await self.backend.run_query(sql, {"since": since})
+
+    def latest(self, limit):
+        """The newest rows, oldest first, as /api/data returns them."""
+        return [format_row(row) for row in self.rows[-limit:]]
+
+    def cursor(self):
+        return format_cursor(self.keys[-1] if self.keys else None)
+
+    def since(self, cursor, limit):
+        """Rows after cursor, oldest first, and whether the client must reset.
+
+        Resets (and returns the newest `limit` rows) when rows after the
+        cursor may have left the buffer or there are more than limit of them.
+        """
+        if not self.complete and self.keys and cursor < self.keys[0]:
+            return self.latest(limit), True
+        start = bisect.bisect_right(self.keys, cursor)
+        if len(self.keys) - start > limit:
+            return self.latest(limit), True
+        return [format_row(row) for row in self.rows[start:]], False
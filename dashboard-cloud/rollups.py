@@ -0,0 +1,229 @@
+"""Incrementally maintained rollups of classified_urls.
+
+The dashboard aggregates (totals, confidence and URL length distributions,
+timeline, realtime metrics, daily detection rate) are all sums over a few
+dimensions, so they are served from counts kept in memory instead of
+scanning the raw table per request:
+
+- the last ROLLUP_MINUTES minutes are kept per minute, classification,
+  score bucket and length bucket;
+- older rows are folded into per-day buckets of the same dimensions.
+
+The first refresh reads the whole table once (grouped by day before the
+minute window, by minute inside it). Later refreshes only re-aggregate the
+minutes since the previous refresh minus ROLLUP_SETTLE_SECONDS, which
+covers rows written late or with a skewed clock, and replace those minute
+buckets; with the table partitioned by day on time_added they scan today's
+partition only (the newest row groups with the DuckDB backend). Every
+ROLLUP_RESYNC_INTERVAL seconds the rollups are rebuilt from scratch to pick
+up rows older than that and deletions.
+"""
+import asyncio
+import datetime
+import time
+
+# Bucket labels, as the original per-endpoint queries returned them
+SCORE_RANGE = """
+        CASE
+            WHEN score >= 0.9 THEN '0.9-1.0'
+            WHEN score >= 0.7 THEN '0.7-0.9'
+            WHEN score >= 0.5 THEN '0.5-0.7'
+            WHEN score >= 0.3 THEN '0.3-0.5'
+            WHEN score >= 0.1 THEN '0.1-0.3'
+            ELSE '0.0-0.1'
+        END"""
+LENGTH_RANGE = """
+        CASE
+            WHEN LENGTH(url) < 30 THEN '0-30'
+            WHEN LENGTH(url) < 50 THEN '30-50'
+            WHEN LENGTH(url) < 75 THEN '50-75'
+            WHEN LENGTH(url) < 100 THEN '75-100'
+            ELSE '100+'
+        END"""
+
+QUERY_ROLLUP = """
+    SELECT
+        {bucket} as bucket,
+        classification,
+        {score_range} as score_range,
+        {length_range} as length_range,
+        COUNT(*) as count,
+        COUNT(score) as scored,
+        SUM(score) as score_sum,
+        SUM(CASE WHEN classification = 'MALICIOUS' AND score < 0.7 THEN 1
+                 WHEN classification = 'BENIGN' AND score > 0.3 THEN 1
+                 ELSE 0 END) as low_confidence,
+        MAX(time_added) as latest
+    FROM {table}
+    WHERE {where}
+    GROUP BY bucket, classification, score_range, length_range
+"""
+
+# Position of the summed values in a rollup entry
+COUNT, SCORED, SCORE_SUM, LOW_CONFIDENCE = range(4)
+DIMENSIONS = ("classification", "score_range", "length_range")
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def truncate_minute(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def add(target, key, values):
+    entry = target.get(key)
+    if entry is None:
+        target[key] = list(values)
+    else:
+        for i, value in enumerate(values):
+            entry[i] += value
+
+
+class Rollups:
+    """Rollups refreshed with queries on a backend (see backends.py)."""
+
+    def __init__(self, backend, minutes=120, settle_seconds=120, resync_interval=21600, query_timeout=300,
+                 clock=utcnow, log=print):
+        if minutes * 60 <= settle_seconds:
+            raise ValueError("The minute window must be longer than the settle time")
+        self.backend = backend
+        self.query_timeout = query_timeout
+        self.window = datetime.timedelta(minutes=minutes)
+        self.settle = datetime.timedelta(seconds=settle_seconds)
+        self.resync_interval = resync_interval
+        self.clock = clock
+        self.log = log
+        self.refresh_lock = asyncio.Lock()
+        # (minute, classification, score_range, length_range) -> [count, scored, score_sum, low_confidence]
+        self.minutes = {}
+        # (date or None, classification, score_range, length_range) -> same, for rows before the window
+        self.days = {}
+        # Everything before boundary is in days, everything from it in minutes
+        self.boundary = None
+        self.watermark = None
+        # minute -> newest time_added in it, for the minutes in the window
+        self.minute_latest = {}
+        self.synced_at = None
+        # Bumped by every refresh that changed a minute; minute -> revision
+        # that last changed it, for timeline deltas
+        self.revision = 0
+        self.minute_revisions = {}
+
+    async def query(self, bucket, where, since, table):
+        sql = QUERY_ROLLUP.format(bucket=bucket, where=where, table=table,
+                                  score_range=SCORE_RANGE, length_range=LENGTH_RANGE)
+        return await self.backend.run_query(sql, {"since": since}, timeout=self.query_timeout)
+
+    def fold(self, minutes, days, boundary):
+        """Moves the minute buckets before boundary into days."""
+        for key in [key for key in minutes if key[0] < boundary]:
+            add(days, (key[0].date(),) + key[1:], minutes.pop(key))
+
+    async def refresh(self):
+        """Brings the rollups up to date; returns self so it can be cached."""
+        async with self.refresh_lock:
+            start = time.monotonic()
+            now = self.clock()
+            boundary = truncate_minute(now) - self.window
+            resync = self.synced_at is None or start - self.synced_at >= self.resync_interval
+            if resync:
+                days = {}
+                minutes = {}
+                since = boundary
+                minute_latest = {}
+                rows = await self.query(self.backend.day("time_added"), "time_added < @since OR time_added IS NULL",
+                                        boundary, self.backend.table)
+                for row in rows:
+                    add(days, (row.bucket, row.classification, row.score_range, row.length_range),
+                        (row.count, row.scored, row.score_sum or 0.0, row.low_confidence))
+            else:
+                days = {key: list(values) for key, values in self.days.items()}
+                since = truncate_minute(max(self.watermark - self.settle, self.boundary))
+                minutes = {key: values for key, values in self.minutes.items() if key[0] < since}
+                minute_latest = {minute: latest for minute, latest in self.minute_latest.items() if minute < since}
+            rows = await self.query(self.backend.minute("time_added"), "time_added >= @since", since,
+                                    await self.backend.table_since(since))
+            for row in rows:
+                add(minutes, (row.bucket, row.classification, row.score_range, row.length_range),
+                    (row.count, row.scored, row.score_sum or 0.0, row.low_confidence))
+                latest = minute_latest.get(row.bucket)
+                if row.latest is not None and (latest is None or row.latest > latest):
+                    minute_latest[row.bucket] = row.latest
+            self.fold(minutes, days, boundary)
+            changed = {key[0] for key in minutes.keys() | self.minutes.keys()
+                       if key[0] >= since and minutes.get(key) != self.minutes.get(key)}
+            if changed:
+                self.revision += 1
+                for minute in changed:
+                    self.minute_revisions[minute] = self.revision
+            self.minute_revisions = {minute: revision for minute, revision in self.minute_revisions.items()
+                                     if minute >= boundary}
+            self.minutes, self.days = minutes, days
+            self.boundary = boundary
+            self.watermark = now
+            self.minute_latest = {minute: latest for minute, latest in minute_latest.items() if minute >= boundary}
+            if resync:
+                self.synced_at = start
+            self.log(f"Rollups {'rebuilt' if resync else 'refreshed'} from {since.isoformat()}: "
+                     f"{len(rows)} groups in {time.monotonic() - start:.2f}s")
+            return self
+
+    def group(self, fields, since=None):
+        """Sums the rollups by some of DIMENSIONS.
+
+        With since (a datetime), only the minutes from it on are summed; it
+        must lie within the minute window.
+        """
+        positions = [1 + DIMENSIONS.index(field) for field in fields]
+        groups = {}
+        sources = [self.minutes] if since is not None else [self.days, self.minutes]
+        start = truncate_minute(since) if since is not None else None
+        for source in sources:
+            for key, values in source.items():
+                if start is None or key[0] >= start:
+                    add(groups, tuple(key[i] for i in positions), values)
+        return groups
+
+    def latest(self, since):
+        """Newest time_added from since (within the minute window) on, or None."""
+        start = truncate_minute(since)
+        return max((latest for minute, latest in self.minute_latest.items() if minute >= start and latest >= since),
+                   default=None)
+
+    def timeline(self, since):
+        """{(minute, classification): count} for the minutes from since on."""
+        counts = {}
+        start = truncate_minute(since)
+        for key, values in self.minutes.items():
+            if key[0] >= start:
+                counts[(key[0], key[1])] = counts.get((key[0], key[1]), 0) + values[COUNT]
+        return counts
+
+    def timeline_changes(self, since, revision):
+        """Like timeline(), but only for the minutes changed after revision.
+
+        A changed minute is returned with every classification that has
+        rows in the window, 0 when it has none in that minute, so a client
+        can overwrite it as a whole.
+        """
+        start = truncate_minute(since)
+        changed = {minute for minute, changed_in in self.minute_revisions.items()
+                   if changed_in > revision and minute >= start}
+        classifications = {key[1] for key in self.minutes if key[0] >= start}
+        counts = {(minute, classification): 0 for minute in changed for classification in classifications}
+        for key, values in self.minutes.items():
+            if key[0] in changed:
+                counts[(key[0], key[1])] += values[COUNT]
+        return counts
+
+    def daily(self, since_date):
+        """{(date, classification): count} for the days from since_date on."""
+        counts = {}
+        items = [((key[0], key[1]), values) for key, values in self.days.items()]
+        items += [((key[0].date(), key[1]), values) for key, values in self.minutes.items()]
+        for key, values in items:
+            if key[0] is not None and key[0] >= since_date:
+                counts[key] = counts.get(key, 0) + values[COUNT]
+        return counts
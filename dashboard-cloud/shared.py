@@ -0,0 +1,15 @@
+"""Makes the modules shared with the scorer importable.
+
+segments.py and summaries.py live at the repository root, next to the
+scorer. The image copies them next to these modules (see the Dockerfile);
+run from a checkout, the repository root is added to sys.path instead. It is
+appended, so this directory's modules win where names overlap.
+"""
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+if not os.path.exists(os.path.join(HERE, "segments.py")) and ROOT not in sys.path:
+    sys.path.append(ROOT)
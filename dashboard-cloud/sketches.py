@@ -0,0 +1,121 @@
+"""Top malicious domains and distinct domain counts from the scorer's sketches.
+
+The scorer (sketches.py at the repository root) keeps SpaceSaving and
+HyperLogLog sketches (summaries.py, shared with the scorer) per time bucket
+and snapshots them to SKETCH_DIR, one JSON file per instance. SketchReader reloads the files that changed, merges
+the buckets of a window across instances and answers from the merged
+sketches, so an answer costs the same however many rows are behind it.
+
+A window is made of the buckets ending after its start, so it reaches back
+up to one bucket further: 5 minutes for the last hour, an hour for the last
+day. Counts in the top list overestimate by at most their "error".
+"""
+import datetime
+import json
+import os
+import threading
+import time
+
+import shared  # noqa: F401 (puts summaries.py on sys.path)
+from summaries import HyperLogLog, SpaceSaving
+
+# Window -> (tier of the scorer's buckets, seconds)
+WINDOWS = {
+    "hour": ("5m", 3600),
+    "day": ("1h", 86400),
+}
+
+
+def load_bucket(data):
+    return {
+        "rows": data["rows"],
+        "malicious_rows": data["malicious_rows"],
+        "top_malicious": SpaceSaving.from_dict(data["top_malicious"]),
+        "domains": HyperLogLog.from_dict(data["domains"]),
+        "malicious_domains": HyperLogLog.from_dict(data["malicious_domains"]),
+    }
+
+
+def copy_bucket(bucket):
+    """A bucket to merge others into, sharing nothing with the cached one."""
+    return {
+        "rows": bucket["rows"],
+        "malicious_rows": bucket["malicious_rows"],
+        "top_malicious": bucket["top_malicious"].copy(),
+        "domains": bucket["domains"].copy(),
+        "malicious_domains": bucket["malicious_domains"].copy(),
+    }
+
+
+class SketchReader:
+    """Reads the snapshots under directory; safe to call from several threads."""
+
+    def __init__(self, directory, clock=time.time, log=print):
+        self.directory = directory
+        self.clock = clock
+        self.log = log
+        self.lock = threading.Lock()
+        # path -> (mtime, written_at, {tier: (size, {start: bucket})})
+        self.snapshots = {}
+
+    def reload(self):
+        """Loads new and changed snapshot files and forgets removed ones."""
+        names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        paths = {os.path.join(self.directory, name) for name in names if name.endswith(".json")}
+        for path in set(self.snapshots) - paths:
+            del self.snapshots[path]
+        for path in paths:
+            try:
+                mtime = os.path.getmtime(path)
+                if path in self.snapshots and self.snapshots[path][0] == mtime:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                tiers = {name: (tier["size"], {int(start): load_bucket(bucket)
+                                               for start, bucket in tier["buckets"].items()})
+                         for name, tier in data["tiers"].items()}
+                self.snapshots[path] = (mtime, data["written_at"], tiers)
+            except (OSError, ValueError, KeyError) as e:
+                # Removed by its scorer meanwhile, or not a snapshot
+                self.log(f"Skipping sketch snapshot {path}: {e!r}")
+
+    def window(self, name, top=15):
+        """Top malicious domains and distinct counts for a window of WINDOWS."""
+        tier, seconds = WINDOWS[name]
+        now = self.clock()
+        with self.lock:
+            self.reload()
+            merged = None
+            written = []
+            for _, written_at, tiers in self.snapshots.values():
+                size, buckets = tiers.get(tier, (0, {}))
+                for start, bucket in buckets.items():
+                    if start + size <= now - seconds:
+                        continue
+                    if merged is None:
+                        merged = copy_bucket(bucket)
+                    else:
+                        merged["rows"] += bucket["rows"]
+                        merged["malicious_rows"] += bucket["malicious_rows"]
+                        for key in ("top_malicious", "domains", "malicious_domains"):
+                            merged[key].merge(bucket[key])
+                written.append(written_at)
+        if merged is None:
+            return {"window": name, "top": [], "rows": 0, "malicious_rows": 0, "distinct_domains": 0,
+                    "distinct_malicious_domains": 0, "instances": len(written), "as_of": None}
+        return {
+            "window": name,
+            "top": [{
+                "domain": domain,
+                "count": count,
+                "error": error,
+                "avg_confidence": round(score, 4) if score is not None else None
+            } for domain, count, error, score in merged["top_malicious"].top(top)],
+            "rows": merged["rows"],
+            "malicious_rows": merged["malicious_rows"],
+            "distinct_domains": round(merged["domains"].estimate()),
+            "distinct_malicious_domains": round(merged["malicious_domains"].estimate()),
+            "instances": len(written),
+            # The oldest snapshot merged; rows scored since then are not counted yet
+            "as_of": datetime.datetime.fromtimestamp(min(written), datetime.timezone.utc).isoformat(),
+        }
@@ -0,0 +1,162 @@
+"""Hub fan-out, slow client policies and unregistering closed clients."""
+import asyncio
+import json
+
+import pytest
+
+from broadcast import SLOW_CLIENT_CLOSE_CODE, Hub
+
+
+class FakeWebSocket:
+    """Records frames; send_text waits on `gate` while it is cleared."""
+
+    def __init__(self, fail=False):
+        self.frames = []
+        self.accepted = False
+        self.close_code = None
+        self.fail = fail
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def accept(self):
+        self.accepted = True
+
+    async def send_text(self, text):
+        if self.fail:
+            raise RuntimeError("connection closed")
+        await self.gate.wait()
+        self.frames.append(text)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def settle():
+    """Lets the writer tasks run until they wait again."""
+    await asyncio.sleep(0.01)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Hub(policy="drop-newest")
+
+
+def test_fan_out_sends_one_frame_to_every_client():
+    async def scenario():
+        hub = Hub(interval=0.01, log=lambda message: None)
+        sockets = [FakeWebSocket() for _ in range(3)]
+        for websocket in sockets:
+            await hub.connect(websocket)
+        hub.publish([{"url": "http://a/"}, {"url": "http://b/"}])
+        hub.publish([{"url": "http://c/"}])
+        await asyncio.sleep(0.05)
+        stats = hub.stats()
+        hub.flusher.cancel()
+        return sockets, stats
+
+    sockets, stats = asyncio.run(scenario())
+    for websocket in sockets:
+        assert websocket.accepted
+        # Rows published within one interval go out as one frame
+        assert [json.loads(frame) for frame in websocket.frames] == [
+            [{"url": "http://a/"}, {"url": "http://b/"}, {"url": "http://c/"}]]
+    assert stats["frames"] == 1 and stats["published_rows"] == 3 and stats["clients"] == 3
+
+
+def test_max_batch_splits_frames():
+    async def scenario():
+        hub = Hub(interval=60, max_batch=2, log=lambda message: None)
+        websocket = FakeWebSocket()
+        await hub.connect(websocket)
+        hub.publish([{"n": i} for i in range(5)])
+        await asyncio.sleep(0.05)
+        hub.flusher.cancel()
+        return websocket
+
+    websocket = asyncio.run(scenario())
+    assert [len(json.loads(frame)) for frame in websocket.frames] == [2, 2, 1]
+
+
+def test_drop_oldest_only_delays_the_slow_client():
+    async def scenario():
+        hub = Hub(queue_size=2, policy="drop-oldest", log=lambda message: None)
+        slow, fast = FakeWebSocket(), FakeWebSocket()
+        slow.gate.clear()
+        slow_client = await hub.connect(slow)
+        await hub.connect(fast)
+        await settle()
+        for n in range(5):
+            hub.send_all(str(n))
+            await settle()
+        # Frame 0 is stuck in send; 1 and 2 were dropped from its queue
+        assert list(slow_client.queue) == ["3", "4"] and slow_client.dropped == 2
+        slow.gate.set()
+        await settle()
+        stats = hub.stats()
+        hub.disconnect(slow_client)
+        return slow, fast, stats
+
+    slow, fast, stats = asyncio.run(scenario())
+    assert fast.frames == ["0", "1", "2", "3", "4"]
+    assert slow.frames == ["0", "3", "4"] and slow.close_code is None
+    assert stats["dropped_frames"] == 2 and stats["clients"] == 2
+
+
+def test_disconnect_policy_closes_the_slow_client():
+    async def scenario():
+        hub = Hub(queue_size=2, policy="disconnect", log=lambda message: None)
+        slow, fast = FakeWebSocket(), FakeWebSocket()
+        slow.gate.clear()
+        slow_client = await hub.connect(slow)
+        fast_client = await hub.connect(fast)
+        await settle()
+        for n in range(4):
+            hub.send_all(str(n))
+            await settle()
+        return hub, slow, fast, slow_client, fast_client
+
+    hub, slow, fast, slow_client, fast_client = asyncio.run(scenario())
+    assert slow.close_code == SLOW_CLIENT_CLOSE_CODE
+    assert hub.clients == {fast_client} and slow_client.writer.cancelled()
+    assert fast.frames == ["0", "1", "2", "3"]
+    assert hub.stats()["slow_disconnects"] == 1
+
+
+def test_send_timeout_closes_the_client():
+    async def scenario():
+        hub = Hub(send_timeout=0.02, log=lambda message: None)
+        slow = FakeWebSocket()
+        slow.gate.clear()
+        await hub.connect(slow)
+        hub.send_all("0")
+        await asyncio.sleep(0.1)
+        return hub, slow
+
+    hub, slow = asyncio.run(scenario())
+    assert slow.close_code == SLOW_CLIENT_CLOSE_CODE
+    assert hub.clients == set() and hub.stats()["slow_disconnects"] == 1
+
+
+def test_closed_clients_are_unregistered():
+    async def scenario():
+        hub = Hub(log=lambda message: None)
+        closed, broken, open_ = FakeWebSocket(), FakeWebSocket(fail=True), FakeWebSocket()
+        closed_client = await hub.connect(closed)
+        await hub.connect(broken)
+        open_client = await hub.connect(open_)
+
+        # What the endpoint does once its receive loop sees the close
+        hub.disconnect(closed_client)
+        hub.disconnect(closed_client)
+        await settle()
+        assert closed_client.writer.cancelled()
+
+        # A send failing underneath the writer unregisters it too
+        hub.send_all("0")
+        await settle()
+        return hub, closed, open_, open_client
+
+    hub, closed, open_, open_client = asyncio.run(scenario())
+    assert hub.clients == {open_client}
+    assert closed.frames == [] and open_.frames == ["0"]
+    assert hub.stats()["send_errors"] == 1 and hub.stats()["clients"] == 1
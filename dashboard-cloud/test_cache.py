@@ -0,0 +1,112 @@
+"""QueryCache: TTL hits, single-flight loads and stale-while-revalidate."""
+import asyncio
+
+import pytest
+
+import cache
+
+
+def age(queries, key, seconds):
+    """Makes the cached value of key seconds older."""
+    value, loaded_at = queries.entries[key]
+    queries.entries[key] = (value, loaded_at - seconds)
+
+
+class Loader:
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("query failed")
+        return self.calls
+
+
+def test_concurrent_misses_share_one_load():
+    async def scenario():
+        queries = cache.QueryCache(log=lambda message: None)
+        loader = Loader()
+        waiting = [asyncio.ensure_future(queries.get("stats", loader, ttl=10)) for _ in range(5)]
+        await asyncio.sleep(0)
+        loader.release.set()
+        assert await asyncio.gather(*waiting) == [1] * 5
+        assert loader.calls == 1
+        assert await queries.get("stats", loader, ttl=10) == 1
+        assert queries.stats() == {"hit": 1, "stale": 0, "miss": 1, "coalesced": 4, "error": 0,
+                                   "entries": 1, "in_flight": 0}
+
+    asyncio.run(scenario())
+
+
+def test_stale_value_served_while_one_refresh_runs():
+    async def scenario():
+        queries = cache.QueryCache(log=lambda message: None)
+        loader = Loader()
+        loader.release.set()
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 1
+
+        loader.release.clear()
+        age(queries, "stats", 15)
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 1
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 1
+        await asyncio.sleep(0.01)
+        assert loader.calls == 2 and queries.stats()["in_flight"] == 1
+        loader.release.set()
+        await asyncio.sleep(0.01)
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 2
+
+        # Past ttl + stale, callers wait for a fresh load
+        age(queries, "stats", 100)
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 3
+
+    asyncio.run(scenario())
+
+
+def test_failed_refresh_keeps_the_stale_value():
+    async def scenario():
+        queries = cache.QueryCache(log=lambda message: None)
+        loader = Loader()
+        loader.release.set()
+        await queries.get("stats", loader, ttl=10, stale=30)
+
+        loader.fail = True
+        age(queries, "stats", 15)
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 1
+        await asyncio.sleep(0.01)
+        assert await queries.get("stats", loader, ttl=10, stale=30) == 1
+        assert queries.stats()["error"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_load_raises_to_every_waiter_and_is_not_cached():
+    async def scenario():
+        queries = cache.QueryCache(log=lambda message: None)
+        loader = Loader(fail=True)
+        waiting = [asyncio.ensure_future(queries.get("stats", loader, ttl=10)) for _ in range(3)]
+        await asyncio.sleep(0)
+        loader.release.set()
+        results = await asyncio.gather(*waiting, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+        loader.fail = False
+        assert await queries.get("stats", loader, ttl=10) == 2
+
+    asyncio.run(scenario())
+
+
+def test_caller_timeout_does_not_cancel_the_shared_load():
+    async def scenario():
+        queries = cache.QueryCache(log=lambda message: None)
+        loader = Loader()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queries.get("stats", loader, ttl=10), 0.01)
+        loader.release.set()
+        assert await queries.get("stats", loader, ttl=10) == 1
+        assert loader.calls == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,164 @@
+"""API endpoints on the DuckDB backend: ETags, delta polling and ingestion."""
+import datetime
+import gzip
+import importlib
+import json
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("duckdb")
+pytest.importorskip("httpx")
+
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="module")
+def dashboard(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        # The scorer's modules share some names with the dashboard's
+        patch.syspath_prepend(os.path.dirname(os.path.abspath(__file__)))
+        patch.delitem(sys.modules, "sketches", raising=False)
+        patch.setenv("DASHBOARD_BACKEND", "duckdb")
+        patch.setenv("PARQUET_ROOT", str(tmp_path_factory.mktemp("parquet")))
+        patch.setenv("SKETCH_DIR", str(tmp_path_factory.mktemp("sketches")))
+        module = importlib.import_module("dashboard")
+        module.backend.log = module.rollups.log = module.cache.log = lambda message: None
+
+        @module.app.get("/api/test-stream")
+        async def stream():
+            return StreamingResponse(iter([b'{"a": 1}\n', b'{"a": 2}\n']), media_type="application/x-ndjson")
+
+        yield module
+        sys.modules.pop("dashboard", None)
+        sys.modules.pop("sketches", None)
+
+
+@pytest.fixture
+def client(dashboard):
+    dashboard.cache.invalidate()
+    with TestClient(dashboard.app) as client:
+        yield client
+
+
+def write(dashboard, *rows):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    dashboard.backend.write_segments([
+        {"url": url, "score": 0.9 if classification == "MALICIOUS" else 0.1, "classification": classification,
+         "time_added": (now - datetime.timedelta(seconds=seconds_ago)).isoformat()}
+        for url, classification, seconds_ago in rows
+    ])
+    dashboard.cache.invalidate()
+
+
+def test_etag_and_if_none_match(dashboard, client):
+    write(dashboard, ("http://a.example/", "MALICIOUS", 30))
+    response = client.get("/api/stats")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+
+    for header in (etag, f"W/{etag}", f'"other", {etag}', f' W/"other" ,W/{etag} ', "*"):
+        not_modified = client.get("/api/stats", headers={"If-None-Match": header})
+        assert not_modified.status_code == 304, header
+        assert not_modified.content == b""
+    # Only whole tags match
+    for header in (etag[:-3] + '"', '"x' + etag[1:], '"other"', ""):
+        assert client.get("/api/stats", headers={"If-None-Match": header}).status_code == 200, header
+
+    write(dashboard, ("http://b.example/", "BENIGN", 20))
+    changed = client.get("/api/stats", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["etag"] != etag
+
+
+def test_non_json_responses_pass_through(client):
+    response = client.get("/api/test-stream")
+    assert response.status_code == 200
+    assert "etag" not in response.headers
+    assert response.text == '{"a": 1}\n{"a": 2}\n'
+    assert client.get("/api/test-stream", headers={"If-None-Match": "*"}).status_code == 200
+
+
+def test_data_delta_follows_the_cursor(dashboard, client):
+    write(dashboard, ("http://c.example/", "BENIGN", 10))
+    first = client.get("/api/data/delta").json()
+    assert first["reset"] and first["rows"][-1]["url"] == "http://c.example/"
+    cursor = first["cursor"]
+
+    unchanged = client.get("/api/data/delta", params={"since_time": cursor["time"], "since_url": cursor["url"]})
+    assert unchanged.json() == {"rows": [], "reset": False, "cursor": cursor}
+
+    write(dashboard, ("http://d.example/", "MALICIOUS", 5))
+    delta = client.get("/api/data/delta", params={"since_time": cursor["time"], "since_url": cursor["url"]}).json()
+    assert not delta["reset"]
+    assert [row["url"] for row in delta["rows"]] == ["http://d.example/"]
+    assert delta["cursor"]["url"] == "http://d.example/"
+
+    assert client.get("/api/data/delta", params={"since_time": "yesterday"}).status_code == 400
+
+
+def test_timeline_delta_by_revision(dashboard, client):
+    write(dashboard, ("http://e.example/", "BENIGN", 1))
+    full = client.get("/api/timeline/delta").json()
+    assert full["buckets"] and full["revision"] >= 1
+
+    same = client.get("/api/timeline/delta", params={"revision": full["revision"]}).json()
+    assert same["buckets"] == [] and same["revision"] == full["revision"]
+
+    write(dashboard, ("http://f.example/", "MALICIOUS", 1))
+    changed = client.get("/api/timeline/delta", params={"revision": full["revision"]}).json()
+    assert changed["revision"] == full["revision"] + 1
+    minute = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+    assert {bucket["classification"] for bucket in changed["buckets"]} == {0, 1}
+    assert all(datetime.datetime.fromisoformat(bucket["time_bucket"]) >= minute - datetime.timedelta(minutes=1)
+               for bucket in changed["buckets"])
+
+
+def test_ingest_endpoint(dashboard, client):
+    rows = [{"url": f"http://ingest{i}.example/", "score": 0.8, "classification": "MALICIOUS"} for i in range(3)]
+    body = "".join(json.dumps(row) + "\n" for row in rows) + '{"url": "http://bad/"}\n'
+    response = client.post("/api/ingest", content=gzip.compress(body.encode()),
+                           headers={"Content-Encoding": "gzip", "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 202
+    result = response.json()
+    assert result["accepted"] == 3 and result["rejected"] == 1
+    assert result["errors"] == [{"line": 4, "error": "missing 'score'"}]
+
+    for _ in range(100):
+        status = client.get(f"/api/ingest/{result['batch_id']}").json()
+        if status["status"] != "queued":
+            break
+        time.sleep(0.05)
+    assert status["status"] == "written" and status["written"] == 3
+    dashboard.cache.invalidate()
+    urls = [row["url"] for row in client.get("/api/data").json()]
+    assert {row["url"] for row in rows} <= set(urls)
+
+    assert client.post("/api/ingest", content=b"garbage", headers={"Content-Encoding": "gzip"}).status_code == 400
+    assert client.get("/api/ingest/unknown").status_code == 404
+
+
+def test_submit_url_writes_before_answering(dashboard, client):
+    rows = [{"url": "http://submit.example/", "score": 0.7, "classification": "MALICIOUS", "source": "old client"}]
+    response = client.post("/api/submit_url", json=rows)
+    assert response.status_code == 200
+    assert response.json() == {"status": "success", "data": rows}
+    # Already written when the answer arrives, without the unknown field
+    dashboard.cache.invalidate()
+    written = [row for row in client.get("/api/data").json() if row["url"] == "http://submit.example/"]
+    assert len(written) == 1 and "source" not in written[0]
+
+    assert client.post("/api/submit_url", json=[{"url": "http://bad/"}]).status_code == 400
+
+
+def test_submit_url_fails_when_the_write_fails(dashboard, client, monkeypatch):
+    async def failing_insert(rows):
+        return [{"index": 0, "errors": ["rejected"]}]
+
+    monkeypatch.setattr(dashboard.writer, "insert_rows", failing_insert)
+    rows = [{"url": "http://fail.example/", "score": 0.2, "classification": "BENIGN"}]
+    response = client.post("/api/submit_url", json=rows)
+    assert response.status_code == 500 and "1 of 1" in response.json()["detail"]
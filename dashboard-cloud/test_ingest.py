@@ -0,0 +1,177 @@
+"""NDJSON ingestion: row validation, streamed parsing and the background writer."""
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from ingest import (MAX_REPORTED_ERRORS, IngestError, IngestWriter, WriterFull, read_ndjson, validate_row,
+                    validate_row_ignoring_unknown)
+
+ROW = {"url": "http://a.example/", "score": 0.9, "classification": "MALICIOUS",
+       "time_added": "2026-03-04T12:00:00Z"}
+
+
+async def chunks(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def read(data, size=7, **kwargs):
+    return asyncio.run(read_ndjson(chunks(data, size), **kwargs))
+
+
+def ndjson(rows):
+    return "".join(json.dumps(row) + "\n" for row in rows).encode()
+
+
+def test_validate_row_normalizes():
+    assert validate_row(ROW) == {**ROW, "time_added": "2026-03-04T12:00:00+00:00"}
+    naive = validate_row({**ROW, "time_added": "2026-03-04T12:00:00", "score": 1, "trace_id": "t"})
+    assert naive["time_added"] == "2026-03-04T12:00:00+00:00" and naive["score"] == 1.0
+    assert "time_added" in validate_row({key: ROW[key] for key in ("url", "score", "classification")})
+    assert "trace_id" not in validate_row({**ROW, "trace_id": None})
+
+
+def test_validate_row_ignoring_unknown_drops_extra_fields():
+    assert validate_row_ignoring_unknown({**ROW, "extra": 1}) == validate_row(ROW)
+    with pytest.raises(ValueError, match="missing 'score'"):
+        validate_row_ignoring_unknown({"url": "http://a/", "classification": "BENIGN", "extra": 1})
+
+
+@pytest.mark.parametrize("row, message", [
+    ([ROW], "expected a JSON object"),
+    ({**ROW, "extra": 1}, "unknown field 'extra'"),
+    ({**ROW, "url": None}, "missing 'url'"),
+    ({**ROW, "score": "0.9"}, "'score': expected a number"),
+    ({**ROW, "score": True}, "'score': expected a number"),
+    ({**ROW, "score": 1.5}, "'score' must be between 0 and 1"),
+    ({**ROW, "classification": "malicious"}, "'classification' must be one of"),
+    ({**ROW, "url": "http://a/" + "x" * 2048}, "'url' longer than 2048 characters"),
+    ({**ROW, "time_added": "yesterday"}, "'time_added'"),
+    ({**ROW, "time_added": 1767323045}, "'time_added': expected an ISO 8601 timestamp"),
+])
+def test_validate_row_rejects(row, message):
+    with pytest.raises(ValueError, match=message.replace("(", r"\(")):
+        validate_row(row)
+
+
+def test_read_ndjson_reports_bad_lines_without_failing_the_batch():
+    body = ndjson([ROW]) + b"\n{not json\n" + ndjson([{**ROW, "score": 2}, {**ROW, "url": "http://b/"}])
+    rows, rejected, errors = read(body.rstrip(b"\n"))
+    assert [row["url"] for row in rows] == ["http://a.example/", "http://b/"]
+    assert rejected == 2
+    assert [error["line"] for error in errors] == [3, 4]
+    assert "between 0 and 1" in errors[1]["error"]
+
+
+def test_read_ndjson_lines_split_across_chunks():
+    body = ndjson([{**ROW, "url": f"http://{i}.example/ü"} for i in range(50)])
+    for size in (1, 3, 64, len(body)):
+        rows, rejected, _ = read(body, size)
+        assert len(rows) == 50 and rejected == 0
+        assert rows[-1]["url"] == "http://49.example/ü"
+
+
+def test_read_ndjson_caps_reported_errors():
+    rows, rejected, errors = read(b"x\n" * 100)
+    assert rows == [] and rejected == 100 and len(errors) == MAX_REPORTED_ERRORS
+
+
+def test_read_ndjson_limits():
+    body = ndjson([ROW] * 11)
+    with pytest.raises(IngestError) as error:
+        read(body, max_rows=10)
+    assert error.value.status_code == 413
+    with pytest.raises(IngestError) as error:
+        read(body, max_bytes=len(body) - 1)
+    assert error.value.status_code == 413
+    assert len(read(body, max_rows=11, max_bytes=len(body))[0]) == 11
+
+
+def test_read_ndjson_gzip():
+    body = ndjson([ROW] * 20)
+    rows, rejected, _ = read(gzip.compress(body), size=10, gzip=True)
+    assert len(rows) == 20 and rejected == 0
+
+    # The decompressed size is what counts against the limit
+    bomb = gzip.compress(b" " * (4 << 20))
+    with pytest.raises(IngestError) as error:
+        read(bomb, size=1024, gzip=True, max_bytes=1 << 20)
+    assert error.value.status_code == 413
+
+    with pytest.raises(IngestError) as error:
+        read(b"not gzip at all", gzip=True)
+    assert error.value.status_code == 400
+
+
+class FakeInserts:
+    """insert_rows stand-in: rejects some URLs, or raises for the first `failures` calls."""
+
+    def __init__(self, bad_urls=(), failures=0):
+        self.bad_urls = set(bad_urls)
+        self.failures = failures
+        self.calls = []
+
+    async def __call__(self, rows):
+        self.calls.append(len(rows))
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("backend unavailable")
+        return [{"index": index, "errors": ["bad row"]} for index, row in enumerate(rows)
+                if row["url"] in self.bad_urls]
+
+
+def batch(prefix, count):
+    return [{**ROW, "url": f"http://{prefix}{i}/"} for i in range(count)]
+
+
+def test_writer_coalesces_batches_and_tracks_statuses():
+    async def scenario():
+        inserts = FakeInserts(bad_urls={"http://b1/", "http://c0/", "http://c1/"})
+        written = []
+        writer = IngestWriter(inserts, flush_rows=100, flush_interval=0.01, insert_rows_per_call=3,
+                              on_written=written.extend, log=lambda message: None)
+        ids = [writer.submit(batch("a", 4)), writer.submit(batch("b", 2)), writer.submit(batch("c", 2))]
+        assert writer.status(ids[0])["status"] == "queued"
+        for _ in range(100):
+            if not writer.pending and writer.counts["flushes"]:
+                break
+            await asyncio.sleep(0.01)
+        writer.task.cancel()
+
+        assert inserts.calls == [3, 3, 2]
+        assert [writer.status(batch_id)["status"] for batch_id in ids] == ["written", "partial", "failed"]
+        assert writer.status(ids[1])["written"] == 1 and writer.status(ids[1])["failed"] == 1
+        assert [row["url"] for row in written] == [f"http://a{i}/" for i in range(4)] + ["http://b0/"]
+        assert writer.stats() == {"accepted_rows": 8, "written_rows": 5, "failed_rows": 3, "flushes": 1,
+                                  "insert_retries": 0, "pending_rows": 0, "pending_batches": 0}
+
+    asyncio.run(scenario())
+
+
+def test_writer_retries_failed_inserts():
+    async def scenario():
+        inserts = FakeInserts(failures=1)
+        writer = IngestWriter(inserts, retries=2, log=lambda message: None)
+        assert await writer.insert_chunk(batch("a", 2)) == set()
+        assert writer.counts["insert_retries"] == 1
+
+        inserts.failures = 5
+        assert await writer.insert_chunk(batch("a", 2)) == {0, 1}
+
+    asyncio.run(scenario())
+
+
+def test_writer_full():
+    async def scenario():
+        writer = IngestWriter(FakeInserts(), flush_rows=1000, flush_interval=60, max_pending_rows=5,
+                              log=lambda message: None)
+        writer.submit(batch("a", 4))
+        with pytest.raises(WriterFull):
+            writer.submit(batch("b", 2))
+        writer.submit(batch("c", 1))
+        assert writer.stats()["pending_rows"] == 5
+        writer.task.cancel()
+
+    asyncio.run(scenario())
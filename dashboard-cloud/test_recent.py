@@ -0,0 +1,106 @@
+"""RecentRows cursors and deltas over the DuckDB backend."""
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip("duckdb")
+
+from backends import DuckDBBackend
+from recent import RecentRows
+
+NOW = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+
+def row(seconds_ago, url, classification="BENIGN", score=0.1):
+    moment = NOW - datetime.timedelta(seconds=seconds_ago)
+    return {"url": url, "score": score, "classification": classification, "time_added": moment.isoformat()}
+
+
+def cursor_of(rows):
+    """The (time_added, url) cursor of a formatted row."""
+    last = rows[-1]
+    return datetime.datetime.fromisoformat(last["timestamp"]), last["url"]
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return DuckDBBackend(str(tmp_path), compact_after=10 ** 9, log=lambda message: None)
+
+
+def test_rows_after_cursor_in_order(backend):
+    async def scenario():
+        recent = RecentRows(backend, size=10, settle_seconds=120)
+        # Two rows of one batch share a time_added; the url orders them
+        backend.write_segments([row(30, "http://a/"), row(20, "http://c/"), row(20, "http://b/")])
+        await recent.refresh()
+        rows = recent.latest(100)
+        assert [r["url"] for r in rows] == ["http://a/", "http://b/", "http://c/"]
+        assert recent.cursor() == {"time": rows[-1]["timestamp"], "url": "http://c/"}
+
+        first = (datetime.datetime.fromisoformat(rows[0]["timestamp"]), "http://a/")
+        assert recent.since(first, 100) == (rows[1:], False)
+        assert recent.since(cursor_of(rows), 100) == ([], False)
+
+        backend.write_segments([row(5, "http://d/", "MALICIOUS", 0.9)])
+        await recent.refresh()
+        delta, reset = recent.since(cursor_of(rows), 100)
+        assert not reset
+        assert delta == [{"timestamp": (NOW - datetime.timedelta(seconds=5)).isoformat(), "url": "http://d/",
+                          "classification": "MALICIOUS", "score": 0.9}]
+
+    asyncio.run(scenario())
+
+
+def test_late_rows_within_settle_time_are_picked_up(backend):
+    async def scenario():
+        recent = RecentRows(backend, size=10, settle_seconds=120)
+        backend.write_segments([row(10, "http://a/")])
+        await recent.refresh()
+        cursor = cursor_of(recent.latest(100))
+
+        # Became visible after the refresh, but sorts after the cursor
+        backend.write_segments([row(60, "http://old/"), row(10, "http://b/")])
+        await recent.refresh()
+        assert [r["url"] for r in recent.latest(100)] == ["http://old/", "http://a/", "http://b/"]
+        # The late row before the cursor is not sent to that client
+        assert [r["url"] for r in recent.since(cursor, 100)[0]] == ["http://b/"]
+
+    asyncio.run(scenario())
+
+
+def test_reset_when_delta_exceeds_limit_or_buffer(backend):
+    async def scenario():
+        recent = RecentRows(backend, size=5, settle_seconds=120)
+        backend.write_segments([row(100 - i, f"http://{i:02d}/") for i in range(3)])
+        await recent.refresh()
+        old_cursor = cursor_of(recent.latest(1))
+        assert recent.complete
+
+        backend.write_segments([row(50 - i, f"http://{i + 10:02d}/") for i in range(4)])
+        await recent.refresh()
+        assert len(recent.rows) == 5 and not recent.complete
+        # More rows than the limit after the cursor
+        rows, reset = recent.since(old_cursor, 2)
+        assert reset and [r["url"] for r in rows] == ["http://12/", "http://13/"]
+        # A cursor from before the buffer may have missed evicted rows
+        ancient = (NOW - datetime.timedelta(days=1), "")
+        rows, reset = recent.since(ancient, 100)
+        assert reset and len(rows) == 5
+
+    asyncio.run(scenario())
+
+
+def test_first_load_falls_back_to_the_whole_table(backend):
+    async def scenario():
+        backend.write_segments([row(3 * 3600, "http://old/"), row(10, "http://new/")])
+        recent = RecentRows(backend, size=10, settle_seconds=120)
+        await recent.refresh()
+        assert [r["url"] for r in recent.latest(100)] == ["http://old/", "http://new/"]
+        assert recent.complete
+
+        empty = RecentRows(DuckDBBackend(backend.root + "-empty", log=lambda message: None))
+        await empty.refresh()
+        assert empty.latest(100) == [] and empty.cursor() is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,185 @@
+"""Rollups over the DuckDB backend, against the rows they were built from."""
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip("duckdb")
+
+from backends import DuckDBBackend
+from rollups import COUNT, LOW_CONFIDENCE, SCORE_SUM, Rollups
+
+NOW = datetime.datetime(2026, 3, 4, 12, 30, 15, tzinfo=datetime.timezone.utc)
+
+
+def row(minutes_ago, classification="MALICIOUS", score=0.95, url="http://a.example/x"):
+    moment = NOW - datetime.timedelta(minutes=minutes_ago)
+    return {"url": url, "score": score, "classification": classification, "time_added": moment.isoformat()}
+
+
+class Clock:
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def backend(tmp_path):
+    # Nothing is merged while a test runs
+    return DuckDBBackend(str(tmp_path), compact_after=10 ** 9, log=lambda message: None)
+
+
+def make_rollups(backend, clock, **kwargs):
+    return Rollups(backend, minutes=120, settle_seconds=120, clock=clock, log=lambda message: None, **kwargs)
+
+
+def test_latest_is_limited_to_the_window(backend):
+    async def scenario():
+        rollups = make_rollups(backend, Clock())
+        await backend.insert_rows([row(90), row(30.5), row(5.25, "BENIGN", 0.1)])
+        await rollups.refresh()
+        hour_ago = NOW - datetime.timedelta(hours=1)
+        assert rollups.latest(hour_ago) == NOW - datetime.timedelta(minutes=5.25)
+        # Inside the minute of `since`, but before it
+        assert rollups.latest(NOW - datetime.timedelta(minutes=30.4)) == NOW - datetime.timedelta(minutes=5.25)
+        assert rollups.latest(NOW - datetime.timedelta(minutes=5)) is None
+
+    asyncio.run(scenario())
+
+
+def test_latest_is_none_without_rows_in_the_window(backend):
+    async def scenario():
+        rollups = make_rollups(backend, Clock())
+        await backend.insert_rows([row(100), row(60 * 24)])
+        await rollups.refresh()
+        assert rollups.latest(NOW - datetime.timedelta(hours=1)) is None
+
+    asyncio.run(scenario())
+
+
+def expected_groups(rows, since=None):
+    """{(classification,): [count, scored, score_sum, low_confidence]} straight from rows."""
+    groups = {}
+    for r in rows:
+        if since is not None and datetime.datetime.fromisoformat(r["time_added"]) < since:
+            continue
+        entry = groups.setdefault((r["classification"],), [0, 0, 0.0, 0])
+        entry[COUNT] += 1
+        entry[SCORE_SUM] += r["score"]
+        malicious = r["classification"] == "MALICIOUS"
+        entry[LOW_CONFIDENCE] += (malicious and r["score"] < 0.7) or (not malicious and r["score"] > 0.3)
+    return groups
+
+
+def summarize(groups):
+    return {key: [values[COUNT], pytest.approx(values[SCORE_SUM]), values[LOW_CONFIDENCE]]
+            for key, values in groups.items()}
+
+
+SPREAD = [
+    row(60 * 24 * 3, "BENIGN", 0.05), row(60 * 24 * 3, "MALICIOUS", 0.6), row(60 * 24, "BENIGN", 0.4),
+    row(200, "MALICIOUS", 0.99), row(119, "BENIGN", 0.2), row(61, "MALICIOUS", 0.75),
+    row(45, "MALICIOUS", 0.91, "http://b.example/a-much-longer-path-for-the-length-buckets"),
+    row(3, "BENIGN", 0.35), row(3, "BENIGN", 0.01), row(0.5, "MALICIOUS", 0.5),
+]
+
+
+def test_rollups_match_the_rows(backend):
+    async def scenario():
+        rollups = make_rollups(backend, Clock())
+        await backend.insert_rows(SPREAD)
+        await rollups.refresh()
+
+        assert summarize(rollups.group(("classification",))) == summarize(expected_groups(SPREAD))
+        hour_ago = NOW - datetime.timedelta(hours=1)
+        assert summarize(rollups.group(("classification",), since=hour_ago)) == summarize(
+            expected_groups(SPREAD, since=hour_ago.replace(second=0)))
+        scores = rollups.group(("score_range",))
+        assert {key[0]: values[COUNT] for key, values in scores.items()} == {
+            "0.0-0.1": 2, "0.1-0.3": 1, "0.3-0.5": 2, "0.5-0.7": 2, "0.7-0.9": 1, "0.9-1.0": 2}
+        lengths = rollups.group(("length_range",))
+        assert {key[0]: values[COUNT] for key, values in lengths.items()} == {"0-30": 9, "50-75": 1}
+
+        daily = rollups.daily(datetime.date(2026, 3, 1))
+        assert daily == {
+            (datetime.date(2026, 3, 1), "BENIGN"): 1, (datetime.date(2026, 3, 1), "MALICIOUS"): 1,
+            (datetime.date(2026, 3, 3), "BENIGN"): 1, (datetime.date(2026, 3, 4), "MALICIOUS"): 4,
+            (datetime.date(2026, 3, 4), "BENIGN"): 3,
+        }
+        minute = datetime.datetime(2026, 3, 4, 12, 27, tzinfo=datetime.timezone.utc)
+        assert rollups.timeline(NOW - datetime.timedelta(minutes=30)) == {
+            (minute, "BENIGN"): 2, (minute.replace(minute=29), "MALICIOUS"): 1}
+
+    asyncio.run(scenario())
+
+
+def test_incremental_refresh_matches_a_rebuild(backend):
+    async def scenario():
+        clock = Clock()
+        rollups = make_rollups(backend, clock)
+        await backend.insert_rows(SPREAD)
+        await rollups.refresh()
+
+        clock.now = NOW + datetime.timedelta(minutes=5)
+        # A new row, and one written late for a minute the last refresh counted
+        late = [row(-4, "MALICIOUS", 0.97), row(1, "BENIGN", 0.02)]
+        await backend.insert_rows(late)
+        await rollups.refresh()
+        assert rollups.synced_at is not None and rollups.boundary == datetime.datetime(
+            2026, 3, 4, 10, 35, tzinfo=datetime.timezone.utc)
+
+        rebuilt = make_rollups(backend, clock)
+        await rebuilt.refresh()
+        assert summarize(rollups.group(("classification",))) == summarize(expected_groups(SPREAD + late))
+        assert rollups.minutes == rebuilt.minutes
+        assert summarize(rollups.group(("classification", "score_range", "length_range"))) == summarize(
+            rebuilt.group(("classification", "score_range", "length_range")))
+
+        # Three hours on, every minute bucket has been folded into days
+        clock.now = NOW + datetime.timedelta(hours=3)
+        await rollups.refresh()
+        assert rollups.minutes == {}
+        assert summarize(rollups.group(("classification",))) == summarize(expected_groups(SPREAD + late))
+        assert rollups.latest(clock.now - datetime.timedelta(hours=1)) is None
+
+    asyncio.run(scenario())
+
+
+def test_resync_drops_deleted_rows(backend, tmp_path):
+    async def scenario():
+        clock = Clock()
+        rollups = make_rollups(backend, clock, resync_interval=0)
+        await backend.insert_rows(SPREAD)
+        await rollups.refresh()
+        for path in tmp_path.glob("date=2026-03-01/**/*.parquet"):
+            path.unlink()
+        await rollups.refresh()
+        assert rollups.daily(datetime.date(2026, 3, 1)).get((datetime.date(2026, 3, 1), "BENIGN")) is None
+
+    asyncio.run(scenario())
+
+
+def test_timeline_changes_by_revision(backend):
+    async def scenario():
+        clock = Clock()
+        rollups = make_rollups(backend, clock)
+        await backend.insert_rows([row(10, "BENIGN", 0.1), row(2, "MALICIOUS", 0.9)])
+        await rollups.refresh()
+        first = rollups.revision
+        window = NOW - datetime.timedelta(minutes=30)
+        assert len(rollups.timeline_changes(window, 0)) == 4
+
+        # Nothing new: no revision, no changed minutes
+        await rollups.refresh()
+        assert rollups.revision == first
+        assert rollups.timeline_changes(window, first) == {}
+
+        await backend.insert_rows([row(2, "BENIGN", 0.2)])
+        await rollups.refresh()
+        minute = datetime.datetime(2026, 3, 4, 12, 28, tzinfo=datetime.timezone.utc)
+        assert rollups.revision == first + 1
+        assert rollups.timeline_changes(window, first) == {(minute, "BENIGN"): 1, (minute, "MALICIOUS"): 1}
+
+    asyncio.run(scenario())
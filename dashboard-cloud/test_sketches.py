@@ -0,0 +1,69 @@
+"""SketchReader: merging the scorers' snapshots for a window."""
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+from summaries import HyperLogLog, SpaceSaving
+
+NOW = 1767323045
+
+
+@pytest.fixture
+def sketches():
+    with pytest.MonkeyPatch.context() as patch:
+        # The scorer's sketches.py shares the name of the dashboard's
+        patch.syspath_prepend(os.path.dirname(os.path.abspath(__file__)))
+        patch.delitem(sys.modules, "sketches", raising=False)
+        yield importlib.import_module("sketches")
+        sys.modules.pop("sketches", None)
+
+
+def bucket(rows, malicious):
+    """A snapshot bucket; malicious maps domain -> (count, score_sum)."""
+    top, domains, malicious_domains = SpaceSaving(10), HyperLogLog(), HyperLogLog()
+    for domain, (count, score_sum) in malicious.items():
+        top.add(domain, count, score_sum)
+        domains.add(domain)
+        malicious_domains.add(domain)
+    return {"rows": rows, "malicious_rows": sum(count for count, _ in malicious.values()),
+            "top_malicious": top.to_dict(), "domains": domains.to_dict(),
+            "malicious_domains": malicious_domains.to_dict()}
+
+
+def snapshot(directory, instance, buckets, tier="5m", size=300):
+    path = directory / f"{instance}.json"
+    path.write_text(json.dumps({"version": 1, "instance": instance, "written_at": NOW - 10,
+                                "tiers": {tier: {"size": size, "buckets": {str(start): data
+                                                                          for start, data in buckets.items()}}}}))
+
+
+def test_window_merges_instances_and_buckets(sketches, tmp_path):
+    start = NOW - NOW % 300
+    snapshot(tmp_path, "a", {start: bucket(10, {"bad.example": (3, 2.7)}),
+                             start - 300: bucket(5, {"bad.example": (1, 0.9), "evil.example": (1, 0.8)}),
+                             # Ended more than an hour ago
+                             start - 3900: bucket(100, {"old.example": (50, 45.0)})})
+    snapshot(tmp_path, "b", {start: bucket(7, {"evil.example": (2, 1.2)})})
+    reader = sketches.SketchReader(str(tmp_path), clock=lambda: NOW, log=lambda message: None)
+
+    window = reader.window("hour")
+    assert window["rows"] == 22 and window["malicious_rows"] == 7 and window["instances"] == 2
+    assert [(entry["domain"], entry["count"], entry["error"]) for entry in window["top"]] == [
+        ("bad.example", 4, 0), ("evil.example", 3, 0)]
+    assert window["top"][0]["avg_confidence"] == pytest.approx(0.9)
+    assert window["distinct_domains"] == window["distinct_malicious_domains"] == 2
+
+    # Merging into the first bucket must leave the loaded snapshot as it was
+    assert reader.window("hour") == window
+
+
+def test_empty_and_broken_snapshots(sketches, tmp_path):
+    (tmp_path / "broken.json").write_text("{")
+    messages = []
+    reader = sketches.SketchReader(str(tmp_path), clock=lambda: NOW, log=messages.append)
+    window = reader.window("day")
+    assert window["top"] == [] and window["as_of"] is None
+    assert len(messages) == 1 and "broken.json" in messages[0]
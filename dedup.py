@@ -0,0 +1,189 @@
+"""Duplicate suppression for domains seen in recent certificates.
+
+DomainDeduplicator answers "was this domain published recently?" in O(1).
+An exact set covers the last `window` domains, optionally also expiring
+them after `ttl` seconds. A rotating Bloom filter can be added for much
+longer windows at a fixed memory budget. Each of its generations holds
+`bloom_capacity` domains. When the newest generation is full, the oldest is
+cleared and reused, so the filter remembers between
+(generations - 1) * capacity and generations * capacity domains.
+
+Bloom filters can report a domain as seen when it wasn't. Besides the
+estimate derived from the filter's fill ratio, the deduplicator checks a
+random never-seen probe every PROBE_EVERY insertions and reports the
+fraction that tested positive as the observed false-positive rate.
+"""
+import hashlib
+import math
+import os
+import secrets
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+PROBE_EVERY = 100
+
+
+class RotatingBloomFilter:
+    """Bloom filter made of generations that are cleared in turn."""
+
+    def __init__(self, capacity, error_rate=0.001, generations=2):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Standard sizing for one generation at the target error rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = [bytearray((self.num_bits + 7) // 8) for _ in range(generations)]
+        self.counts = [0] * generations
+        self.current = 0
+
+    @property
+    def nbytes(self):
+        return sum(len(generation) for generation in self.bits)
+
+    def positions(self, key):
+        """Bit positions of key, by double hashing one 128-bit digest."""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def contains(self, positions):
+        for generation in self.bits:
+            if all(generation[p >> 3] & (1 << (p & 7)) for p in positions):
+                return True
+        return False
+
+    def __contains__(self, key):
+        return self.contains(self.positions(key))
+
+    def add(self, key):
+        """Adds key; returns True if it (probably) was already present."""
+        positions = self.positions(key)
+        if self.contains(positions):
+            return True
+        if self.counts[self.current] >= self.capacity:
+            self.current = (self.current + 1) % len(self.bits)
+            self.bits[self.current] = bytearray(len(self.bits[self.current]))
+            self.counts[self.current] = 0
+        generation = self.bits[self.current]
+        for p in positions:
+            generation[p >> 3] |= 1 << (p & 7)
+        self.counts[self.current] += 1
+        return False
+
+    def estimated_fp_rate(self):
+        """False-positive rate implied by how full each generation is."""
+        miss = 1.0
+        for generation in self.bits:
+            fill = np.unpackbits(np.frombuffer(generation, dtype=np.uint8))[:self.num_bits].mean()
+            miss *= 1 - fill ** self.num_hashes
+        return 1 - miss
+
+
+class DomainDeduplicator:
+    """Exact recent-domain set with FIFO/TTL expiry, plus an optional rotating Bloom filter."""
+
+    def __init__(self, window=20000, ttl=None, bloom_capacity=0, bloom_error_rate=0.001, bloom_generations=2):
+        self.window = window
+        self.ttl = ttl
+        self.recent = OrderedDict()
+        self.bloom = (
+            RotatingBloomFilter(bloom_capacity, bloom_error_rate, bloom_generations)
+            if bloom_capacity else None
+        )
+        self.checked = 0
+        self.duplicates = 0
+        self.bloom_duplicates = 0
+        self.probes = 0
+        self.probe_hits = 0
+
+    def __len__(self):
+        return len(self.recent)
+
+    def expire(self, now):
+        while len(self.recent) > self.window:
+            self.recent.popitem(last=False)
+        if self.ttl:
+            cutoff = now - self.ttl
+            while self.recent and next(iter(self.recent.values())) < cutoff:
+                self.recent.popitem(last=False)
+
+    def filter_new(self, domains):
+        """Returns the domains not seen recently and records them as seen."""
+        now = time.time()
+        self.expire(now)
+        fresh = []
+        for domain in domains:
+            self.checked += 1
+            if domain in self.recent:
+                self.duplicates += 1
+                continue
+            if self.bloom is not None:
+                if self.bloom.add(domain):
+                    self.duplicates += 1
+                    self.bloom_duplicates += 1
+                    continue
+                if self.checked % PROBE_EVERY == 0:
+                    self.probe()
+            self.recent[domain] = now
+            if len(self.recent) > self.window:
+                self.recent.popitem(last=False)
+            fresh.append(domain)
+        return fresh
+
+    def probe(self):
+        # A random label can't have been inserted, so any hit is a false positive
+        self.probes += 1
+        if f"probe-{secrets.token_hex(16)}.invalid" in self.bloom:
+            self.probe_hits += 1
+
+    def stats(self):
+        stats = {
+            "recent": len(self.recent),
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+        }
+        if self.bloom is not None:
+            stats.update({
+                "bloom_duplicates": self.bloom_duplicates,
+                "bloom_bytes": self.bloom.nbytes,
+                "bloom_fp_estimated": round(float(self.bloom.estimated_fp_rate()), 6),
+                "bloom_fp_observed": round(self.probe_hits / self.probes, 6) if self.probes else 0.0,
+                "bloom_probes": self.probes,
+            })
+        return stats
+
+    def save(self, path):
+        """Writes the recent set and Bloom bits atomically to path (.npz)."""
+        arrays = {
+            "domains": np.frombuffer("\n".join(self.recent).encode("utf-8"), dtype=np.uint8),
+            "seen_at": np.fromiter(self.recent.values(), dtype=np.float64, count=len(self.recent)),
+        }
+        if self.bloom is not None:
+            arrays["bloom_bits"] = np.array([np.frombuffer(bits, dtype=np.uint8) for bits in self.bloom.bits])
+            arrays["bloom_counts"] = np.array(self.bloom.counts)
+            arrays["bloom_current"] = np.array(self.bloom.current)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Restores state saved by save(); returns False if there is none to load."""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            text = data["domains"].tobytes().decode("utf-8")
+            domains = text.split("\n") if text else []
+            self.recent = OrderedDict(zip(domains, data["seen_at"].tolist()))
+            bloom = self.bloom
+            # A filter saved with another size or error rate can't be reused
+            shape = (len(bloom.bits), len(bloom.bits[0])) if bloom is not None else None
+            if bloom is not None and "bloom_bits" in data and data["bloom_bits"].shape == shape:
+                bloom.bits = [bytearray(row.tobytes()) for row in data["bloom_bits"]]
+                bloom.counts = data["bloom_counts"].tolist()
+                bloom.current = int(data["bloom_current"])
+        self.expire(time.time())
+        return True
@@ -0,0 +1,200 @@
+"""Domain normalization and filtering shared by the producers and the scorer.
+
+filter_domains drops wildcards and the certificate metadata that crt.sh
+mixes into name_value ("Terms of use at ...", "(c)2024 ...") with one
+pass of a single compiled pattern over the whole batch. normalize_domains lowercases,
+drops the trailing root dot and converts internationalized names to their
+IDNA (punycode) form. PublicSuffixList knows which part of a name is a
+public suffix, so "co.uk" alone is rejected and registered_domain() can
+group "a.b.example.co.uk" under "example.co.uk".
+"""
+import os
+import re
+import time
+
+import metrics
+
+# Scheme and www prefixes stripped before scoring
+PREFIX_PATTERN = re.compile(r'https?://|www\.')
+
+METADATA_PHRASES = (
+    "terms of use", "see www.", "(c)", "http://", "https://",
+    "go to", "repository", "resources/cps", "incits",
+    "copyright", "visit", "refer to",
+)
+
+# Substrings that make a name invalid. Phrases containing a space are
+# already rejected by the space itself.
+INVALID_SUBSTRINGS = (" ",) + tuple(phrase for phrase in METADATA_PHRASES if " " not in phrase)
+
+# Any invalid substring, or a wildcard at the start of a line of the
+# newline-joined batch
+INVALID_PATTERN = re.compile("|".join(map(re.escape, INVALID_SUBSTRINGS + ("\n*.",))))
+
+PUBLIC_SUFFIX_LIST = os.environ.get("PUBLIC_SUFFIX_LIST", "/usr/share/publicsuffix/public_suffix_list.dat")
+
+clean_seconds = metrics.histogram("domain_filter_seconds", "clean_domains time per call")
+
+# Used when no public suffix list file is available: every TLD plus the
+# multi-label suffixes most common in CT logs
+DEFAULT_SUFFIXES = (
+    "co.uk", "org.uk", "ac.uk", "gov.uk", "me.uk", "com.au", "net.au", "org.au", "edu.au",
+    "co.jp", "ne.jp", "or.jp", "com.br", "com.cn", "com.tw", "com.hk", "com.vn", "co.in",
+    "co.kr", "co.nz", "com.mx", "com.tr", "co.za", "com.sg", "com.my", "co.id", "com.ar",
+    "github.io", "gitlab.io", "herokuapp.com", "appspot.com", "blogspot.com", "cloudfront.net",
+    "azurewebsites.net", "vercel.app", "netlify.app", "pages.dev", "workers.dev", "web.app",
+    "firebaseapp.com", "ngrok.io", "ngrok-free.app", "r2.dev",
+)
+
+
+def is_valid_domain(d):
+    if not d or d.startswith("*."):
+        return False
+    lowered = d.lower()
+    if any(substring in lowered for substring in INVALID_SUBSTRINGS):
+        return False
+    # Must contain at least one dot (domain.tld)
+    return "." in d
+
+
+def filter_domains(domains):
+    """Returns the valid domains of a list, see is_valid_domain.
+
+    The list is joined and lowercased once and INVALID_PATTERN, one
+    alternation of every invalid substring, scans the whole batch in a
+    single pass. Only the lines it matches are rejected individually.
+    """
+    joined = "\n" + "\n".join(domains)
+    lowered = joined.lower()
+    if joined.count("\n") != len(domains) or len(lowered) != len(joined):
+        # A domain contains the separator or changes length when
+        # lowercased, fall back to per-domain checks
+        return [d for d in domains if is_valid_domain(d)]
+
+    # Line of each match, counting separators from the previous one. Only
+    # the wildcard alternative spans a separator, the one starting its line.
+    invalid = set()
+    line, scanned = -1, 0
+    for match in INVALID_PATTERN.finditer(lowered):
+        position = match.start() + 1
+        line += lowered.count("\n", scanned, position)
+        scanned = position
+        invalid.add(line)
+    if not invalid:
+        return [d for d in domains if "." in d]
+    return [d for i, d in enumerate(domains) if i not in invalid and "." in d]
+
+
+def drop_wildcards(urls):
+    return [u for u in urls if not u.startswith("*.")]
+
+
+def to_ascii(domain):
+    """IDNA (punycode) form of an internationalized name, or None if it has none."""
+    try:
+        import idna
+
+        return idna.encode(domain, uts46=True).decode("ascii")
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        return domain.encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+
+
+def normalize_domain(domain):
+    domain = domain.strip().lower().rstrip(".")
+    if not domain.isascii():
+        return to_ascii(domain)
+    return domain
+
+
+def normalize_domains(domains):
+    """normalize_domain over a list; names that can't be encoded are dropped."""
+    joined = "\n".join(domains).lower()
+    if joined.isascii() and joined.count("\n") == len(domains) - 1:
+        return [d.strip().rstrip(".") for d in joined.split("\n")]
+    normalized = (normalize_domain(d) for d in domains)
+    return [d for d in normalized if d]
+
+
+class PublicSuffixList:
+    """Public suffix rules (https://publicsuffix.org/list/), with wildcard
+    and exception rules. Names are expected normalized (lowercase ASCII)."""
+
+    def __init__(self, rules=DEFAULT_SUFFIXES):
+        self.rules = set()
+        self.wildcards = set()
+        self.exceptions = set()
+        for rule in rules:
+            if rule.startswith("!"):
+                self.exceptions.add(normalize_domain(rule[1:]))
+            elif rule.startswith("*."):
+                self.wildcards.add(normalize_domain(rule[2:]))
+            else:
+                self.rules.add(normalize_domain(rule))
+
+    @classmethod
+    def load(cls, path=PUBLIC_SUFFIX_LIST):
+        """Reads a public_suffix_list.dat file, or the built-in suffixes if it is missing."""
+        if not path or not os.path.exists(path):
+            return cls()
+        rules = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("//"):
+                    rules.append(line.split()[0])
+        return cls(rules)
+
+    def public_suffix(self, domain):
+        labels = domain.split(".")
+        for i in range(len(labels)):
+            candidate = ".".join(labels[i:])
+            if candidate in self.exceptions:
+                return ".".join(labels[i + 1:])
+            if candidate in self.rules:
+                return candidate
+            if i + 1 < len(labels) and ".".join(labels[i + 1:]) in self.wildcards:
+                return candidate
+        # Default rule: the TLD is a public suffix
+        return labels[-1]
+
+    def is_public_suffix(self, domain):
+        # Same as public_suffix(domain) == domain, without walking the labels
+        if domain in self.rules:
+            return True
+        parent = domain.partition(".")[2]
+        if not parent:
+            return True
+        return parent in self.wildcards and domain not in self.exceptions
+
+    def registered_domain(self, domain):
+        """The public suffix plus one label, or None for a bare suffix."""
+        suffix = self.public_suffix(domain)
+        if suffix == domain:
+            return None
+        return ".".join(domain.split(".")[-suffix.count(".") - 2:])
+
+
+_public_suffixes = None
+
+
+def public_suffixes():
+    """The process-wide PublicSuffixList, loaded on first use."""
+    global _public_suffixes
+    if _public_suffixes is None:
+        _public_suffixes = PublicSuffixList.load()
+    return _public_suffixes
+
+
+def clean_domains(domains):
+    """filter_domains + normalize_domains, also dropping bare public suffixes."""
+    start = time.perf_counter()
+    psl = public_suffixes()
+    cleaned = [d for d in normalize_domains(filter_domains(domains)) if not psl.is_public_suffix(d)]
+    clean_seconds.observe(time.perf_counter() - start)
+    return cleaned
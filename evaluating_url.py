@@ -1,23 +1,141 @@
+import time
+
+MODULE_IMPORT_START = time.perf_counter()
+
+import atexit
 import base64
-import json
-import re
-import tensorflow as tf
 import numpy as np
-from google.cloud import bigquery
 import os
 import datetime
+import queue
 import sys
+import tempfile
+import threading
+from collections import deque
+
+import metrics
+from domains import PREFIX_PATTERN, drop_wildcards
+from metrics import TRACE_ATTRIBUTE, TRACE_IDS, LogSampler
+from payloads import decode_payload
+from prefilter import LexicalModel, in_band
+from sketches import DomainSketches
+from sinks import FAILED, WRITTEN, BufferedWriter, concat_columns, open_sink
+from verdict_cache import VerdictCache, open_store
+
+# TensorFlow and google.cloud.bigquery are imported on first use, they are
+# the bulk of a cold start
 
 PROJECT_ID = "hip-host-475008-d5"
 DATASET_ID = "big_data_uet_dataset"
 TABLE_ID = "classified_urls"
 THRESHOLD = 0.5
 BATCH_SIZE = 500
+MODEL_PATH = "url_classifier_model.keras"
+
+# Streaming worker settings (python evaluating_url.py)
+SUBSCRIPTION_ID = os.environ.get("SUBSCRIPTION_ID", "urlstream-sub")
+WORKER_MAX_BATCH_URLS = int(os.environ.get("WORKER_MAX_BATCH_URLS", 512))
+WORKER_MAX_LATENCY_MS = float(os.environ.get("WORKER_MAX_LATENCY_MS", 50))
+WORKER_MAX_OUTSTANDING = int(os.environ.get("WORKER_MAX_OUTSTANDING", 2000))
+WORKER_REPORT_INTERVAL = float(os.environ.get("WORKER_REPORT_INTERVAL", 30))
+
+# Character encoding (must match the TextVectorization layer of the model)
+MAX_URL_CHARS = 500
+SEQUENCE_LENGTH = 200
+OOV_ID = 1
+# Characters removed by the "lower_and_strip_punctuation" standardization
+STRIPPED_CHARS = "!\"#$%&()*+,-./:;<=>?@[\\]^_`{|}~'"
+# Characters the whitespace split treats as separators
+SPLIT_CHARS = " \t\n\v\f\r"
+
+# Compiled serving model (python evaluating_url.py export)
+SERVING_MODEL_DIR = os.environ.get("SERVING_MODEL_DIR", "url_classifier_serving")
+LOOKUP_TABLE_FILE = "lookup_table.npy"
+# Inputs are padded up to one of these batch sizes so only a few shapes are traced
+BATCH_BUCKETS = tuple(int(b) for b in os.environ.get("BATCH_BUCKETS", "32,128,512").split(","))
+
+# "tensorflow" (SavedModel / Keras) or "tflite" (model from convert_tflite.py)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "tensorflow")
+TFLITE_MODEL_PATH = os.environ.get("TFLITE_MODEL_PATH", "url_classifier_model.tflite")
+TFLITE_NUM_THREADS = int(os.environ.get("TFLITE_NUM_THREADS", os.cpu_count() or 1))
+
+# Thread pools of the in-process TensorFlow model (0 keeps TensorFlow's
+# defaults). INFERENCE_REPLICAS > 0 instead runs that many model replicas in
+# separate processes (see inference_pool.py), each with these thread counts
+# (intra-op defaults to the usable cores divided by the replicas) and pinned
+# to cores per INFERENCE_CPU_AFFINITY: "auto", or one CPU list per replica
+# such as "0-3;4-7".
+INFERENCE_REPLICAS = int(os.environ.get("INFERENCE_REPLICAS", 0))
+INFERENCE_INTRA_OP_THREADS = int(os.environ.get("INFERENCE_INTRA_OP_THREADS", 0))
+INFERENCE_INTER_OP_THREADS = int(os.environ.get("INFERENCE_INTER_OP_THREADS", 0))
+INFERENCE_CPU_AFFINITY = os.environ.get("INFERENCE_CPU_AFFINITY", "")
+
+# Verdict cache keyed by normalized URL (VERDICT_CACHE_SIZE=0 disables it).
+# VERDICT_CACHE_BACKEND optionally shares verdicts between workers:
+# "sqlite:///path/to/verdicts.db" or "redis://host:6379/0"
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", 100000))
+VERDICT_CACHE_TTL = float(os.environ.get("VERDICT_CACHE_TTL", 6 * 3600))
+VERDICT_CACHE_BACKEND = os.environ.get("VERDICT_CACHE_BACKEND", "")
+
+# Lexical pre-filter (see prefilter.py, train it with train_prefilter.py).
+# URLs whose lexical score is outside [PREFILTER_LOW, PREFILTER_HIGH] keep
+# that score and skip the CNN; the default band only short-circuits the
+# clearly benign side. An empty PREFILTER_PATH disables it.
+PREFILTER_PATH = os.environ.get("PREFILTER_PATH", "")
+PREFILTER_LOW = float(os.environ.get("PREFILTER_LOW", 0.02))
+PREFILTER_HIGH = float(os.environ.get("PREFILTER_HIGH", 1.0))
+
+# Output sink, see sinks.py: "bigquery-storage", "bigquery" (legacy streaming
+# inserts), "file:///path.ndjson", "sqlite:///path.db" or "parquet:///dir"
+# (hourly segments for the dashboard's DuckDB backend)
+SINK = os.environ.get("SINK", "bigquery-storage")
+SINK_MAX_ROWS = int(os.environ.get("SINK_MAX_ROWS", 1000))
+SINK_MAX_BYTES = int(os.environ.get("SINK_MAX_BYTES", 5 * 1024 * 1024))
+SINK_MAX_LATENCY_MS = float(os.environ.get("SINK_MAX_LATENCY_MS", 200))
+SINK_MAX_ATTEMPTS = int(os.environ.get("SINK_MAX_ATTEMPTS", 5))
+DEAD_LETTER_PATH = os.environ.get(
+    "DEAD_LETTER_PATH", os.path.join(tempfile.gettempdir(), "classified_urls_dead_letter.ndjson")
+)
+
+# Top malicious domain and distinct domain sketches (see sketches.py), written
+# every SKETCH_SNAPSHOT_INTERVAL seconds to SKETCH_DIR, a directory the
+# dashboard reads. An empty SKETCH_DIR disables them.
+SKETCH_DIR = os.environ.get("SKETCH_DIR", "")
+SKETCH_SNAPSHOT_INTERVAL = float(os.environ.get("SKETCH_SNAPSHOT_INTERVAL", 60))
+SKETCH_TOP_CAPACITY = int(os.environ.get("SKETCH_TOP_CAPACITY", 500))
+
+# "lazy" loads the model on the first message, "prewarm" loads it and runs a
+# dummy inference in a background thread as soon as the module is imported
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "lazy")
+
+# Metrics (see metrics.py for METRICS_PORT / METRICS_FILE and TRACE_IDS)
+decode_seconds = metrics.histogram("scorer_decode_seconds", "Payload decompression and JSON decoding time")
+filter_seconds = metrics.histogram("scorer_filter_seconds", "Wildcard filtering time per payload")
+preprocess_seconds = metrics.histogram(
+    "scorer_preprocess_seconds", "Normalization, cache lookup and encoding time per batch"
+)
+prefilter_seconds = metrics.histogram("scorer_prefilter_seconds", "Lexical pre-filter time per batch")
+predict_seconds = metrics.histogram("scorer_predict_seconds", "Model forward pass time per batch")
+scored_urls = metrics.counter(
+    "scorer_urls_total", "Distinct URLs per batch by what decided their score", ("tier",)
+)
+inbox_depth = metrics.gauge("scorer_inbox_depth", "Messages waiting in the worker inbox")
+failed_batches = metrics.counter("scorer_failed_batches_total", "Worker micro-batches that raised, nacked")
+log_sampler = LogSampler()
 
 # Lazy-loaded global variables
 model = None
-bq_client = None
-table_ref = None
+encoded_model = None
+lookup_table = None
+serving_model = None
+predictor = None
+predictor_lock = threading.Lock()
+verdict_cache = None
+prefilter = None
+writer = None
+domain_sketches = None
+# Milliseconds spent in each startup stage, logged once the predictor is ready
+startup_timeline = {}
 
 
 def log(msg):
@@ -25,13 +143,67 @@ def log(msg):
     print(f"[LOG] {datetime.datetime.now().isoformat()} - {msg}", flush=True)
 
 
+def log_sampled(key, msg):
+    """log() for per-batch messages, at most once per LOG_SAMPLE_INTERVAL per key."""
+    log_sampler(key, msg, log)
+
+
+def record_startup(stage, start):
+    """Records a startup stage that began at perf_counter() value start."""
+    if stage not in startup_timeline:
+        startup_timeline[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def import_tensorflow():
+    """Imports TensorFlow on first use and records how long it took."""
+    start = time.perf_counter()
+    import tensorflow as tf
+    record_startup("import_tensorflow", start)
+    return tf
+
+
+def configure_threads(tf, intra_op, inter_op):
+    """Sets TensorFlow's thread pool sizes; 0 keeps the default. Only works
+    before the first operation runs."""
+    try:
+        if intra_op:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+        if inter_op:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    except RuntimeError as e:
+        log(f"ERROR setting TensorFlow thread pools, keeping the current ones: {e}")
+
+
+def usable_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def tflite_interpreter_class():
+    """Returns the lightest available TFLite Interpreter class.
+
+    The standalone LiteRT / tflite_runtime packages import much faster than
+    TensorFlow, which is only used as a fallback.
+    """
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = import_tensorflow().lite.Interpreter
+    return Interpreter
+
+
 def get_model():
     """Lazy-loads model once per container."""
     global model
     if model is None:
+        tf = import_tensorflow()
         log("Loading TensorFlow model...")
         try:
-            model = tf.keras.models.load_model("url_classifier_model.keras")
+            model = tf.keras.models.load_model(MODEL_PATH)
             log("Model loaded successfully.")
         except Exception as e:
             log(f"ERROR loading model: {e}")
@@ -39,19 +211,277 @@ def get_model():
     return model
 
 
-def get_bigquery_client():
-    """Lazy-loads BigQuery client."""
-    global bq_client, table_ref
-    if bq_client is None:
-        log("Initializing BigQuery client...")
+def get_encoder():
+    """Lazy-loads the id-input model and the character lookup table.
+
+    The returned model starts at the embedding, skipping the string
+    TextVectorization layer, and expects the output of encode_urls().
+    """
+    global encoded_model, lookup_table
+    if encoded_model is None:
+        full_model = get_model()
+        if full_model is None:
+            return None, None
+        tf = import_tensorflow()
+        vectorizer = next(
+            layer for layer in full_model.layers
+            if isinstance(layer, tf.keras.layers.TextVectorization)
+        )
+        lookup_table = build_lookup_table(vectorizer.get_vocabulary())
+        encoded_model = tf.keras.Model(inputs=vectorizer.output, outputs=full_model.output)
+        log(f"Encoder ready ({len(lookup_table)} code points in lookup table).")
+    return encoded_model, lookup_table
+
+
+class BucketedPredictor:
+    """Calls a compiled forward pass on id matrices padded to fixed batch sizes.
+
+    Batches larger than the biggest bucket are split into chunks of that size.
+    """
+
+    def __init__(self, serve_fn, buckets=BATCH_BUCKETS):
+        self.serve_fn = serve_fn
+        self.buckets = sorted(buckets)
+
+    def bucket_for(self, size):
+        return next((b for b in self.buckets if b >= size), self.buckets[-1])
+
+    def __call__(self, encoded):
+        scores = np.empty((len(encoded), 1), dtype=np.float32)
+        largest = self.buckets[-1]
+        for start in range(0, len(encoded), largest):
+            chunk = encoded[start:start + largest]
+            padded = np.zeros((self.bucket_for(len(chunk)), SEQUENCE_LENGTH), dtype=np.int32)
+            padded[:len(chunk)] = chunk
+            output = self.serve_fn(padded)
+            scores[start:start + len(chunk)] = np.asarray(output)[:len(chunk)]
+        return scores
+
+    def warm_up(self):
+        """Traces every bucket so the first real batch doesn't pay for it."""
+        for bucket in self.buckets:
+            start = time.perf_counter()
+            self.serve_fn(np.zeros((bucket, SEQUENCE_LENGTH), dtype=np.int32))
+            log(f"Warmed up batch bucket {bucket} in {(time.perf_counter() - start) * 1000:.0f} ms.")
+
+
+class TFLiteModel:
+    """Runs a converted model through the TFLite interpreter.
+
+    Keeps one allocated interpreter per input shape, which with the batch
+    buckets means one per bucket.
+    """
+
+    def __init__(self, model_path, num_threads=TFLITE_NUM_THREADS):
+        with open(model_path, "rb") as f:
+            self.model_content = f.read()
+        self.num_threads = num_threads
+        self.interpreter_class = tflite_interpreter_class()
+        self.interpreters = {}
+
+    def __call__(self, ids):
+        interpreter = self.interpreters.get(ids.shape)
+        if interpreter is None:
+            interpreter = self.interpreter_class(model_content=self.model_content, num_threads=self.num_threads)
+            interpreter.resize_tensor_input(interpreter.get_input_details()[0]["index"], ids.shape)
+            interpreter.allocate_tensors()
+            self.interpreters[ids.shape] = interpreter
+        interpreter.set_tensor(interpreter.get_input_details()[0]["index"], ids)
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]["index"])
+
+
+def tflite_lookup_table_path(model_path):
+    """Where convert_tflite.py stores the lookup table for a .tflite model."""
+    return os.path.splitext(model_path)[0] + "_" + LOOKUP_TABLE_FILE
+
+
+def export_serving_model(export_dir=SERVING_MODEL_DIR):
+    """Exports the id-input model as a SavedModel with a tf.function endpoint,
+    plus the lookup table needed to encode its inputs."""
+    encoded, table = get_encoder()
+    if encoded is None:
+        log("Model not available, nothing exported.")
+        return
+    tf = import_tensorflow()
+    archive = tf.keras.export.ExportArchive()
+    archive.track(encoded)
+    archive.add_endpoint(
+        name="serve",
+        fn=lambda ids: encoded(ids, training=False),
+        input_signature=[tf.TensorSpec(shape=(None, SEQUENCE_LENGTH), dtype=tf.int32)],
+    )
+    archive.write_out(export_dir)
+    np.save(os.path.join(export_dir, LOOKUP_TABLE_FILE), table)
+    log(f"Serving model exported to {export_dir}.")
+
+
+def get_predictor():
+    """Lazy-loads the warmed-up BucketedPredictor and its lookup table.
+
+    With INFERENCE_BACKEND=tflite, runs TFLITE_MODEL_PATH. Otherwise uses the
+    exported SavedModel when SERVING_MODEL_DIR exists, or compiles the Keras
+    model in-process. With INFERENCE_REPLICAS > 0 the predictor is an
+    InferencePool whose replicas each load the model that way. Callers
+    block while another thread (e.g. prewarm) is still loading it.
+    """
+    global serving_model, predictor, lookup_table
+    with predictor_lock:
+        if predictor is not None:
+            return predictor, lookup_table
+
+        if INFERENCE_REPLICAS > 0:
+            return start_inference_pool()
+        if INFERENCE_BACKEND != "tflite":
+            configure_threads(import_tensorflow(), INFERENCE_INTRA_OP_THREADS, INFERENCE_INTER_OP_THREADS)
+        start = time.perf_counter()
+        if INFERENCE_BACKEND == "tflite":
+            log(f"Loading TFLite model from {TFLITE_MODEL_PATH} ({TFLITE_NUM_THREADS} threads)...")
+            try:
+                serve_fn = TFLiteModel(TFLITE_MODEL_PATH)
+                lookup_table = np.load(tflite_lookup_table_path(TFLITE_MODEL_PATH))
+            except Exception as e:
+                log(f"ERROR loading TFLite model: {e}")
+                return None, None
+        elif os.path.isdir(SERVING_MODEL_DIR):
+            tf = import_tensorflow()
+            log(f"Loading serving model from {SERVING_MODEL_DIR}...")
+            try:
+                # Keep a reference, the endpoint's variables belong to it
+                serving_model = tf.saved_model.load(SERVING_MODEL_DIR)
+                serve_fn = serving_model.serve
+                lookup_table = np.load(os.path.join(SERVING_MODEL_DIR, LOOKUP_TABLE_FILE))
+            except Exception as e:
+                log(f"ERROR loading serving model: {e}")
+                return None, None
+        else:
+            log(f"No serving model in {SERVING_MODEL_DIR}, compiling {MODEL_PATH} "
+                f"(run 'python evaluating_url.py export' for faster cold starts).")
+            encoded, _ = get_encoder()
+            if encoded is None:
+                return None, None
+            serve_fn = import_tensorflow().function(lambda ids: encoded(ids, training=False))
+        record_startup("load_model", start)
+
+        candidate = BucketedPredictor(serve_fn)
+        start = time.perf_counter()
+        candidate.warm_up()
+        record_startup("first_trace", start)
+        start = time.perf_counter()
+        candidate(np.zeros((1, SEQUENCE_LENGTH), dtype=np.int32))
+        record_startup("first_predict", start)
+
+        predictor = candidate
+        timeline = ", ".join(f"{stage}={ms}ms" for stage, ms in startup_timeline.items())
+        log(f"Startup timeline: {timeline}")
+        return predictor, lookup_table
+
+
+def start_inference_pool():
+    """get_predictor() for INFERENCE_REPLICAS > 0, called with predictor_lock held."""
+    global predictor, lookup_table
+    from inference_pool import InferencePool
+
+    intra_op = INFERENCE_INTRA_OP_THREADS or max(1, usable_cores() // INFERENCE_REPLICAS)
+    inter_op = INFERENCE_INTER_OP_THREADS or 1
+    log(f"Starting {INFERENCE_REPLICAS} inference replicas...")
+    start = time.perf_counter()
+    try:
+        pool = InferencePool(
+            INFERENCE_REPLICAS, intra_op, inter_op, INFERENCE_CPU_AFFINITY,
+            max_rows=max(BATCH_BUCKETS), sequence_length=SEQUENCE_LENGTH, log=log,
+        )
+    except Exception as e:
+        log(f"ERROR starting inference replicas: {e}")
+        return None, None
+    atexit.register(pool.close)
+    record_startup("load_model", start)
+    predictor, lookup_table = pool, pool.table
+    return predictor, lookup_table
+
+
+def prewarm():
+    """Loads the predictor and the sink in a background thread."""
+    def run():
+        get_predictor()
+        get_writer()
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_verdict_cache():
+    """Lazy-creates the verdict cache, None when disabled."""
+    global verdict_cache
+    if verdict_cache is None and VERDICT_CACHE_SIZE > 0:
+        store = None
+        try:
+            store = open_store(VERDICT_CACHE_BACKEND, VERDICT_CACHE_TTL)
+        except Exception as e:
+            log(f"ERROR opening shared verdict cache, using local cache only: {e}")
+        verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL, store)
+        log(f"Verdict cache ready ({VERDICT_CACHE_SIZE} entries, TTL {VERDICT_CACHE_TTL:.0f}s"
+            f"{', shared: ' + VERDICT_CACHE_BACKEND if store else ''}).")
+    return verdict_cache
+
+
+def get_prefilter():
+    """Lazy-loads the lexical pre-filter, None when PREFILTER_PATH is unset or unreadable."""
+    global prefilter
+    if prefilter is None and PREFILTER_PATH:
         try:
-            bq_client = bigquery.Client(project=PROJECT_ID)
-            table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID)
-            log("BigQuery client initialized.")
+            prefilter = LexicalModel.load(PREFILTER_PATH)
+            log(f"Lexical pre-filter loaded from {PREFILTER_PATH} "
+                f"(CNN band [{PREFILTER_LOW}, {PREFILTER_HIGH}]).")
         except Exception as e:
-            log(f"ERROR initializing BigQuery client: {e}")
-            bq_client = None
-    return bq_client
+            log(f"ERROR loading lexical pre-filter, scoring everything with the CNN: {e}")
+    return prefilter
+
+
+def get_writer():
+    """Lazy-creates the BufferedWriter in front of the configured SINK."""
+    global writer
+    if writer is None:
+        log(f"Initializing {SINK} sink...")
+        try:
+            sink = open_sink(SINK, PROJECT_ID, DATASET_ID, TABLE_ID, trace_ids=TRACE_IDS)
+            writer = BufferedWriter(
+                sink,
+                max_rows=SINK_MAX_ROWS,
+                max_bytes=SINK_MAX_BYTES,
+                max_latency=SINK_MAX_LATENCY_MS / 1000,
+                max_attempts=SINK_MAX_ATTEMPTS,
+                dead_letter_path=DEAD_LETTER_PATH,
+                log=log,
+            )
+            log("Sink initialized.")
+        except Exception as e:
+            log(f"ERROR initializing {SINK} sink: {e}")
+            writer = None
+    return writer
+
+
+def get_sketches():
+    """Lazy-creates the domain sketches, None when SKETCH_DIR is unset."""
+    global domain_sketches
+    if domain_sketches is None and SKETCH_DIR:
+        domain_sketches = DomainSketches(capacity=SKETCH_TOP_CAPACITY)
+        log(f"Domain sketches ready (snapshots to {SKETCH_DIR} every {SKETCH_SNAPSHOT_INTERVAL:.0f}s).")
+    return domain_sketches
+
+
+def update_sketches(columns, force_snapshot=False):
+    """Adds scored rows to the domain sketches and writes a snapshot when one is due."""
+    sketches = get_sketches()
+    if sketches is None:
+        return
+    try:
+        sketches.add(columns)
+        if force_snapshot or sketches.snapshot_due(SKETCH_SNAPSHOT_INTERVAL):
+            sketches.snapshot(SKETCH_DIR)
+    except Exception as e:
+        log(f"ERROR updating domain sketches: {e}")
 
 
 def create_batches(data, batch_size):
@@ -61,74 +491,454 @@ def create_batches(data, batch_size):
 
 def preprocess_url(url):
     url = url.lower()
-    url = re.sub(r'https?://|www\.', '', url)
+    url = PREFIX_PATTERN.sub('', url)
     url = url[:500]
     url = " ".join(list(url))
     return url
 
 
+def normalize_urls(urls):
+    """Lowercases, strips scheme/www prefixes and truncates a list of URLs.
+
+    Same result as preprocess_url() without the space-joining, but with a
+    single lower() and regex pass over the whole batch.
+    """
+    joined = "\n".join(urls)
+    if joined.count("\n") != len(urls) - 1:
+        # A URL contains the separator, fall back to per-URL processing
+        return [PREFIX_PATTERN.sub('', url.lower())[:MAX_URL_CHARS] for url in urls]
+    parts = PREFIX_PATTERN.sub('', joined.lower()).split("\n")
+    return [part[:MAX_URL_CHARS] for part in parts]
+
+
+def build_lookup_table(vocabulary):
+    """Builds a code point -> token id table from a TextVectorization vocabulary.
+
+    Index 0 and 1 of the vocabulary are the padding and [UNK] tokens. Characters
+    dropped by the vectorizer map to -1, unknown characters map to OOV_ID.
+    """
+    size = max([128] + [ord(token) + 1 for token in vocabulary if len(token) == 1])
+    table = np.full(size, OOV_ID, dtype=np.int32)
+    for token_id, token in enumerate(vocabulary):
+        if len(token) == 1:
+            table[ord(token)] = token_id
+    for char in STRIPPED_CHARS + SPLIT_CHARS:
+        table[ord(char)] = -1
+    return table
+
+
+def encode_urls(urls, table):
+    """Encodes raw URLs into a padded (N, SEQUENCE_LENGTH) int32 id matrix.
+
+    Produces the same ids as running preprocess_url() through the model's
+    TextVectorization layer.
+    """
+    return encode_normalized(normalize_urls(urls), table)
+
+
+def encode_normalized(normalized, table):
+    """encode_urls() for URLs already passed through normalize_urls()."""
+    encoded = np.zeros((len(normalized), SEQUENCE_LENGTH), dtype=np.int32)
+    if not normalized:
+        return encoded
+
+    lengths = np.fromiter(map(len, normalized), dtype=np.int64, count=len(normalized))
+    chars = np.array(normalized, dtype=f"U{max(int(lengths.max()), 1)}")
+    codes = chars.view(np.uint32).reshape(len(normalized), -1)
+
+    ids = table[np.minimum(codes, len(table) - 1)]
+    ids[codes >= len(table)] = OOV_ID
+
+    # Keep real characters only (numpy pads with NUL), minus the dropped ones
+    keep = np.arange(codes.shape[1]) < lengths[:, None]
+    keep &= ids >= 0
+    positions = np.cumsum(keep, axis=1) - 1
+    keep &= positions < SEQUENCE_LENGTH
+
+    rows, cols = np.nonzero(keep)
+    encoded[rows, positions[rows, cols]] = ids[rows, cols]
+    return encoded
+
+
+def score_urls(urls, predict, table, cache=None, stats=None, lexical=None,
+               low=PREFILTER_LOW, high=PREFILTER_HIGH):
+    """Returns the (N, 1) scores of a list of URLs.
+
+    Each distinct normalized URL goes through the model at most once, and
+    only when the verdict cache doesn't already have it. With a lexical
+    pre-filter, misses scoring outside [low, high] keep the lexical score
+    and never reach the model; only model verdicts are cached.
+    """
+    t = time.perf_counter()
+    normalized = normalize_urls(urls)
+    distinct = list(dict.fromkeys(normalized))
+    verdicts = cache.get_many(distinct) if cache is not None else {}
+    misses = [url for url in distinct if url not in verdicts]
+    preprocess_time = time.perf_counter() - t
+    scored_urls.inc(len(distinct) - len(misses), tier="cache")
+
+    if misses and lexical is not None:
+        t = time.perf_counter()
+        lexical_scores = lexical.predict(misses)
+        uncertain = in_band(lexical_scores, low, high)
+        verdicts.update(
+            (url, score) for url, score, keep in
+            zip(misses, lexical_scores.tolist(), uncertain.tolist()) if not keep
+        )
+        misses = [url for url, keep in zip(misses, uncertain.tolist()) if keep]
+        elapsed = time.perf_counter() - t
+        prefilter_seconds.observe(elapsed)
+        scored_urls.inc(len(uncertain) - len(misses), tier="prefilter")
+        if stats is not None:
+            stats.record("prefilter", elapsed)
+            stats.prefiltered += len(uncertain) - len(misses)
+
+    if misses:
+        t = time.perf_counter()
+        encoded = encode_normalized(misses, table)
+        elapsed = time.perf_counter() - t
+        preprocess_time += elapsed
+        if stats is not None:
+            stats.record("encode", elapsed)
+        t = time.perf_counter()
+        predictions = predict(encoded)[:, 0]
+        elapsed = time.perf_counter() - t
+        predict_seconds.observe(elapsed)
+        scored_urls.inc(len(misses), tier="model")
+        if stats is not None:
+            stats.record("predict", elapsed)
+            stats.model_urls += len(misses)
+        fresh = dict(zip(misses, predictions.tolist()))
+        if cache is not None:
+            cache.put_many(fresh)
+        verdicts.update(fresh)
+
+    preprocess_seconds.observe(preprocess_time)
+    return np.array([verdicts[url] for url in normalized], dtype=np.float32).reshape(-1, 1)
+
+
+def decode_urls(data):
+    """Decodes a Pub/Sub payload (plain, gzip or zstd) into its list of URLs, without wildcards."""
+    with decode_seconds.time():
+        urls = decode_payload(data)
+    with filter_seconds.time():
+        return drop_wildcards(urls)
+
+
+def message_trace_id(attributes):
+    """The producer's trace ID from Pub/Sub message attributes, or ""."""
+    return (attributes or {}).get(TRACE_ATTRIBUTE, "")
+
+
+def build_columns(urls, predictions, trace_ids=None):
+    """Turns model predictions into a column batch of BigQuery rows.
+
+    Thresholding and rounding run on the whole array, and every row of the
+    batch shares one timestamp (epoch microseconds). trace_ids, one per
+    URL, adds the trace_id column.
+    """
+    scores = predictions[:, 0].astype(np.float64)
+    columns = {
+        "url": np.array(urls, dtype=object),
+        "score": np.round(scores, 2),
+        "classification": np.where(scores > THRESHOLD, "MALICIOUS", "BENIGN"),
+        "time_added": np.full(len(urls), time.time_ns() // 1000, dtype=np.int64),
+    }
+    if trace_ids is not None:
+        columns["trace_id"] = np.array(trace_ids, dtype=object)
+    return columns
+
+
 def process_pubsub(event, _):
     """Triggered from a Pub/Sub message."""
-    log("=== Function triggered ===")
+    metrics.start_exporter()
+    started = time.perf_counter()
+    trace_id = message_trace_id(event.get("attributes"))
+    trace = f" [trace {trace_id}]" if trace_id else ""
 
     try:
-        log("Decoding Pub/Sub message...")
-        pubsub_message = base64.b64decode(event["data"]).decode("utf-8")
-        data = json.loads(pubsub_message)
-        url_list = data.get("urls", [])
-        log(f"Received {len(url_list)} URLs.")
-
+        with decode_seconds.time():
+            url_list = decode_payload(base64.b64decode(event["data"]))
         if not url_list:
-            log("No URLs found in message, exiting.")
+            log_sampled("empty", f"No URLs found in message, exiting.{trace}")
             return
 
         # Filter wildcards
-        filtered_urls = [u for u in url_list if not u.startswith("*.")]
-        log(f"{len(filtered_urls)} URLs after filtering wildcards.")
+        with filter_seconds.time():
+            filtered_urls = drop_wildcards(url_list)
 
-        model = get_model()
-        if model is None:
+        predict, table = get_predictor()
+        if predict is None:
             log("Model not available, aborting.")
             return
 
-        bq_client = get_bigquery_client()
-        if bq_client is None:
-            log("BigQuery client not available, aborting.")
+        row_writer = get_writer()
+        if row_writer is None:
+            log("Sink not available, aborting.")
             return
 
-        rows_to_insert = []
+        cache = get_verdict_cache()
+        lexical = get_prefilter()
+        batches = []
 
         for url_batch in create_batches(filtered_urls, BATCH_SIZE):
-            log(f"Processing batch of {len(url_batch)} URLs...")
-
-            processed_batch = [preprocess_url(url) for url in url_batch]
-            processed_batch = np.array(processed_batch, dtype=object)
-
-            log("Running model prediction...")
-            predictions = model.predict(processed_batch, verbose=0)
-            log("Model prediction complete.")
-
-            for url, prediction in zip(url_batch, predictions):
-                score = float(prediction[0])
-                label = "MALICIOUS" if score > THRESHOLD else "BENIGN"
-                rows_to_insert.append({
-                    "url": url,
-                    "score": round(score, 2),
-                    "classification": label,
-                    "time_added": datetime.datetime.now(datetime.UTC).isoformat()
-                })
-
-        if rows_to_insert:
-            log(f"Inserting {len(rows_to_insert)} rows into BigQuery...")
-            errors = bq_client.insert_rows_json(table_ref, rows_to_insert)
-            if errors:
-                log(f"BigQuery insert errors: {errors}")
-            else:
-                log("Inserted successfully.")
-        else:
-            log("No rows to insert.")
+            predictions = score_urls(url_batch, predict, table, cache, lexical=lexical)
+            trace_ids = [trace_id] * len(url_batch) if TRACE_IDS else None
+            batches.append(build_columns(url_batch, predictions, trace_ids))
+
+        status = "no rows"
+        if batches:
+            columns = concat_columns(batches)
+            statuses = []
+            row_writer.submit(columns, statuses.append)
+            update_sketches(columns)
+            # The instance may be frozen once the function returns
+            row_writer.flush()
+            status = statuses[0] if statuses else "pending"
+            if status != WRITTEN:
+                log(f"Write of {len(columns['url'])} rows to {SINK} finished as {status}.{trace}")
+
+        log_sampled("batch", f"Scored {len(filtered_urls)} of {len(url_list)} URLs in "
+                             f"{(time.perf_counter() - started) * 1000:.0f} ms, write {status}.{trace}")
+
+    except Exception as e:
+        log(f"ERROR during processing: {e}{trace}")
+
+
+class LocalMessage:
+    """In-memory stand-in for a Pub/Sub message, for running the worker locally."""
+
+    def __init__(self, data, attributes=None):
+        self.data = data
+        self.attributes = attributes or {}
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
 
-        log("=== Function completed successfully ===")
+    def nack(self):
+        self.nacked = True
 
+
+class LatencyStats:
+    """Keeps the most recent per-stage latencies and reports percentiles."""
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.samples = {}
+        self.urls = 0
+        # URLs decided by the lexical pre-filter / scored by the model
+        self.prefiltered = 0
+        self.model_urls = 0
+        self.started = time.perf_counter()
+
+    def record(self, stage, seconds):
+        if stage not in self.samples:
+            self.samples[stage] = deque(maxlen=self.window)
+        self.samples[stage].append(seconds * 1000)
+
+    def summary(self):
+        """Returns {stage: {"p50": ms, "p95": ms, "p99": ms}} and URLs/s."""
+        stages = {}
+        for stage, values in list(self.samples.items()):
+            p50, p95, p99 = np.percentile(np.array(values.copy()), [50, 95, 99])
+            stages[stage] = {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2)}
+        elapsed = time.perf_counter() - self.started
+        return stages, self.urls / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        stages, urls_per_second = self.summary()
+        log(f"Throughput: {urls_per_second:.1f} URL/s over {self.urls} URLs")
+        if self.prefiltered:
+            log(f"Pre-filter decided {self.prefiltered} URLs, model scored {self.model_urls}")
+        for stage, p in stages.items():
+            log(f"  {stage:<12} p50={p['p50']}ms p95={p['p95']}ms p99={p['p99']}ms")
+
+
+def collect_batch(inbox, max_urls, max_latency, stop_event):
+    """Blocks for the first message, then fills a micro-batch until it holds
+    max_urls URLs or max_latency seconds have passed since the first one.
+
+    Returns a list of (received_at, message, urls).
+    """
+    pending = []
+    while not pending:
+        if stop_event.is_set():
+            return pending
+        try:
+            pending.append(inbox.get(timeout=0.5))
+        except queue.Empty:
+            continue
+
+    deadline = time.perf_counter() + max_latency
+    url_count = len(pending[0][2])
+    while url_count < max_urls:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            item = inbox.get(timeout=remaining)
+        except queue.Empty:
+            break
+        pending.append(item)
+        url_count += len(item[2])
+    return pending
+
+
+def process_batch(pending, predict, table, cache, row_writer, stats, lexical=None):
+    """Scores one micro-batch with a single forward pass and hands the rows to
+    the writer. Its messages are acked once the rows are written (or spilled
+    to the dead-letter file), and nacked if even that fails."""
+    batch_start = time.perf_counter()
+    for received_at, _, _ in pending:
+        stats.record("queue_wait", batch_start - received_at)
+
+    urls = [url for _, _, message_urls in pending for url in message_urls]
+    trace_ids = None
+    if TRACE_IDS:
+        trace_ids = []
+        for _, message, message_urls in pending:
+            trace_ids.extend([message_trace_id(getattr(message, "attributes", None))] * len(message_urls))
+    columns = build_columns(urls, score_urls(urls, predict, table, cache, stats, lexical), trace_ids) if urls else None
+    submitted = time.perf_counter()
+    stats.record("batch", submitted - batch_start)
+    stats.urls += len(urls)
+
+    def on_done(status):
+        done = time.perf_counter()
+        stats.record("write", done - submitted)
+        if status == FAILED:
+            log(f"Write failed, nacking {len(pending)} messages.")
+            for _, message, _ in pending:
+                message.nack()
+            return
+        for received_at, message, _ in pending:
+            message.ack()
+            stats.record("end_to_end", done - received_at)
+
+    row_writer.submit(columns, on_done)
+    # After the submit, so the write is not held up by it
+    update_sketches(columns)
+
+
+def subscribe(inbox):
+    """Starts a streaming pull on SUBSCRIPTION_ID feeding the inbox queue."""
+    from google.cloud import pubsub_v1
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
+    flow_control = pubsub_v1.types.FlowControl(max_messages=WORKER_MAX_OUTSTANDING)
+    log(f"Subscribing to {subscription_path}...")
+    return subscriber.subscribe(
+        subscription_path,
+        callback=lambda message: enqueue(inbox, message),
+        flow_control=flow_control,
+    )
+
+
+def enqueue(inbox, message):
+    """Decodes a message and puts it on the worker inbox with its arrival time."""
+    received_at = time.perf_counter()
+    try:
+        urls = decode_urls(message.data)
     except Exception as e:
-        log(f"ERROR during processing: {e}")
+        log(f"Dropping undecodable message: {e}")
+        message.ack()
+        return
+    inbox.put((received_at, message, urls))
+
+
+def report_cache(cache):
+    """Logs the verdict cache counters and purges expired shared verdicts."""
+    if cache is None:
+        return
+    log(f"Verdict cache: {cache.stats()}")
+    if cache.store is not None:
+        try:
+            cache.store.purge_expired()
+        except Exception as e:
+            log(f"ERROR purging shared verdict cache: {e}")
+
+
+def run_worker(inbox=None, sink=None, stop_event=None,
+               max_urls=WORKER_MAX_BATCH_URLS, max_latency_ms=WORKER_MAX_LATENCY_MS,
+               report_interval=WORKER_REPORT_INTERVAL):
+    """Long-lived scoring loop with micro-batching.
+
+    Pulls from the Pub/Sub subscription, or from the given inbox queue (fill
+    it with enqueue(inbox, LocalMessage(data)) to run locally), and writes to
+    the given sink or the configured SINK. A batch that raises is nacked
+    and the loop goes on. Returns the LatencyStats once stop_event is set.
+    """
+    stop_event = stop_event or threading.Event()
+    stats = LatencyStats()
+
+    predict, table = get_predictor()
+    if predict is None:
+        log("Model not available, aborting.")
+        return stats
+    cache = get_verdict_cache()
+    lexical = get_prefilter()
+    if sink is not None:
+        row_writer = BufferedWriter(
+            sink, max_rows=SINK_MAX_ROWS, max_latency=SINK_MAX_LATENCY_MS / 1000,
+            max_attempts=SINK_MAX_ATTEMPTS, dead_letter_path=DEAD_LETTER_PATH, log=log,
+        )
+    else:
+        row_writer = get_writer()
+    if row_writer is None:
+        log("Sink not available, aborting.")
+        return stats
+
+    streaming_pull = None
+    if inbox is None:
+        inbox = queue.Queue()
+        streaming_pull = subscribe(inbox)
+    inbox_depth.set_function(inbox.qsize)
+    metrics.start_exporter()
+
+    log(f"Worker started (max {max_urls} URLs or {max_latency_ms} ms per batch).")
+    last_report = time.perf_counter()
+    try:
+        while not stop_event.is_set():
+            pending = collect_batch(inbox, max_urls, max_latency_ms / 1000, stop_event)
+            if pending:
+                try:
+                    process_batch(pending, predict, table, cache, row_writer, stats, lexical)
+                except Exception as e:
+                    failed_batches.inc()
+                    log(f"ERROR scoring a batch, nacking its {len(pending)} messages: {e!r}")
+                    for _, message, _ in pending:
+                        message.nack()
+            if time.perf_counter() - last_report >= report_interval:
+                stats.report()
+                report_cache(cache)
+                last_report = time.perf_counter()
+    except KeyboardInterrupt:
+        log("Shutting down worker...")
+    finally:
+        if streaming_pull is not None:
+            streaming_pull.cancel()
+        if sink is not None:
+            # Ours alone, unlike the shared get_writer()
+            row_writer.close()
+        else:
+            row_writer.flush()
+        update_sketches(None, force_snapshot=True)
+        log(f"Writer: {row_writer.stats()}")
+        stats.report()
+        report_cache(cache)
+    return stats
+
+
+record_startup("module_import", MODULE_IMPORT_START)
+if STARTUP_MODE == "prewarm":
+    prewarm()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["export"]:
+        export_serving_model()
+    else:
+        run_worker()
@@ -0,0 +1,332 @@
+"""Multi-process CPU inference: one model replica per process.
+
+Each replica is a spawned process running evaluating_url.get_predictor()
+with its own intra-op/inter-op thread counts and, optionally, pinned to a
+set of cores. Batches are handed over through one pair of shared memory
+blocks per replica (the int32 id matrix in, the float32 scores out); only
+the row count travels over the control pipe.
+
+InferencePool is called like a BucketedPredictor. A batch is split into
+chunks across the idle replicas, so one caller gets the replicas working
+on it in parallel and several callers (threads) share them.
+"""
+import os
+import queue
+import threading
+import time
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Smallest chunk worth sending to a separate replica
+MIN_CHUNK_ROWS = 32
+# Times a chunk is resubmitted after the replica scoring it died
+CHUNK_RETRIES = 1
+READY_TIMEOUT = float(os.environ.get("INFERENCE_READY_TIMEOUT", 300))
+
+# Only one pool at a time may rewrite os.environ for its children
+_spawn_lock = threading.Lock()
+
+
+def parse_cpu_list(spec):
+    """"0-3,8" -> {0, 1, 2, 3, 8}."""
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def plan_affinity(spec, replicas):
+    """CPU sets per replica for INFERENCE_CPU_AFFINITY.
+
+    "" leaves scheduling to the OS, "auto" splits the usable cores evenly
+    between the replicas, and "0-3;4-7" gives explicit sets, one per replica.
+    """
+    if not spec or not hasattr(os, "sched_getaffinity"):
+        return [None] * replicas
+    if spec == "auto":
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) < replicas:
+            # Fewer cores than replicas: share them round-robin
+            return [{cores[i % len(cores)]} for i in range(replicas)]
+        per_replica = len(cores) // replicas
+        return [set(cores[i * per_replica:(i + 1) * per_replica]) for i in range(replicas)]
+    sets = [parse_cpu_list(part) for part in spec.split(";")]
+    if len(sets) != replicas:
+        raise ValueError(f"INFERENCE_CPU_AFFINITY has {len(sets)} CPU sets for {replicas} replicas")
+    return sets
+
+
+def replica_main(conn, input_name, output_name, max_rows, sequence_length, cpus):
+    """Entry point of a replica process."""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    # Imported here so the thread settings in the environment apply
+    import evaluating_url
+
+    inputs = SharedMemory(name=input_name)
+    outputs = SharedMemory(name=output_name)
+    ids = np.ndarray((max_rows, sequence_length), dtype=np.int32, buffer=inputs.buf)
+    scores = np.ndarray((max_rows, 1), dtype=np.float32, buffer=outputs.buf)
+    try:
+        predict, table = evaluating_url.get_predictor()
+        if predict is None:
+            conn.send(("error", "model not available"))
+            return
+        conn.send(("ready", table))
+        while True:
+            rows = conn.recv()
+            if rows is None:
+                break
+            start = time.perf_counter()
+            try:
+                scores[:rows] = predict(ids[:rows])
+                conn.send(("ok", time.perf_counter() - start))
+            except Exception as e:
+                conn.send(("error", repr(e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del ids, scores
+        inputs.close()
+        outputs.close()
+
+
+class ReplicaDied(RuntimeError):
+    """A chunk kept killing the replicas it was sent to."""
+
+
+class Replica:
+    """Parent-side handle of one replica process and its shared buffers."""
+
+    def __init__(self, context, index, max_rows, sequence_length, cpus):
+        self.index = index
+        self.max_rows = max_rows
+        self.inputs = SharedMemory(create=True, size=max_rows * sequence_length * 4)
+        self.outputs = SharedMemory(create=True, size=max_rows * 4)
+        self.ids = np.ndarray((max_rows, sequence_length), dtype=np.int32, buffer=self.inputs.buf)
+        self.scores = np.ndarray((max_rows, 1), dtype=np.float32, buffer=self.outputs.buf)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=replica_main, name=f"inference-replica-{index}", daemon=True,
+            args=(child_conn, self.inputs.name, self.outputs.name, max_rows, sequence_length, cpus),
+        )
+        self.process.start()
+        child_conn.close()
+        self.rows = 0
+
+    def submit(self, chunk):
+        self.rows = len(chunk)
+        self.ids[:self.rows] = chunk
+        self.conn.send(self.rows)
+
+    def result(self):
+        status, value = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Replica {self.index} failed: {value}")
+        return self.scores[:self.rows].copy(), value
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        del self.ids, self.scores
+        for block in (self.inputs, self.outputs):
+            block.close()
+            block.unlink()
+
+
+class InferencePool:
+    """N model replicas in separate processes, called like a predictor.
+
+    Raises RuntimeError if a replica fails to load the model. A replica
+    whose process dies is respawned before it is handed out again; if that
+    fails too it is dropped, and calls fail once no replica is left. The
+    chunk a replica died on is resubmitted CHUNK_RETRIES times before the
+    call raises ReplicaDied.
+    """
+
+    def __init__(self, replicas, intra_op=1, inter_op=1, affinity="", max_rows=512,
+                 sequence_length=200, log=print):
+        self.max_rows = max_rows
+        self.sequence_length = sequence_length
+        self.log = log
+        self.table = None
+        self.replicas = []
+        self.idle = queue.Queue()
+        # Guards the replica list and the counters, updated by every caller
+        self.lock = threading.Lock()
+        self.busy_seconds = 0.0
+        self.calls = 0
+        self.respawns = 0
+        self.context = get_context("spawn")
+        self.cpu_sets = plan_affinity(affinity, replicas)
+        self.threads = f"{intra_op} intra-op / {inter_op} inter-op threads"
+        self.environment = {
+            # Read by evaluating_url in the replica, which loads the model
+            # in-process with these thread counts. Prewarming is the parent's
+            # business.
+            "INFERENCE_REPLICAS": "0",
+            "INFERENCE_INTRA_OP_THREADS": str(intra_op),
+            "INFERENCE_INTER_OP_THREADS": str(inter_op),
+            "TFLITE_NUM_THREADS": str(intra_op),
+            "OMP_NUM_THREADS": str(intra_op),
+            "STARTUP_MODE": "lazy",
+        }
+        try:
+            for index in range(replicas):
+                self.replicas.append(self.spawn(index))
+            for replica in self.replicas:
+                self.wait_ready(replica)
+                self.idle.put(replica)
+        except BaseException:
+            self.close()
+            raise
+
+    def spawn(self, index):
+        """Starts replica index with the pool's thread settings in its environment."""
+        with _spawn_lock:
+            saved = {name: os.environ.get(name) for name in self.environment}
+            os.environ.update(self.environment)
+            try:
+                return Replica(self.context, index, self.max_rows, self.sequence_length, self.cpu_sets[index])
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+
+    def wait_ready(self, replica):
+        if not replica.conn.poll(READY_TIMEOUT):
+            raise RuntimeError(f"Replica {replica.index} not ready after {READY_TIMEOUT:.0f}s")
+        status, value = replica.conn.recv()
+        if status != "ready":
+            raise RuntimeError(f"Replica {replica.index} failed to start: {value}")
+        self.table = value
+        cpus = self.cpu_sets[replica.index]
+        pinned = f", CPUs {sorted(cpus)}" if cpus else ""
+        self.log(f"Inference replica {replica.index} ready (pid {replica.process.pid}, {self.threads}{pinned}).")
+
+    def release(self, replica, died=False):
+        """Puts a replica back on the idle queue, respawning it first if its
+        process died (or its pipe broke, when died is set)."""
+        if not died and replica.process.is_alive():
+            self.idle.put(replica)
+            return
+        replica.process.join(timeout=1)
+        self.log(f"Inference replica {replica.index} died (exit code {replica.process.exitcode}), respawning.")
+        replica.close()
+        try:
+            fresh = self.spawn(replica.index)
+            try:
+                self.wait_ready(fresh)
+            except BaseException:
+                fresh.close()
+                raise
+        except Exception as e:
+            with self.lock:
+                self.replicas.remove(replica)
+            self.log(f"Dropped inference replica {replica.index}: {e}")
+            return
+        with self.lock:
+            self.replicas[self.replicas.index(replica)] = fresh
+            self.respawns += 1
+        self.idle.put(fresh)
+
+    def acquire(self, block):
+        """An idle replica; raises queue.Empty if none is idle and block is False."""
+        while True:
+            if not self.replicas:
+                raise RuntimeError("No inference replicas left")
+            try:
+                return self.idle.get(block=block, timeout=1 if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+
+    def chunk_rows(self, size):
+        """Rows per chunk: spread over the replicas, within the shared buffers."""
+        per_replica = -(-size // max(len(self.replicas), 1))
+        return min(self.max_rows, max(MIN_CHUNK_ROWS, per_replica))
+
+    def __call__(self, encoded):
+        scores = np.empty((len(encoded), 1), dtype=np.float32)
+        if not len(encoded):
+            return scores
+        rows = self.chunk_rows(len(encoded))
+        pending = []
+
+        def retry(replica, start, attempt, error):
+            """Respawns a replica that died on a chunk and resubmits the chunk."""
+            self.release(replica, died=True)
+            if attempt >= CHUNK_RETRIES:
+                raise ReplicaDied(f"Inference replica {replica.index} died on rows {start}-"
+                                  f"{min(start + rows, len(encoded)) - 1} {attempt + 1} times") from error
+            submit(start, attempt + 1)
+
+        def submit(start, attempt=0):
+            while True:
+                try:
+                    # Only block on other callers when holding no replica
+                    replica = self.acquire(block=not pending)
+                    break
+                except queue.Empty:
+                    collect()
+            try:
+                replica.submit(encoded[start:start + rows])
+            except (EOFError, OSError) as e:
+                retry(replica, start, attempt, e)
+                return
+            except BaseException:
+                self.release(replica)
+                raise
+            pending.append((replica, start, attempt))
+
+        def collect():
+            replica, start, attempt = pending.pop(0)
+            try:
+                result, seconds = replica.result()
+            except (EOFError, OSError) as e:
+                retry(replica, start, attempt, e)
+                return
+            except BaseException:
+                self.release(replica)
+                raise
+            self.release(replica)
+            scores[start:start + len(result)] = result
+            with self.lock:
+                self.busy_seconds += seconds
+
+        try:
+            for start in range(0, len(encoded), rows):
+                submit(start)
+            while pending:
+                collect()
+        finally:
+            # On error, drain what was submitted so the replicas stay usable
+            for replica, _, _ in pending:
+                try:
+                    replica.result()
+                except Exception:
+                    pass
+                self.release(replica)
+        with self.lock:
+            self.calls += 1
+        return scores
+
+    def close(self):
+        with self.lock:
+            replicas, self.replicas = self.replicas, []
+        for replica in replicas:
+            replica.close()
@@ -0,0 +1,288 @@
+"""Process-local metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are registered once at import time by the
+modules that update them, and cost a lock and a few additions per update.
+start_exporter() publishes them:
+
+    METRICS_PORT=9100       GET http://host:9100/metrics
+    METRICS_FILE=/path.prom rewritten every METRICS_PUSH_INTERVAL seconds,
+                            for node_exporter's textfile collector or a sidecar
+
+LogSampler replaces per-batch prints: a message key is logged at most once
+per LOG_SAMPLE_INTERVAL seconds, with the number of messages suppressed
+since (LOG_SAMPLE_INTERVAL=0 logs everything).
+
+new_trace_id() tags a payload; the producers send it as the "trace_id"
+Pub/Sub attribute and, with TRACE_IDS=1, the scorer writes it next to each
+row so a URL can be followed from the producer log to its BigQuery row.
+"""
+import bisect
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+METRICS_PUSH_INTERVAL = float(os.environ.get("METRICS_PUSH_INTERVAL", "15"))
+LOG_SAMPLE_INTERVAL = float(os.environ.get("LOG_SAMPLE_INTERVAL", "10"))
+TRACE_IDS = os.environ.get("TRACE_IDS", "0") == "1"
+TRACE_ATTRIBUTE = "trace_id"
+
+# Seconds, from sub-millisecond encodes to multi-second sink retries
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = {}
+registry_lock = threading.Lock()
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value set directly, or read from a callback when rendered."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.callbacks = {}
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        """Renders fn() as the value; replaces any earlier callback for these labels."""
+        with self.lock:
+            self.callbacks[self.key(labels)] = fn
+
+    def render(self):
+        with self.lock:
+            callbacks = list(self.callbacks.items())
+        for key, fn in callbacks:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            with self.lock:
+                self.values[key] = value
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, with +Inf last, then sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(self.labels, key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total!r}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Timer:
+    """Context manager observing the elapsed seconds into a histogram."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def register(cls, name, documentation, labels=(), **kwargs):
+    """Returns the metric called name, creating it on first use."""
+    with registry_lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = cls(name, documentation, labels, **kwargs)
+        return metric
+
+
+def counter(name, documentation, labels=()):
+    return register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    return register(Gauge, name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    return register(Histogram, name, documentation, labels, buckets=buckets)
+
+
+def render():
+    with registry_lock:
+        metrics = list(registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="0.0.0.0"):
+    """Serves /metrics from a background thread and returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def write_file(path):
+    """Writes the metrics to path atomically."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def push_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_file(path)
+        except OSError as e:
+            print(f"Failed to write metrics to {path}: {e}", flush=True)
+
+
+exporter_lock = threading.Lock()
+exporter_started = False
+
+
+def start_exporter(port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_PUSH_INTERVAL):
+    """Starts the configured exporters once per process; a no-op when neither is set."""
+    global exporter_started
+    with exporter_lock:
+        if exporter_started:
+            return
+        exporter_started = True
+    if port:
+        serve(port)
+        print(f"Serving metrics on http://0.0.0.0:{port}/metrics", flush=True)
+    if path:
+        threading.Thread(target=push_loop, args=(path, interval),
+                         name="metrics-push", daemon=True).start()
+        print(f"Writing metrics to {path} every {interval:g}s", flush=True)
+
+
+class LogSampler:
+    """Lets a message key through at most once per interval, counting the rest."""
+
+    def __init__(self, interval=LOG_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = {}
+        self.suppressed = {}
+
+    def __call__(self, key, message, log=print):
+        if self.interval > 0:
+            now = time.monotonic()
+            with self.lock:
+                last = self.last.get(key)
+                if last is not None and now - last < self.interval:
+                    self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                    return False
+                self.last[key] = now
+                suppressed = self.suppressed.pop(key, 0)
+            if suppressed:
+                message = f"{message} ({suppressed} similar suppressed)"
+        log(message)
+        return True
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
@@ -0,0 +1,50 @@
+"""Builds code_and_model.zip, the Cloud Function source terraform uploads.
+
+The function runs evaluating_url.py (GOOGLE_FUNCTION_SOURCE in
+terraform/main.tf), so the zip holds it, the local modules it imports, the
+model and the requirements files the build installs. Rebuild it after
+changing any of them, before terraform apply:
+
+    python package_function.py
+"""
+import argparse
+import os
+import zipfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FUNCTION_FILES = (
+    "evaluating_url.py",
+    # Imported by evaluating_url.py, some only on first use
+    "domains.py",
+    "inference_pool.py",
+    "metrics.py",
+    "payloads.py",
+    "prefilter.py",
+    "segments.py",
+    "sinks.py",
+    "sketches.py",
+    "summaries.py",
+    "verdict_cache.py",
+    "url_classifier_model.keras",
+    "requirements.txt",
+    # Included by requirements.txt
+    "requirements-producer.txt",
+)
+
+
+def build(output):
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name in FUNCTION_FILES:
+            archive.write(os.path.join(ROOT, name), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=os.path.join(ROOT, "code_and_model.zip"))
+    args = parser.parse_args()
+    build(args.output)
+    print(f"Wrote {args.output} ({len(FUNCTION_FILES)} files, {os.path.getsize(args.output) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Pub/Sub payloads of domains, shared by the producers and the scorer.
+
+A payload is the JSON object {"urls": [...]}, optionally compressed with
+gzip or zstd. decode_payload recognizes the compression from its magic
+bytes, so producers can change codec without redeploying the scorer.
+
+DomainBatcher coalesces the domains of many certificates into payloads
+bounded by URL count, approximate size and linger time, so one Pub/Sub
+message (and one scorer invocation) carries hundreds of domains instead of
+the handful on a single certificate.
+"""
+import gzip
+import json
+import time
+
+from domains import clean_domains
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+# Bytes of {"urls": []} and of the quotes and separator around each domain
+PAYLOAD_OVERHEAD_BYTES = 12
+DOMAIN_OVERHEAD_BYTES = 4
+
+
+def compress(data, compression):
+    if compression == "none":
+        return data
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+
+
+def decompress(data):
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def encode_payload(urls, compression="none"):
+    return compress(json.dumps({"urls": urls}).encode("utf-8"), compression)
+
+
+def decode_payload(data):
+    """Returns the URL list of a plain, gzip or zstd payload."""
+    return json.loads(decompress(data).decode("utf-8")).get("urls", [])
+
+
+class DomainBatcher:
+    """Accumulates cleaned (see domains.clean_domains), de-duplicated domains
+    into encoded payloads.
+
+    add() returns the payloads closed by max_urls or max_bytes; poll()
+    returns the pending payload once it is linger seconds old; flush()
+    returns it regardless. Each payload is (data, url_count).
+    """
+
+    def __init__(self, max_urls=500, max_bytes=64 * 1024, linger=1.0, compression="none"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.compression = compression
+        self.pending = {}
+        self.size = PAYLOAD_OVERHEAD_BYTES
+        self.started_at = None
+        self.filtered = 0
+
+    @property
+    def deadline(self):
+        """Monotonic time at which the pending payload is due, or None."""
+        return None if self.started_at is None else self.started_at + self.linger
+
+    def add(self, domains, cleaned=False):
+        """Adds domains, cleaning them first unless cleaned is set."""
+        ready = []
+        if not cleaned:
+            valid = clean_domains(domains)
+            self.filtered += len(domains) - len(valid)
+            domains = valid
+        for domain in domains:
+            if domain in self.pending:
+                continue
+            self.pending[domain] = None
+            self.size += len(domain) + DOMAIN_OVERHEAD_BYTES
+            if self.started_at is None:
+                self.started_at = time.monotonic()
+            if len(self.pending) >= self.max_urls or self.size >= self.max_bytes:
+                ready.append(self.flush())
+        return ready
+
+    def poll(self, now=None):
+        deadline = self.deadline
+        if deadline is not None and (now if now is not None else time.monotonic()) >= deadline:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.pending:
+            return None
+        urls = list(self.pending)
+        self.pending = {}
+        self.size = PAYLOAD_OVERHEAD_BYTES
+        self.started_at = None
+        return encode_payload(urls, self.compression), len(urls)
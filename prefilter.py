@@ -0,0 +1,160 @@
+"""Lexical pre-filter that decides the obvious URLs before the CNN.
+
+LexicalModel is a logistic regression over a handful of hand-built lexical
+features plus hashed character trigrams. Scoring a batch is a few NumPy
+operations on the code-point matrix of the URLs, orders of magnitude
+cheaper than a CNN forward pass. The scorer only sends URLs whose lexical
+score falls inside an uncertain band to the CNN; the rest keep the lexical
+score. train_prefilter.py fits the model and measures the recall lost and
+the CNN calls saved for a given band.
+"""
+import numpy as np
+
+NGRAM = 3
+HASH_BITS = 18
+MAX_CHARS = 200
+SPECIAL_CHARS = "@~%=?&_"
+DENSE_FEATURES = (
+    "length", "digits", "dots", "hyphens", "slashes", "specials", "vowels", "digit_runs",
+)
+
+
+def code_points(urls, max_chars=MAX_CHARS):
+    """(N, max_chars) uint32 code points of the URLs, zero-padded, and their lengths."""
+    if not urls:
+        return np.zeros((0, max_chars), dtype=np.uint32), np.zeros(0, dtype=np.int64)
+    codes = np.array([url[:max_chars] for url in urls], dtype=f"<U{max_chars}")
+    codes = codes.view(np.uint32).reshape(len(urls), max_chars)
+    return codes, np.count_nonzero(codes, axis=1)
+
+
+def dense_features(codes, lengths):
+    """Hand-built lexical features, one row per URL (see DENSE_FEATURES)."""
+    present = codes != 0
+    digits = (codes >= ord("0")) & (codes <= ord("9"))
+    specials = np.isin(codes, [ord(c) for c in SPECIAL_CHARS])
+    vowels = np.isin(codes, [ord(c) for c in "aeiou"])
+    # Digit runs: digits whose previous character isn't a digit
+    run_starts = digits.copy()
+    run_starts[:, 1:] &= ~digits[:, :-1]
+    safe_lengths = np.maximum(lengths, 1)
+    return np.stack([
+        lengths / 100.0,
+        digits.sum(axis=1) / safe_lengths,
+        (codes == ord(".")).sum(axis=1),
+        (codes == ord("-")).sum(axis=1),
+        (codes == ord("/")).sum(axis=1),
+        (specials & present).sum(axis=1),
+        vowels.sum(axis=1) / safe_lengths,
+        run_starts.sum(axis=1),
+    ], axis=1).astype(np.float32)
+
+
+def ngram_hashes(codes, lengths, n=NGRAM, bits=HASH_BITS):
+    """Hashed character n-grams: (N, max_chars - n + 1) bucket ids and a validity mask."""
+    width = codes.shape[1] - n + 1
+    h = np.zeros((codes.shape[0], width), dtype=np.uint64)
+    for i in range(n):
+        h = h * np.uint64(0x100000001B3) + codes[:, i:i + width].astype(np.uint64)
+    # Multiplicative hashing; uint64 multiplication wraps around
+    buckets = (h * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - bits)
+    valid = np.arange(width)[None, :] + n <= lengths[:, None]
+    return buckets.astype(np.int64), valid
+
+
+class LexicalModel:
+    """Logistic regression on dense lexical features and hashed trigrams."""
+
+    def __init__(self, ngram_weights, dense_weights, bias, mean, std, bits=HASH_BITS, n=NGRAM):
+        self.ngram_weights = ngram_weights.astype(np.float32)
+        self.dense_weights = dense_weights.astype(np.float32)
+        self.bias = float(bias)
+        self.mean = mean.astype(np.float32)
+        self.std = std.astype(np.float32)
+        self.bits = bits
+        self.n = n
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["ngram_weights"], data["dense_weights"], data["bias"],
+                data["mean"], data["std"], int(data["bits"]), int(data["n"]),
+            )
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f, ngram_weights=self.ngram_weights, dense_weights=self.dense_weights,
+                bias=self.bias, mean=self.mean, std=self.std, bits=self.bits, n=self.n,
+            )
+
+    def features(self, urls):
+        """Standardized dense features, n-gram buckets and mask of normalized URLs."""
+        codes, lengths = code_points(urls)
+        dense = (dense_features(codes, lengths) - self.mean) / self.std
+        buckets, valid = ngram_hashes(codes, lengths, self.n, self.bits)
+        return dense, buckets, valid
+
+    @staticmethod
+    def logits(dense, buckets, valid, ngram_weights, dense_weights, bias):
+        counts = np.maximum(valid.sum(axis=1), 1)
+        ngram_term = np.where(valid, ngram_weights[buckets], 0).sum(axis=1) / counts
+        return dense @ dense_weights + bias + ngram_term
+
+    def predict(self, urls):
+        """Probability of being malicious for each normalized URL, as float32."""
+        if not urls:
+            return np.zeros(0, dtype=np.float32)
+        dense, buckets, valid = self.features(urls)
+        z = self.logits(dense, buckets, valid, self.ngram_weights, self.dense_weights, self.bias)
+        return (1 / (1 + np.exp(-z))).astype(np.float32)
+
+
+def fit(urls, labels, epochs=5, batch_size=4096, learning_rate=0.05, l2=1e-6, bits=HASH_BITS, seed=42, log=print):
+    """Trains a LexicalModel with mini-batch Adam on binary labels."""
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels, dtype=np.float32)
+    codes, lengths = code_points(urls)
+    dense = dense_features(codes, lengths)
+    mean = dense.mean(axis=0)
+    std = dense.std(axis=0) + 1e-6
+    dense = (dense - mean) / std
+    buckets, valid = ngram_hashes(codes, lengths, NGRAM, bits)
+
+    params = [np.zeros(2 ** bits, dtype=np.float32), np.zeros(dense.shape[1], dtype=np.float32),
+              np.zeros(1, dtype=np.float32)]
+    moments = [np.zeros_like(p) for p in params]
+    velocities = [np.zeros_like(p) for p in params]
+    step = 0
+    for epoch in range(epochs):
+        order = rng.permutation(len(urls))
+        loss = 0.0
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            b, v, d, y = buckets[idx], valid[idx], dense[idx], labels[idx]
+            z = LexicalModel.logits(d, b, v, params[0], params[1], params[2][0])
+            p = 1 / (1 + np.exp(-z))
+            loss += float(-(y * np.log(p + 1e-7) + (1 - y) * np.log(1 - p + 1e-7)).sum())
+            g = (p - y) / len(idx)
+            per_ngram = np.repeat(g / np.maximum(v.sum(axis=1), 1), v.shape[1]).reshape(v.shape)
+            grads = [
+                np.bincount(b[v], weights=per_ngram[v], minlength=2 ** bits).astype(np.float32)
+                + l2 * params[0],
+                d.T @ g + l2 * params[1],
+                np.array([g.sum()], dtype=np.float32),
+            ]
+            step += 1
+            for param, grad, m, s in zip(params, grads, moments, velocities):
+                m *= 0.9
+                m += 0.1 * grad
+                s *= 0.999
+                s += 0.001 * grad * grad
+                param -= learning_rate * (m / (1 - 0.9 ** step)) / (np.sqrt(s / (1 - 0.999 ** step)) + 1e-8)
+        log(f"Epoch {epoch + 1}/{epochs}: log loss {loss / len(urls):.4f}")
+    return LexicalModel(params[0], params[1], params[2][0], mean, std, bits, NGRAM)
+
+
+def in_band(scores, low, high):
+    """Mask of the lexical scores that are uncertain, i.e. still need the CNN."""
+    return (scores >= low) & (scores <= high)
@@ -1,10 +1,28 @@
+"""Certstream -> Pub/Sub producer.
+
+A receiver task reads certificate updates from the Certstream WebSocket,
+filters their domains and coalesces them into payloads of up to
+PAYLOAD_MAX_URLS domains / PAYLOAD_MAX_BYTES bytes, or whatever arrived in
+PAYLOAD_LINGER_MS. Payloads go on a bounded queue. A pool of publisher
+tasks takes them off the queue and publishes them to Pub/Sub, paced by a
+token bucket, so a slow publish never stalls the WebSocket. When the queue
+is full, DROP_POLICY decides what happens to a new payload:
+
+    block        the receiver waits, pushing back on the WebSocket (default)
+    drop-newest  the new payload is discarded
+    drop-oldest  the oldest queued payload is discarded to make room
+
+Dropping loses certificates for good, so it is opt-in, for deployments
+that prefer fresh domains over complete ones.
+"""
+import asyncio
 import json
 import os
-import time
-import atexit
 import threading
-import websocket
-from itertools import count
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import websockets
 from google.cloud import pubsub_v1
 from google.cloud.pubsub_v1.types import (
     LimitExceededBehavior,
@@ -12,13 +30,33 @@ from google.cloud.pubsub_v1.types import (
     PublishFlowControl,
 )
 
+import metrics
+from metrics import TRACE_ATTRIBUTE, TRACE_IDS, LogSampler, new_trace_id
+from payloads import DomainBatcher
+
 # GCP Project details
 PROJECT_ID = os.environ.get("PROJECT_ID", "hip-host-475008-d5")
 TOPIC_ID = "urlstream"
-WS_URL = "ws://localhost:8080/"
-PING_INTERVAL = 30 
+WS_URL = os.environ.get("WS_URL", "ws://localhost:8080/")
+PING_INTERVAL = 30
+RECONNECT_DELAY = 5
+
+# Pipeline between the receiver and the publishers
+QUEUE_SIZE = int(os.environ.get("PRODUCER_QUEUE_SIZE", "1000"))
+PUBLISHER_WORKERS = int(os.environ.get("PRODUCER_WORKERS", "4"))
+DROP_POLICY = os.environ.get("PRODUCER_DROP_POLICY", "block")
+DROP_POLICIES = ("block", "drop-newest", "drop-oldest")
+REPORT_INTERVAL = 30
 
-counter = count()
+# Coalescing of certificate domains into Pub/Sub payloads
+PAYLOAD_MAX_URLS = int(os.environ.get("PAYLOAD_MAX_URLS", "500"))
+PAYLOAD_MAX_BYTES = int(os.environ.get("PAYLOAD_MAX_BYTES", str(64 * 1024)))
+PAYLOAD_LINGER_MS = float(os.environ.get("PAYLOAD_LINGER_MS", "1000"))
+PAYLOAD_COMPRESSION = os.environ.get("PAYLOAD_COMPRESSION", "none")  # none, gzip or zstd
+
+# Token bucket: payloads per second on average, bursts of up to TARGET_BURST
+TARGET_RATE = float(os.environ.get("TARGET_RATE", "50"))
+TARGET_BURST = int(os.environ.get("TARGET_BURST", str(max(int(TARGET_RATE), 1))))
 
 # Batch and flow control
 batch_settings = pubsub_v1.types.BatchSettings(
@@ -33,95 +71,241 @@ flow_control_settings = PublishFlowControl(
     limit_exceeded_behavior=LimitExceededBehavior.BLOCK,
 )
 
-publisher = pubsub_v1.PublisherClient(
-    batch_settings=batch_settings,
-    publisher_options=PublisherOptions(flow_control=flow_control_settings)
+
+certificates_total = metrics.counter("producer_certificates_total", "Certificate updates received")
+domains_total = metrics.counter("producer_domains_total", "Domains handed to the publish queue")
+payloads_total = metrics.counter("producer_payloads_total", "Payloads by outcome", ("status",))
+publish_seconds = metrics.histogram(
+    "producer_publish_latency_seconds", "Time from publish() to the Pub/Sub acknowledgement"
 )
+queue_depth = metrics.gauge("producer_queue_depth", "Payloads waiting for a publisher task")
+log_sampled = LogSampler()
 
-topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
 
-TARGET_RATE = 50
-SLEEP_BETWEEN_BATCHES = 1.0 / TARGET_RATE
+def create_publisher():
+    return pubsub_v1.PublisherClient(
+        batch_settings=batch_settings,
+        publisher_options=PublisherOptions(flow_control=flow_control_settings)
+    )
 
-# Callback for async publish
-def on_publish_done(future):
-    try:
-        future.result()
-    except Exception as e:
-        print(f"Publish failed: {e}", flush=True)
 
-# Certstream message handler
-def handle_cert_message(message):
-    """Parse a Certstream message and push to Pub/Sub."""
-    try:
-        msg = json.loads(message)
-        if msg.get("message_type") != "certificate_update":
+class TokenBucket:
+    """Lets through rate events per second on average, in bursts of up to capacity.
+
+    A rate of 0 or less disables the limit.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ProducerStats:
+    """Counters shared by the receiver, the publishers and Pub/Sub callbacks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.domains = 0
+        self.dropped = 0
+        self.published = 0
+        self.failed = 0
+
+    def on_publish_done(self, future, started=None, trace_id=None):
+        trace = f" [trace {trace_id}]" if trace_id else ""
+        if started is not None:
+            publish_seconds.observe(time.perf_counter() - started)
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Publish failed: {e}{trace}", flush=True)
+            payloads_total.inc(status="failed")
+            with self.lock:
+                self.failed += 1
             return
+        payloads_total.inc(status="published")
+        with self.lock:
+            self.published += 1
 
-        all_domains = msg["data"]["leaf_cert"]["all_domains"]
-        data = json.dumps({"urls": all_domains}).encode("utf-8")
+    def report(self, queue, batcher):
+        print(f"Received {self.received} certs, {self.domains} domains ({batcher.filtered} filtered); "
+              f"published {self.published}, failed {self.failed}, dropped {self.dropped} payloads; "
+              f"queue {queue.qsize()}/{queue.maxsize}", flush=True)
 
-        future = publisher.publish(topic_path, data)
-        future.add_done_callback(on_publish_done)
 
-        n = next(counter)
-        if n % 50 == 0:
-            print(f"Published {n} cert batches", flush=True)
+def extract_domains(message):
+    """Returns the domains of a certificate_update message, or None."""
+    msg = json.loads(message)
+    if msg.get("message_type") != "certificate_update":
+        return None
+    return msg["data"]["leaf_cert"]["all_domains"]
 
-        time.sleep(SLEEP_BETWEEN_BATCHES)
 
-    except Exception as e:
-        print(f"Error handling message: {e}", flush=True)
+async def offer(queue, item, stats, policy=DROP_POLICY):
+    """Puts item on the queue, applying the drop policy when it is full."""
+    if policy == "block":
+        await queue.put(item)
+        return
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        stats.dropped += 1
+        payloads_total.inc(status="dropped")
+        if policy == "drop-oldest":
+            queue.get_nowait()
+            queue.task_done()
+            queue.put_nowait(item)
 
 
+async def ping_loop(ws):
+    while True:
+        await asyncio.sleep(PING_INTERVAL)
+        await ws.send("ping")
+        print("Sent ping", flush=True)
 
-# Use Websocket to run Certstream
-def run_websocket():
-    def on_open(ws):
-        print("Connection established to Certstream server.", flush=True)
 
-        def ping_loop():
-            while True:
+async def receive(queue, batcher, stats, ws_url=WS_URL, policy=DROP_POLICY):
+    """Coalesces Certstream updates into payloads on the queue, reconnecting on failure."""
+    while True:
+        try:
+            async with websockets.connect(ws_url, ping_interval=None) as ws:
+                print("Connection established to Certstream server.", flush=True)
+                pinger = asyncio.create_task(ping_loop(ws))
                 try:
-                    ws.send("ping")
-                    print("Sent ping", flush=True)
-                except Exception as e:
-                    print(f"Ping failed: {e}", flush=True)
-                    break
-                time.sleep(PING_INTERVAL)
-
-        threading.Thread(target=ping_loop, daemon=True).start()
+                    async for message in ws:
+                        try:
+                            domains = extract_domains(message)
+                        except Exception as e:
+                            print(f"Error handling message: {e}", flush=True)
+                            continue
+                        if domains:
+                            stats.received += 1
+                            certificates_total.inc()
+                            for payload in batcher.add(domains):
+                                stats.domains += payload[1]
+                                domains_total.inc(payload[1])
+                                await offer(queue, payload, stats, policy)
+                finally:
+                    pinger.cancel()
+            print(f"[!] WebSocket closed. Reconnecting in {RECONNECT_DELAY}s...", flush=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Connection failed: {e}. Retrying in {RECONNECT_DELAY}s...", flush=True)
+        await asyncio.sleep(RECONNECT_DELAY)
 
-    def on_message(ws, message):
-        handle_cert_message(message)
 
-    def on_error(ws, error):
-        print(f"[!] WebSocket error: {error}", flush=True)
+async def linger(queue, batcher, stats, policy=DROP_POLICY):
+    """Hands over the pending payload once it has waited the linger time."""
+    while True:
+        deadline = batcher.deadline
+        delay = batcher.linger / 4 if deadline is None else deadline - time.monotonic()
+        await asyncio.sleep(max(delay, 0.01))
+        payload = batcher.poll()
+        if payload is not None:
+            stats.domains += payload[1]
+            domains_total.inc(payload[1])
+            await offer(queue, payload, stats, policy)
 
-    def on_close(ws, close_status_code, close_msg):
-        print(f"[!] WebSocket closed ({close_status_code}): {close_msg}", flush=True)
 
+async def publish(queue, publisher, topic_path, bucket, executor, stats):
+    """Publisher task: takes payloads off the queue at the bucket's rate."""
+    loop = asyncio.get_running_loop()
     while True:
+        data, url_count = await queue.get()
         try:
-            ws = websocket.WebSocketApp(
-                WS_URL,
-                on_open=on_open,
-                on_message=on_message,
-                on_error=on_error,
-                on_close=on_close,
+            await bucket.acquire()
+            attributes = {TRACE_ATTRIBUTE: new_trace_id()} if TRACE_IDS else {}
+            started = time.perf_counter()
+            # publish() blocks the calling thread while the client's flow
+            # control limit is reached, so it runs off the event loop
+            future = await loop.run_in_executor(
+                executor, lambda: publisher.publish(topic_path, data, **attributes)
             )
-            ws.run_forever(ping_interval=None, ping_timeout=None)
+            trace_id = attributes.get(TRACE_ATTRIBUTE)
+            future.add_done_callback(lambda f: stats.on_publish_done(f, started, trace_id))
+            if trace_id:
+                log_sampled("publish", f"Published {url_count} URLs [trace {trace_id}]")
         except Exception as e:
-            print(f"Connection failed: {e}. Retrying in 5s...", flush=True)
-            time.sleep(5)
+            print(f"Error publishing: {e}", flush=True)
+        finally:
+            queue.task_done()
+
+
+async def report_loop(queue, batcher, stats, interval=REPORT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        stats.report(queue, batcher)
+
+
+async def run(publisher, topic_path, ws_url=WS_URL, queue_size=QUEUE_SIZE, workers=PUBLISHER_WORKERS,
+              policy=DROP_POLICY, rate=TARGET_RATE, burst=TARGET_BURST, batcher=None, stats=None):
+    """Runs the receiver, the publisher pool and the reporter until cancelled."""
+    if policy not in DROP_POLICIES:
+        raise ValueError(f"Unknown drop policy {policy!r}, expected one of {DROP_POLICIES}")
+    queue = asyncio.Queue(maxsize=queue_size)
+    queue_depth.set_function(queue.qsize)
+    batcher = batcher or DomainBatcher(
+        PAYLOAD_MAX_URLS, PAYLOAD_MAX_BYTES, PAYLOAD_LINGER_MS / 1000, PAYLOAD_COMPRESSION
+    )
+    bucket = TokenBucket(rate, burst)
+    stats = stats or ProducerStats()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="publisher")
+    tasks = [
+        asyncio.create_task(publish(queue, publisher, topic_path, bucket, executor, stats))
+        for _ in range(workers)
+    ]
+    tasks.append(asyncio.create_task(receive(queue, batcher, stats, ws_url, policy)))
+    tasks.append(asyncio.create_task(linger(queue, batcher, stats, policy)))
+    tasks.append(asyncio.create_task(report_loop(queue, batcher, stats)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Publish whatever is still pending or queued before shutting down
+        remaining = [queue.get_nowait() for _ in range(queue.qsize())]
+        payload = batcher.flush()
+        if payload is not None:
+            stats.domains += payload[1]
+            domains_total.inc(payload[1])
+            remaining.append(payload)
+        for data, _ in remaining:
+            publisher.publish(topic_path, data).add_done_callback(stats.on_publish_done)
+        executor.shutdown(wait=True)
+        stats.report(queue, batcher)
 
-# Flush publisher on exit
-@atexit.register
-def flush_pubsub():
-    print("Flushing Pub/Sub messages before exit...")
-    publisher.stop()
 
 # Start Certstream listener
 if __name__ == "__main__":
-    print(f"Starting Certstream producer (target: {TARGET_RATE} certs/sec)...", flush=True)
-    run_websocket()
+    metrics.start_exporter()
+    print(f"Starting Certstream producer (target: {TARGET_RATE:g} payloads/sec, burst {TARGET_BURST}, "
+          f"{PUBLISHER_WORKERS} publishers, queue {QUEUE_SIZE}, {DROP_POLICY}, "
+          f"payloads of {PAYLOAD_MAX_URLS} URLs / {PAYLOAD_LINGER_MS:g} ms, {PAYLOAD_COMPRESSION})...", flush=True)
+    publisher = create_publisher()
+    topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
+    try:
+        asyncio.run(run(publisher, topic_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Flush publisher on exit
+        print("Flushing Pub/Sub messages before exit...", flush=True)
+        publisher.stop()
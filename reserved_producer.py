@@ -1,9 +1,9 @@
-import json
 import os
+import queue
+import threading
 import time
 import atexit
-import requests
-from collections import deque
+from concurrent.futures import wait
 from itertools import count
 from google.cloud import pubsub_v1
 from google.cloud.pubsub_v1.types import (
@@ -12,6 +12,13 @@ from google.cloud.pubsub_v1.types import (
     PublishFlowControl,
 )
 
+from crtsh import CRTSH_URL, CrtShBackfill, CursorStore, TokenBucket
+from dedup import DomainDeduplicator
+import metrics
+from domains import clean_domains
+from metrics import TRACE_ATTRIBUTE, TRACE_IDS, LogSampler, new_trace_id
+from payloads import DomainBatcher
+
 # GCP Project details
 PROJECT_ID = os.environ.get("PROJECT_ID", "hip-host-475008-d5")
 TOPIC_ID = "urlstream"
@@ -39,226 +46,228 @@ publisher = pubsub_v1.PublisherClient(
 
 topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
 
+# Payloads are published from one thread at up to TARGET_RATE per second,
+# so the crt.sh workers never wait for the pacing while they hold the
+# handle lock. They only block once PUBLISH_QUEUE_SIZE payloads are waiting.
 TARGET_RATE = 10
-SLEEP_BETWEEN_BATCHES = 1.0 / TARGET_RATE
+PUBLISH_QUEUE_SIZE = 100
+
+# Domains from many certificates are coalesced into one payload
+PAYLOAD_MAX_URLS = int(os.environ.get("PAYLOAD_MAX_URLS", "500"))
+PAYLOAD_MAX_BYTES = int(os.environ.get("PAYLOAD_MAX_BYTES", str(64 * 1024)))
+PAYLOAD_LINGER_MS = float(os.environ.get("PAYLOAD_LINGER_MS", "1000"))
+PAYLOAD_COMPRESSION = os.environ.get("PAYLOAD_COMPRESSION", "none")  # none, gzip or zstd
+
+batcher = DomainBatcher(PAYLOAD_MAX_URLS, PAYLOAD_MAX_BYTES, PAYLOAD_LINGER_MS / 1000, PAYLOAD_COMPRESSION)
 
 STATE_FILE = "crt_state.json"
-RECENT_CACHE_SIZE = 20000
+DEDUP_STATE_FILE = os.path.join(os.path.dirname(STATE_FILE), "crt_dedup.npz")
+DEDUP_SAVE_INTERVAL = 60
 
-# Create a cache of 20k most recently crawled URL to prevent duplicates
-recent_domains = deque(maxlen=RECENT_CACHE_SIZE)
+# Exact set of the 20k most recently crawled domains (optionally also
+# expiring after DEDUP_TTL seconds) to prevent duplicates. A rotating Bloom
+# filter of DEDUP_BLOOM_CAPACITY domains per generation extends the window
+# to millions of domains at a fixed memory budget.
+RECENT_CACHE_SIZE = int(os.environ.get("DEDUP_WINDOW", "20000"))
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", "0")) or None
+DEDUP_BLOOM_CAPACITY = int(os.environ.get("DEDUP_BLOOM_CAPACITY", "0"))
+DEDUP_BLOOM_ERROR_RATE = float(os.environ.get("DEDUP_BLOOM_ERROR_RATE", "0.001"))
 
-def load_state():
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f:
-                data = json.load(f)
-                return data.get("max_cert_id")
-        except Exception:
-            pass
-    return None
+recent_domains = DomainDeduplicator(
+    RECENT_CACHE_SIZE, DEDUP_TTL, DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_ERROR_RATE
+)
+last_saved = time.monotonic()
 
+# crt.sh polling: one cursor per search term, concurrent queries under a
+# global rate limit. Point CRTSH_URL at crtsh_stub.py to test locally.
+CRTSH_BASE_URL = os.environ.get("CRTSH_URL", CRTSH_URL)
+CRTSH_WORKERS = int(os.environ.get("CRTSH_WORKERS", "4"))
+CRTSH_RATE = float(os.environ.get("CRTSH_RATE", "1.0"))  # requests per second
+CRTSH_BURST = int(os.environ.get("CRTSH_BURST", "2"))
 
-def save_state():
-    try:
-        with open(STATE_FILE, "w") as f:
-            json.dump({"max_cert_id": max_cert_id}, f)
-    except Exception as e:
-        print(f"Failed to save state: {e}", flush=True)
+# Common TLDs to monitor for new certificates
+tlds = ['.com', '.net', '.org', '.io', '.dev', '.app', '.co', '.ai', '.xyz']
+search_terms = [f"%{tld}" for tld in tlds]
 
+# Publishes since the last cursor checkpoint, as (future, payload), and
+# payloads whose publish failed, retried on the next flush
+outstanding = []
+failed_payloads = []
+publish_queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+publish_bucket = TokenBucket(TARGET_RATE)
 
-def is_valid_domain(d):
-    if not d or d.startswith("*."):
-        return False
-    
-    # Filter out certificate metadata (contains spaces, special phrases)
-    if any(phrase in d.lower() for phrase in [
-        "terms of use", "see www.", "(c)", "http://", "https://",
-        "go to", "repository", "resources/cps", "incits", 
-        "copyright", "visit", "refer to"]):
-        return False
-    
-    # Must contain at least one dot (domain.tld)
-    if "." not in d:
-        return False
-    
-    # Should not have spaces
-    if " " in d:
-        return False
-    
-    # Otherwise, return True
-    return True
+certificates_total = metrics.counter("producer_certificates_total", "Certificate updates received")
+domains_total = metrics.counter("producer_domains_total", "Domains handed to the publish queue")
+payloads_total = metrics.counter("producer_payloads_total", "Payloads by outcome", ("status",))
+publish_seconds = metrics.histogram(
+    "producer_publish_latency_seconds", "Time from publish() to the Pub/Sub acknowledgement"
+)
+outstanding_publishes = metrics.gauge("producer_outstanding_publishes", "Publishes not yet acknowledged")
+outstanding_publishes.set_function(lambda: sum(not future.done() for future, _ in outstanding))
+log_sampled = LogSampler()
 
 
-def on_publish_done(future):
+def save_dedup_state():
+    global last_saved
     try:
-        message_id = future.result()
+        recent_domains.save(DEDUP_STATE_FILE)
+        last_saved = time.monotonic()
     except Exception as e:
-        print(f"Publish failed: {e}", flush=True)
+        print(f"Failed to save dedup state: {e}", flush=True)
+
+
+def on_publish_done(future, started, trace_id):
+    publish_seconds.observe(time.perf_counter() - started)
+    try:
+        future.result()
+    except Exception as e:
+        trace = f" [trace {trace_id}]" if trace_id else ""
+        print(f"Publish failed: {e}{trace}", flush=True)
+        payloads_total.inc(status="failed")
+        return
+    payloads_total.inc(status="published")
+
+
+def publish_payload(payload):
+    """Queues a payload for the publisher thread."""
+    if payload is not None:
+        publish_queue.put(payload)
+
+
+def publish_loop():
+    while True:
+        payload = publish_queue.get()
+        try:
+            publish_bucket.acquire()
+            send_payload(payload)
+        except Exception as e:
+            print(f"Publish failed: {e}", flush=True)
+            payloads_total.inc(status="failed")
+            failed_payloads.append(payload)
+        finally:
+            publish_queue.task_done()
+
+
+def send_payload(payload):
+    global total_domains
+    data, url_count = payload
+    n = next(counter)
+    total_domains += url_count
+    domains_total.inc(url_count)
+
+    trace_id = new_trace_id() if TRACE_IDS else None
+    attributes = {TRACE_ATTRIBUTE: trace_id} if trace_id else {}
+    started = time.perf_counter()
+    future = publisher.publish(topic_path, data, **attributes)
+    future.add_done_callback(lambda f: on_publish_done(f, started, trace_id))
+    outstanding.append((future, payload))
+
+    trace = f" | trace {trace_id}" if trace_id else ""
+    log_sampled("published", f"Published {n + 1} batches | {total_domains} domains | "
+                             f"{batcher.filtered} filtered{trace}")
+
+
+def cert_domains(cert):
+    domains = []
+    name_value = cert.get("name_value", "")
+    common_name = cert.get("common_name", "")
+
+    if name_value:
+        domains.extend([d.strip() for d in name_value.split("\n") if d.strip()])
+    if common_name and common_name not in domains:
+        domains.append(common_name)
+    return domains
+
+
+def handle_certs(certs):
+    # Clean the whole chunk in one pass, then remove recently seen domains
+    certificates_total.inc(len(certs))
+    domains = [d for cert in certs for d in cert_domains(cert)]
+    valid = clean_domains(domains)
+    batcher.filtered += len(domains) - len(valid)
+
+    for payload in batcher.add(recent_domains.filter_new(valid), cleaned=True):
+        publish_payload(payload)
+    publish_payload(batcher.poll())
+
+
+def retry_failed():
+    retry = failed_payloads[:]
+    failed_payloads.clear()
+    for payload in retry:
+        publish_payload(payload)
+
+
+def flush_batches():
+    """Publishes the pending payload, and any that failed before, then waits
+    for every publish since the last checkpoint. Returns False if one
+    failed, so the cursor isn't advanced past unpublished domains."""
+    retry_failed()
+    publish_payload(batcher.flush())
+    publish_queue.join()
+    wait([future for future, _ in outstanding])
+    failed_payloads.extend(payload for future, payload in outstanding if future.exception() is not None)
+    outstanding.clear()
+
+    if time.monotonic() - last_saved >= DEDUP_SAVE_INTERVAL:
+        save_dedup_state()
+        print(f"Dedup: {recent_domains.stats()}", flush=True)
+    if failed_payloads:
+        print(f"{len(failed_payloads)} payloads failed to publish, keeping the cursor", flush=True)
+        return False
+    return True
 
 
-@atexit.register
 def flush_pubsub():
     print("Flushing Pub/Sub messages before exit...", flush=True)
+    retry_failed()
+    publish_payload(batcher.flush())
+    publish_queue.join()
     publisher.stop()
+    if len(recent_domains):
+        save_dedup_state()
 
 
-print(f"Starting crt.sh certificate producer...", flush=True)
-
-try:
-    test_future = publisher.publish(topic_path, b"test message")
-    print(f"Test publish successful: {test_future.result()}", flush=True)
-except Exception as e:
-    print(f"Test publish failed: {e}", flush=True)
-    exit(1)
+def main():
+    print(f"Starting crt.sh certificate producer...", flush=True)
+    atexit.register(flush_pubsub)
+    metrics.start_exporter()
+    threading.Thread(target=publish_loop, name="publisher", daemon=True).start()
 
+    try:
+        test_future = publisher.publish(topic_path, b"test message")
+        print(f"Test publish successful: {test_future.result()}", flush=True)
+    except Exception as e:
+        print(f"Test publish failed: {e}", flush=True)
+        exit(1)
 
-# Track the highest certificate ID we've seen
-max_cert_id = load_state()
-if max_cert_id:
-    print(f"Resuming from saved max_cert_id={max_cert_id}", flush=True)
-else:
-    print("Starting fresh (no saved state)", flush=True)
+    # Track the highest certificate ID we've seen for each search term
+    cursors = CursorStore(STATE_FILE)
+    if cursors.cursors or cursors.default:
+        print(f"Resuming from saved cursors: {cursors.cursors or cursors.default}", flush=True)
+    else:
+        print("Starting fresh (no saved state)", flush=True)
 
-print("Starting certificate stream from crt.sh...", flush=True)
+    try:
+        if recent_domains.load(DEDUP_STATE_FILE):
+            print(f"Restored {len(recent_domains)} recent domains from {DEDUP_STATE_FILE}", flush=True)
+    except Exception as e:
+        print(f"Failed to restore dedup state: {e}", flush=True)
 
-# Common TLDs to monitor for new certificates
-tlds = ['.com', '.net', '.org', '.io', '.dev', '.app', '.co', '.ai', '.xyz']
-tld_index = 0
-backoff = 10
-reset_counter = 0
+    print(f"Starting certificate stream from {CRTSH_BASE_URL} ({CRTSH_WORKERS} workers, "
+          f"{CRTSH_RATE:g} req/s)...", flush=True)
 
-while True:
+    backfill = CrtShBackfill(
+        search_terms, cursors, handle_certs, flush_batches,
+        base_url=CRTSH_BASE_URL, workers=CRTSH_WORKERS, rate=CRTSH_RATE, burst=CRTSH_BURST,
+    )
     try:
-        # Rotate through TLDs to get diverse certificate data
-        search_term = f"%.{tlds[tld_index]}"
-        tld_index = (tld_index + 1) % len(tlds)
-        reset_counter += 1
-
-        # Periodically reset max_cert_id to avoid stalls
-        if reset_counter % 1000 == 0:
-            print("Resetting max_cert_id to avoid stalls", flush=True)
-            max_cert_id = None
-            save_state()
-        
-        print(f"Querying for {search_term}...", flush=True)
-        
-        # Use the identity search which is more reliable
-        params = {
-            "Identity": search_term,
-            "output": "json"
-        }
-        
-        if max_cert_id:
-            params["minCertID"] = max_cert_id + 1
-        
-        response = requests.get(
-            url="https://crt.sh/",
-            params=params,
-            headers={
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
-            },
-            timeout=30
-        )
-        
-        print(f"Response status: {response.status_code}, length: {len(response.text)}", flush=True)
-        
-        if response.status_code == 200:
-            # Check if response is HTML (error page) or JSON
-            content_type = response.headers.get('content-type', '')
-            
-            if not response.text.strip().startswith('['):
-                print("Not a JSON array, skipping...", flush=True)
-                time.sleep(10)
-                continue
-            
-            try:
-                # Try to parse JSON
-                text = response.text.strip()
-                
-                # Log first 200 chars for debugging
-                print(f"Response preview: {text[:200]}", flush=True)
-                
-                if not text or text == '[]':
-                    empty_counter += 1
-                    wait = min(60 * empty_counter, 300)  # up to 5 min
-                    print(f"No new certs, sleeping {wait}s", flush=True)
-                    time.sleep(wait)
-                    continue
-                else:
-                    empty_counter = 0
-                
-                certs = json.loads(text)
-                
-                if not isinstance(certs, list):
-                    print(f"Unexpected response format: {type(certs)}", flush=True)
-                    time.sleep(10)
-                    continue
-                
-                print(f"Found {len(certs)} certificates", flush=True)
-                
-                for cert in certs:
-                    cert_id = cert.get("id")
-                    
-                    # Update max_cert_id
-                    if cert_id and (max_cert_id is None or cert_id > max_cert_id):
-                        max_cert_id = cert_id
-                    
-                    # Extract domain names
-                    domains = []
-                    name_value = cert.get("name_value", "")
-                    common_name = cert.get("common_name", "")
-                    
-                    if name_value:
-                        domains.extend([d.strip() for d in name_value.split("\n") if d.strip()])
-                    if common_name and common_name not in domains:
-                        domains.append(common_name)
-                    
-                    # Remove duplicates and filter invalid domains
-                    domains = [d for d in domains if is_valid_domain(d) and d not in recent_domains]
-                    recent_domains.extend(domains)
-                    
-                    if domains:
-                        n = next(counter)
-                        total_domains += len(domains)
-                        
-                        payload = json.dumps({"urls": domains}).encode("utf-8")
-                        future = publisher.publish(topic_path, payload)
-                        future.add_done_callback(on_publish_done)
-                        
-                        if n % 50 == 0:
-                            print(f"Published {n} batches | {total_domains} domains | Latest: {domains[0][:50]}", flush=True)
-                        
-                        time.sleep(SLEEP_BETWEEN_BATCHES)
-                
-                # Small delay before next query
-                time.sleep(2)
-                
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error: {e}", flush=True)
-                print(f"Response text (first 500 chars): {response.text[:500]}", flush=True)
-                time.sleep(10)
-                
-        elif response.status_code == 429:
-            print(f"Rate limited, waiting 60s...", flush=True)
-            time.sleep(60)
-        elif response.status_code == 404:
-            print(f"No results found, trying next TLD...", flush=True)
-            time.sleep(5)
-        else:
-            print(f"HTTP {response.status_code}, retrying in 10s...", flush=True)
-            time.sleep(10)
-            
-    except requests.RequestException as e:
-        print(f"Request error: {e}, retrying in 10s...", flush=True)
-        time.sleep(10)
+        backfill.run()
     except KeyboardInterrupt:
         print("\nShutting down gracefully...", flush=True)
-        break
-    except Exception as e:
-        print(f"Unexpected error: {e}", flush=True)
-        import traceback
-        traceback.print_exc()
-        time.sleep(10)
 
-print("Shutdown complete", flush=True)
\ No newline at end of file
+    print("Shutdown complete", flush=True)
+
+
+if __name__ == "__main__":
+    main()
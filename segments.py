@@ -0,0 +1,135 @@
+"""Hourly Parquet segments, shared by the scorer's ParquetSink (sinks.py) and
+the dashboard's DuckDB backend (dashboard-cloud/backends.py):
+
+    root/date=YYYY-MM-DD/hour=HH/<writer>-<sequence>.parquet
+
+Each segment is sorted by time_added and written under a temporary name,
+then renamed, so readers never see a partial file. Segment names start with
+an ID per writer, so several writers can share root.
+
+Once an hour has been over for compact_after seconds, a writer merges its
+segments of it into one file. A reader scanning *.parquet must never see the
+merged rows next to their inputs, so the merge is written as
+<name>.parquet.merging, which the glob skips, with the names of its inputs
+in its schema metadata (the manifest). Then the inputs are removed and the
+merge is renamed into place. A scan in between may miss rows for a moment,
+but never counts them twice. A .merging file left behind by a failed remove
+or a crash is finished the same way by the next compaction, or by the next
+SegmentWriter opened on root.
+"""
+import datetime
+import glob
+import json
+import os
+import uuid
+
+MERGING = ".merging"
+# Schema metadata key of a merge: the JSON list of the segments it replaces
+MANIFEST_KEY = b"merged_from"
+HOUR = datetime.timedelta(hours=1)
+
+
+def hour_directory(root, hour):
+    return os.path.join(root, f"date={hour:%Y-%m-%d}", f"hour={hour:%H}")
+
+
+class SegmentWriter:
+    """Writes one writer's segments under root and merges them per hour.
+
+    Hours are UTC datetimes truncated to the hour. Not thread safe: callers
+    write and compact from a single thread.
+    """
+
+    def __init__(self, root, prefix, compact_after=300):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.root = root
+        self.compact_after = datetime.timedelta(seconds=compact_after)
+        self.writer_id = f"{prefix}-{uuid.uuid4().hex[:12]}"
+        self.sequence = 0
+        # Hours holding segments of ours that are not merged yet
+        self.open_hours = set()
+        self.schema = pyarrow.schema([
+            ("url", pyarrow.string()),
+            ("score", pyarrow.float64()),
+            ("classification", pyarrow.string()),
+            ("time_added", pyarrow.timestamp("us", tz="UTC")),
+            # Always present, so every segment has the same schema
+            ("trace_id", pyarrow.string()),
+        ])
+        # Merges left behind by a writer that crashed
+        for path in sorted(glob.glob(os.path.join(root, "date=*", "hour=*", "*.parquet" + MERGING))):
+            try:
+                self.finish(path)
+            except OSError:
+                pass
+
+    def write(self, table, hour):
+        """Writes table, sorted by time_added, as a new segment of hour."""
+        self.write_file(table, self.next_path(hour))
+        self.open_hours.add(hour)
+
+    def next_path(self, hour):
+        directory = hour_directory(self.root, hour)
+        os.makedirs(directory, exist_ok=True)
+        self.sequence += 1
+        return os.path.join(directory, f"{self.writer_id}-{self.sequence:08d}.parquet")
+
+    def write_file(self, table, path):
+        self.pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def compact(self):
+        """Merges our segments of each hour over for compact_after seconds.
+
+        Returns the number of hours merged and a list of (hour, exception)
+        for those that failed; they are retried by the next call. Rows
+        arriving late for a merged hour start new segments, merged in turn.
+        """
+        closed_before = datetime.datetime.now(datetime.timezone.utc) - self.compact_after
+        merged, failed = 0, []
+        for hour in sorted(self.open_hours):
+            if hour + HOUR > closed_before:
+                continue
+            try:
+                self.merge(hour)
+            except Exception as e:
+                failed.append((hour, e))
+                continue
+            merged += 1
+            self.open_hours.discard(hour)
+        return merged, failed
+
+    def merge(self, hour):
+        directory = hour_directory(self.root, hour)
+        for path in sorted(glob.glob(os.path.join(directory, f"{self.writer_id}-*.parquet" + MERGING))):
+            self.finish(path)
+        paths = sorted(glob.glob(os.path.join(directory, f"{self.writer_id}-*.parquet")))
+        if len(paths) < 2:
+            return
+        table = self.pa.concat_tables([self.pq.read_table(path, schema=self.schema) for path in paths])
+        manifest = {MANIFEST_KEY: json.dumps([os.path.basename(path) for path in paths])}
+        path = self.next_path(hour) + MERGING
+        self.write_file(table.sort_by("time_added").replace_schema_metadata(manifest), path)
+        self.finish(path)
+
+    def finish(self, path):
+        """Removes the inputs named in a merge's manifest, then renames it into place."""
+        try:
+            names = json.loads(self.pq.read_schema(path).metadata[MANIFEST_KEY])
+        except FileNotFoundError:
+            # Finished by another writer meanwhile
+            return
+        directory = os.path.dirname(path)
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        try:
+            os.replace(path, path[:-len(MERGING)])
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,521 @@
+"""Output sinks for classified URLs.
+
+Rows travel as columns: a dict of equal-length NumPy arrays keyed by
+COLUMNS, with time_added as int64 microseconds since the epoch, plus a
+trace_id column when the scorer runs with TRACE_IDS=1 (see metrics.py). A sink
+writes one such batch and raises on failure. BufferedWriter sits in
+front of a sink: it gathers rows from many callers, flushes them by row
+count, byte size or age from a background thread, retries failed batches
+with exponential backoff and spills what still fails to a local dead-letter
+file, so rows are never silently dropped.
+
+Sink specs (see open_sink):
+    bigquery-storage        BigQuery Storage Write API, committed stream with offsets
+    bigquery                legacy streaming inserts (insert_rows_json)
+    file:///path.ndjson     newline-delimited JSON file
+    sqlite:///path.db       local SQLite table
+    parquet:///path/dir     hourly Parquet segments, for the dashboard's
+                            DuckDB backend (see ParquetSink)
+"""
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+# Status passed to BufferedWriter callbacks
+WRITTEN = "written"
+DEAD_LETTER = "dead_letter"
+FAILED = "failed"
+
+# Rough per-row JSON overhead on top of the URL, used to size batches
+ROW_OVERHEAD_BYTES = 96
+
+COLUMNS = ("url", "score", "classification", "time_added")
+TRACE_COLUMN = "trace_id"
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC)
+HOUR_MICROS = 3600 * 1000000
+
+write_seconds = metrics.histogram("sink_write_seconds", "Sink write_batch duration", ("status",))
+rows_total = metrics.counter("sink_rows_total", "Rows handled by the writer, by outcome", ("status",))
+retries_total = metrics.counter("sink_retries_total", "Sink writes retried")
+compactions_total = metrics.counter("sink_parquet_compactions_total", "Parquet hours merged, by outcome",
+                                    ("status",))
+queue_depth = metrics.gauge("sink_queue_depth", "Submitted batches waiting for the writer thread")
+
+
+class SinkError(Exception):
+    """A batch could not be written."""
+
+
+def num_rows(columns):
+    return len(columns["url"])
+
+
+def column_names(columns):
+    """COLUMNS, plus TRACE_COLUMN when the batch carries trace IDs."""
+    return COLUMNS + (TRACE_COLUMN,) if TRACE_COLUMN in columns else COLUMNS
+
+
+def concat_columns(batches):
+    """Joins several column batches into one."""
+    if len(batches) == 1:
+        return batches[0]
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in column_names(batches[0])}
+
+
+def isoformat_micros(values):
+    """ISO 8601 strings for an array of epoch microseconds.
+
+    Batches share one timestamp, so only the distinct values are formatted.
+    """
+    unique, inverse = np.unique(values, return_inverse=True)
+    text = [(EPOCH + datetime.timedelta(microseconds=value)).isoformat() for value in unique.tolist()]
+    return np.array(text, dtype=object)[inverse]
+
+
+def iter_rows(columns):
+    """Yields (url, score, classification, time_added[, trace_id]) tuples with ISO timestamps."""
+    values = [
+        columns["url"].tolist(),
+        columns["score"].tolist(),
+        columns["classification"].tolist(),
+        isoformat_micros(columns["time_added"]).tolist(),
+    ]
+    if TRACE_COLUMN in columns:
+        values.append(columns[TRACE_COLUMN].tolist())
+    return zip(*values)
+
+
+def to_ndjson(columns):
+    """Formats a column batch as newline-delimited JSON."""
+    if TRACE_COLUMN in columns:
+        return "".join(
+            f'{{"url": {json.dumps(url)}, "score": {score!r}, "classification": "{label}", '
+            f'"time_added": "{time_added}", "trace_id": {json.dumps(trace_id)}}}\n'
+            for url, score, label, time_added, trace_id in iter_rows(columns)
+        )
+    return "".join(
+        f'{{"url": {json.dumps(url)}, "score": {score!r}, "classification": "{label}", '
+        f'"time_added": "{time_added}"}}\n'
+        for url, score, label, time_added in iter_rows(columns)
+    )
+
+
+def varint(value):
+    """The protobuf base-128 varint of a non-negative int."""
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+# Single-byte varints, for the lengths of most URLs
+SHORT_VARINTS = [bytes((n,)) for n in range(128)]
+
+
+def encode_field(number, value):
+    """One field of a row: a string, a double or a non-negative int64; nothing for None."""
+    if value is None:
+        return b""
+    if isinstance(value, float):
+        return varint(number << 3 | 1) + struct.pack("<d", value)
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    data = value.encode("utf-8")
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def proto_rows(columns):
+    """Serializes each row as BigQueryStorageSink's ClassifiedUrl message.
+
+    The bytes are the ones SerializeToString() gives, written directly: a
+    batch has few distinct scores, labels, timestamps and trace IDs, so each
+    of those fields is encoded once per value, and only URLs per row.
+    """
+    # The fields after the URL, joined per row by NumPy's object addition
+    tail = None
+    for number, name in enumerate(column_names(columns)[1:], start=2):
+        unique, inverse = np.unique(columns[name], return_inverse=True)
+        encoded = np.array([encode_field(number, value) for value in unique.tolist()], dtype=object)
+        encoded = encoded[inverse.reshape(-1)]
+        tail = encoded if tail is None else tail + encoded
+    url_tag = varint(1 << 3 | 2)
+    rows = []
+    for url, rest in zip(columns["url"].tolist(), tail.tolist()):
+        data = url.encode("utf-8")
+        size = len(data)
+        rows.append(b"".join((url_tag, SHORT_VARINTS[size] if size < 128 else varint(size), data, rest)))
+    return rows
+
+
+class BigQueryStorageSink:
+    """Appends rows through the BigQuery Storage Write API on a COMMITTED stream.
+
+    Rows are visible as soon as an append is acknowledged. Every append
+    carries the stream offset it expects, so when BufferedWriter retries a
+    batch whose first append landed but timed out, the server answers
+    ALREADY_EXISTS instead of writing the rows twice; that counts as
+    written. After an error the connection is reopened on the same stream so
+    the offsets still apply. A different batch arriving while the previous
+    one is unconfirmed (the writer gave up on it) goes to a new stream, so
+    it cannot be mistaken for that one. With trace_ids, rows also carry the
+    trace_id column, which the table must then have (a NULLABLE STRING).
+    """
+
+    FIELDS = (
+        ("url", "TYPE_STRING"),
+        ("score", "TYPE_DOUBLE"),
+        ("classification", "TYPE_STRING"),
+        # TIMESTAMP columns take int64 microseconds since the epoch
+        ("time_added", "TYPE_INT64"),
+    )
+
+    def __init__(self, project_id, dataset_id, table_id, timeout=30, trace_ids=False):
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1 import types
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        self.types = types
+        self.timeout = timeout
+        self.client = bigquery_storage_v1.BigQueryWriteClient()
+        self.parent = self.client.table_path(project_id, dataset_id, table_id)
+
+        self.descriptor = descriptor_pb2.DescriptorProto(name="ClassifiedUrl")
+        fields = self.FIELDS + ((TRACE_COLUMN, "TYPE_STRING"),) if trace_ids else self.FIELDS
+        for number, (name, field_type) in enumerate(fields, start=1):
+            self.descriptor.field.add(
+                name=name,
+                number=number,
+                type=getattr(descriptor_pb2.FieldDescriptorProto, field_type),
+                label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+            )
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(descriptor_pb2.FileDescriptorProto(
+            name="classified_url.proto", syntax="proto2", message_type=[self.descriptor]
+        ))
+        self.row_class = message_factory.GetMessageClass(pool.FindMessageTypeByName("ClassifiedUrl"))
+        # Connection to write_stream; offset is the number of rows appended to it
+        self.stream = None
+        self.write_stream = None
+        self.offset = 0
+        # The batch whose last append failed without an answer, if any
+        self.unconfirmed = None
+
+    def open_stream(self):
+        from google.cloud.bigquery_storage_v1 import writer
+
+        types = self.types
+        if self.write_stream is None:
+            self.write_stream = self.client.create_write_stream(
+                parent=self.parent,
+                write_stream=types.WriteStream(type_=types.WriteStream.Type.COMMITTED),
+            ).name
+            self.offset = 0
+        template = types.AppendRowsRequest(write_stream=self.write_stream)
+        template.proto_rows = types.AppendRowsRequest.ProtoData(
+            writer_schema=types.ProtoSchema(proto_descriptor=self.descriptor)
+        )
+        return writer.AppendRowsStream(self.client, template)
+
+    def write_batch(self, columns):
+        from google.api_core import exceptions
+
+        types = self.types
+        rows = types.ProtoRows()
+        rows.serialized_rows.extend(proto_rows(columns))
+        if self.unconfirmed is not None and self.unconfirmed is not columns:
+            # The previous batch may or may not be at self.offset
+            self.close()
+            self.write_stream = None
+        if self.stream is None:
+            self.stream = self.open_stream()
+        request = types.AppendRowsRequest(offset=self.offset)
+        request.proto_rows = types.AppendRowsRequest.ProtoData(rows=rows)
+
+        self.unconfirmed = columns
+        try:
+            response = self.stream.send(request).result(timeout=self.timeout)
+        except exceptions.AlreadyExists:
+            # An earlier attempt of this batch was appended, its answer got lost
+            response = None
+        except Exception as e:
+            self.close()
+            raise SinkError(f"Storage Write API append failed: {e}") from e
+        self.unconfirmed = None
+        if response is not None and response.row_errors:
+            raise SinkError(f"Storage Write API row errors: {list(response.row_errors)[:5]}")
+        self.offset += len(rows.serialized_rows)
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except Exception:
+                pass
+            self.stream = None
+
+
+class BigQueryInsertSink:
+    """Legacy streaming inserts through insert_rows_json."""
+
+    def __init__(self, project_id, dataset_id, table_id):
+        from google.cloud import bigquery
+
+        self.client = bigquery.Client(project=project_id)
+        self.table_ref = self.client.dataset(dataset_id).table(table_id)
+
+    def write_batch(self, columns):
+        if TRACE_COLUMN in columns:
+            rows = [{"url": url, "score": score, "classification": label, "time_added": time_added,
+                     "trace_id": trace_id} for url, score, label, time_added, trace_id in iter_rows(columns)]
+        else:
+            rows = [{"url": url, "score": score, "classification": label, "time_added": time_added}
+                    for url, score, label, time_added in iter_rows(columns)]
+        errors = self.client.insert_rows_json(self.table_ref, rows)
+        if errors:
+            raise SinkError(f"BigQuery insert errors: {errors[:5]}")
+
+    def close(self):
+        self.client.close()
+
+
+class FileSink:
+    """Appends rows to a newline-delimited JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write_batch(self, columns):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(to_ndjson(columns))
+
+    def close(self):
+        pass
+
+
+class SQLiteSink:
+    """Writes rows into a local classified_urls table with the BigQuery schema."""
+
+    def __init__(self, path, table="classified_urls"):
+        self.table = table
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            "(url TEXT, score REAL, classification TEXT, time_added TEXT, trace_id TEXT)"
+        )
+        existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        if TRACE_COLUMN not in existing:
+            # Tables created before trace IDs
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {TRACE_COLUMN} TEXT")
+        self.conn.commit()
+
+    def write_batch(self, columns):
+        names = column_names(columns)
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {self.table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                iter_rows(columns),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class ParquetSink:
+    """Writes rows as Parquet segments, partitioned by hour of time_added.
+
+    Each batch becomes one segment per hour it spans, in the layout the
+    dashboard's DuckDB backend reads (see segments.py). Once an hour has been
+    over for compact_after seconds, this sink's segments of it are merged
+    into one file, keeping the file count per hour low; the merge runs on
+    the writer thread and a failed one is retried after the next batch.
+    """
+
+    def __init__(self, root, compact_after=300):
+        import pyarrow
+
+        from segments import SegmentWriter
+
+        self.pa = pyarrow
+        self.root = root
+        self.segments = SegmentWriter(root, "scorer", compact_after)
+
+    def write_batch(self, columns):
+        pa = self.pa
+        hours = columns["time_added"] - columns["time_added"] % HOUR_MICROS
+        for hour in np.unique(hours).tolist():
+            index = np.flatnonzero(hours == hour)
+            index = index[np.argsort(columns["time_added"][index], kind="stable")]
+            trace_ids = (pa.array(columns[TRACE_COLUMN][index].tolist(), pa.string()) if TRACE_COLUMN in columns
+                         else pa.nulls(len(index), pa.string()))
+            table = pa.Table.from_arrays([
+                pa.array(columns["url"][index].tolist(), pa.string()),
+                pa.array(columns["score"][index], pa.float64()),
+                pa.array(columns["classification"][index].tolist(), pa.string()),
+                pa.array(columns["time_added"][index], pa.timestamp("us", tz="UTC")),
+                trace_ids,
+            ], schema=self.segments.schema)
+            try:
+                self.segments.write(table, EPOCH + datetime.timedelta(microseconds=hour))
+            except OSError as e:
+                raise SinkError(f"Parquet segment write failed: {e}") from e
+        # The batch is written; a failed merge must not make it be retried
+        merged, failed = self.segments.compact()
+        compactions_total.inc(merged, status="merged")
+        compactions_total.inc(len(failed), status="failed")
+
+    def close(self):
+        pass
+
+
+def open_sink(spec, project_id, dataset_id, table_id, trace_ids=False):
+    """Creates the sink described by spec, see the module docstring."""
+    if spec == "bigquery-storage":
+        return BigQueryStorageSink(project_id, dataset_id, table_id, trace_ids=trace_ids)
+    if spec == "bigquery":
+        return BigQueryInsertSink(project_id, dataset_id, table_id)
+    if spec.startswith("file:///"):
+        return FileSink(spec[len("file:///"):])
+    if spec.startswith("sqlite:///"):
+        return SQLiteSink(spec[len("sqlite:///"):])
+    if spec.startswith("parquet:///"):
+        return ParquetSink(spec[len("parquet:///"):])
+    raise ValueError(f"Unsupported sink: {spec}")
+
+
+class BufferedWriter:
+    """Batches rows in the background and writes them to a sink.
+
+    submit() takes a column batch and returns immediately. A batch is
+    flushed once it holds max_rows rows or max_bytes bytes, or max_latency
+    seconds after its first row.
+    Each submit's on_done callback is called from the writer thread with
+    WRITTEN, DEAD_LETTER (rows spilled to dead_letter_path after
+    max_attempts) or FAILED (the spill failed too).
+    """
+
+    def __init__(self, sink, max_rows=500, max_bytes=5 * 1024 * 1024, max_latency=1.0,
+                 max_attempts=5, backoff=0.5, dead_letter_path="dead_letter.ndjson", log=print):
+        self.sink = sink
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.dead_letter_path = dead_letter_path
+        self.log = log
+        self.inbox = queue.Queue()
+        self.rows_written = 0
+        self.batches_written = 0
+        self.retries = 0
+        self.rows_dead_lettered = 0
+        queue_depth.set_function(self.inbox.qsize)
+        self.thread = threading.Thread(target=self.run, name="buffered-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, columns, on_done=None):
+        count = num_rows(columns) if columns is not None else 0
+        if not count:
+            if on_done is not None:
+                on_done(WRITTEN)
+            return
+        size = sum(map(len, columns["url"].tolist())) + ROW_OVERHEAD_BYTES * count
+        self.inbox.put((columns, count, on_done, size))
+
+    def flush(self, timeout=None):
+        """Blocks until everything submitted so far has been handled."""
+        done = threading.Event()
+        self.inbox.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        self.inbox.put(None)
+        self.thread.join(timeout)
+        self.sink.close()
+
+    def stats(self):
+        return {
+            "rows_written": self.rows_written,
+            "batches_written": self.batches_written,
+            "retries": self.retries,
+            "rows_dead_lettered": self.rows_dead_lettered,
+            "queued": self.inbox.qsize(),
+        }
+
+    def run(self):
+        batches, callbacks, rows, size, first_at = [], [], 0, 0, None
+        while True:
+            timeout = None if first_at is None else max(first_at + self.max_latency - time.monotonic(), 0)
+            try:
+                item = self.inbox.get(timeout=timeout)
+            except queue.Empty:
+                item = "deadline"
+
+            if isinstance(item, tuple):
+                columns, count, on_done, batch_size = item
+                batches.append(columns)
+                callbacks.append(on_done)
+                rows += count
+                size += batch_size
+                if first_at is None:
+                    first_at = time.monotonic()
+                if rows < self.max_rows and size < self.max_bytes:
+                    continue
+
+            # Size limit, deadline, flush() or close()
+            if batches:
+                self.write(concat_columns(batches), callbacks)
+                batches, callbacks, rows, size, first_at = [], [], 0, 0, None
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def write(self, columns, callbacks):
+        count = num_rows(columns)
+        status = FAILED
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.perf_counter()
+            try:
+                self.sink.write_batch(columns)
+                write_seconds.observe(time.perf_counter() - start, status="ok")
+                status = WRITTEN
+                self.rows_written += count
+                self.batches_written += 1
+                break
+            except Exception as e:
+                write_seconds.observe(time.perf_counter() - start, status="error")
+                self.log(f"Sink write failed (attempt {attempt}/{self.max_attempts}): {e}")
+                if attempt < self.max_attempts:
+                    self.retries += 1
+                    retries_total.inc()
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        if status != WRITTEN:
+            try:
+                with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    f.write(to_ndjson(columns))
+                status = DEAD_LETTER
+                self.rows_dead_lettered += count
+                self.log(f"Spilled {count} rows to {os.path.abspath(self.dead_letter_path)}")
+            except Exception as e:
+                self.log(f"ERROR writing dead-letter file, {count} rows lost: {e}")
+
+        rows_total.inc(count, status=status)
+        for on_done in callbacks:
+            if on_done is not None:
+                try:
+                    on_done(status)
+                except Exception as e:
+                    self.log(f"Writer callback failed: {e}")
@@ -0,0 +1,173 @@
+"""Mergeable sketches of the scorer's verdicts, kept per time window.
+
+The dashboard's top malicious domains used to group every malicious row of
+the table by domain on each request. Instead the scorer keeps, for each
+time bucket:
+
+- a SpaceSaving summary of the malicious registrable domains (the public
+  suffix plus one label, see domains.PublicSuffixList), with their counts
+  and score sums, for the top K;
+- HyperLogLog counters of the distinct registrable domains, all and
+  malicious only;
+- row counts.
+
+Buckets come in two tiers, TIERS: 5 minutes for the last hour and 1 hour
+for the last day, so a last hour or last day answer merges a bounded number
+of sketches whatever the traffic. Sketches merge across
+buckets as well as across scorer instances: HyperLogLog exactly as if one
+counter had seen both streams, SpaceSaving with the two error bounds added.
+
+DomainSketches.snapshot() writes an instance's buckets as one JSON file in
+a directory the dashboard reads (a shared volume or a mounted bucket);
+dashboard-cloud/sketches.py merges the files of all instances. The sketch
+classes themselves are in summaries.py, shared with the dashboard.
+"""
+import functools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+import metrics
+from domains import public_suffixes
+from summaries import HyperLogLog, SpaceSaving
+
+# (name, bucket seconds, buckets kept): enough for the last hour and the
+# last day, plus the bucket in progress
+TIERS = (
+    ("5m", 300, 13),
+    ("1h", 3600, 25),
+)
+SNAPSHOT_VERSION = 1
+# Scheme and www prefixes of a URL, as the dashboard's domain extraction strips them
+HOST_PREFIX = re.compile(r"^(?:https?://)?(?:www\.)?")
+
+snapshot_seconds = metrics.histogram("sketch_snapshot_seconds", "Domain sketch snapshot write time")
+
+
+class Bucket:
+    """The sketches of one time bucket."""
+
+    def __init__(self, capacity, precision):
+        self.rows = 0
+        self.malicious_rows = 0
+        self.top_malicious = SpaceSaving(capacity)
+        self.domains = HyperLogLog(precision)
+        self.malicious_domains = HyperLogLog(precision)
+
+    def to_dict(self):
+        return {"rows": self.rows, "malicious_rows": self.malicious_rows,
+                "top_malicious": self.top_malicious.to_dict(), "domains": self.domains.to_dict(),
+                "malicious_domains": self.malicious_domains.to_dict()}
+
+
+@functools.lru_cache(maxsize=100000)
+def registrable_host(host):
+    # Hostnames without a dot and IPv4 addresses have no public suffix
+    if "." not in host or host.rsplit(".", 1)[1].isdigit():
+        return host
+    return public_suffixes().registered_domain(host) or host
+
+
+def registrable_domain(url):
+    """The registrable domain of a URL's host, or the host itself when it has none."""
+    return registrable_host(HOST_PREFIX.sub("", url.lower()).split("/", 1)[0].split(":", 1)[0].rstrip("."))
+
+
+class DomainSketches:
+    """Per-bucket domain sketches of column batches (see sinks.py), for TIERS."""
+
+    def __init__(self, capacity=500, precision=12, tiers=TIERS, clock=time.time):
+        self.capacity = capacity
+        self.precision = precision
+        self.tiers = tiers
+        self.clock = clock
+        self.instance = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        # tier name -> {bucket start (epoch seconds): Bucket}
+        self.buckets = {name: {} for name, _, _ in tiers}
+        self.snapshot_at = clock()
+
+    def add(self, columns):
+        """Adds a column batch's verdicts to the buckets of its time_added."""
+        if columns is None or not len(columns["url"]):
+            return
+        seconds = columns["time_added"] // 1000000
+        domains = [registrable_domain(url) for url in columns["url"].tolist()]
+        malicious = (columns["classification"] == "MALICIOUS").tolist()
+        scores = columns["score"].tolist()
+        with self.lock:
+            for name, size, _ in self.tiers:
+                starts = seconds - seconds % size
+                for start in np.unique(starts).tolist():
+                    bucket = self.buckets[name].get(start)
+                    if bucket is None:
+                        self.expire(self.clock())
+                        bucket = self.buckets[name][start] = Bucket(self.capacity, self.precision)
+                    self.add_rows(bucket, np.flatnonzero(starts == start).tolist(), domains, malicious, scores)
+
+    def add_rows(self, bucket, indexes, domains, malicious, scores):
+        # Domains repeat within a batch; each distinct one is hashed and counted once
+        seen = set()
+        counts = {}
+        for i in indexes:
+            domain = domains[i]
+            seen.add(domain)
+            if malicious[i]:
+                entry = counts.get(domain)
+                if entry is None:
+                    counts[domain] = [1, scores[i]]
+                else:
+                    entry[0] += 1
+                    entry[1] += scores[i]
+        bucket.rows += len(indexes)
+        bucket.malicious_rows += sum(entry[0] for entry in counts.values())
+        for domain in seen:
+            bucket.domains.add(domain)
+        for domain, (count, score_sum) in counts.items():
+            bucket.malicious_domains.add(domain)
+            bucket.top_malicious.add(domain, count, score_sum)
+
+    def expire(self, now):
+        for name, size, kept in self.tiers:
+            oldest = now - now % size - (kept - 1) * size
+            self.buckets[name] = {start: bucket for start, bucket in self.buckets[name].items() if start >= oldest}
+
+    def snapshot_due(self, interval):
+        return self.clock() - self.snapshot_at >= interval
+
+    def snapshot(self, directory):
+        """Writes this instance's buckets to directory/<instance>.json; returns the path.
+
+        Also removes other instances' snapshots older than the longest
+        tier, which hold no bucket the dashboard still uses.
+        """
+        began = time.perf_counter()
+        now = self.clock()
+        with self.lock:
+            self.expire(now)
+            data = {
+                "version": SNAPSHOT_VERSION,
+                "instance": self.instance,
+                "written_at": now,
+                "tiers": {name: {"size": size, "buckets": {str(start): bucket.to_dict()
+                                                           for start, bucket in self.buckets[name].items()}}
+                          for name, size, _ in self.tiers},
+            }
+            self.snapshot_at = now
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.instance}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        retention = max(size * kept for _, size, kept in self.tiers)
+        for name in os.listdir(directory):
+            other = os.path.join(directory, name)
+            if name.endswith(".json") and other != path and os.path.getmtime(other) < now - retention:
+                os.remove(other)
+        snapshot_seconds.observe(time.perf_counter() - began)
+        return path
@@ -0,0 +1,140 @@
+"""Mergeable summaries: SpaceSaving top-K counts and HyperLogLog distinct counts.
+
+The scorer builds them per time bucket (sketches.py) and the dashboard
+merges the snapshots of all scorers (dashboard-cloud/sketches.py); both use
+these classes, so a sketch merges the same way wherever it is read.
+"""
+import base64
+import hashlib
+import math
+
+import numpy as np
+
+
+def hash64(item):
+    """A 64-bit hash that is the same in every process, unlike hash()."""
+    return int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class SpaceSaving:
+    """Approximate top-K counts (Metwally et al.'s Space-Saving).
+
+    Up to 2 * capacity items are counted; past that, all but the capacity
+    largest are evicted at once, which amortizes the eviction. floor is the
+    largest count evicted so far: an item not tracked occurred at most floor
+    times, and a newly tracked item starts from floor with that much error.
+    A count is thus an overestimate by at most its error, and
+    score_sum / (count - error) is the mean score of the occurrences
+    seen since the item was tracked.
+    """
+
+    def __init__(self, capacity=500):
+        self.capacity = capacity
+        self.floor = 0
+        # item -> [count, error, score_sum]
+        self.entries = {}
+
+    def add(self, item, count=1, score_sum=0.0):
+        entry = self.entries.get(item)
+        if entry is not None:
+            entry[0] += count
+            entry[2] += score_sum
+            return
+        self.entries[item] = [self.floor + count, self.floor, score_sum]
+        if len(self.entries) > 2 * self.capacity:
+            self.prune(self.capacity)
+
+    def prune(self, size):
+        if len(self.entries) <= size:
+            return
+        ranked = sorted(self.entries.items(), key=lambda item: item[1][0], reverse=True)
+        self.floor = max(self.floor, ranked[size][1][0])
+        self.entries = dict(ranked[:size])
+
+    def merge(self, other):
+        """Adds other's counts to this summary (Agarwal et al.'s mergeable summaries)."""
+        entries = {}
+        for item in self.entries.keys() | other.entries.keys():
+            mine = self.entries.get(item, (self.floor, self.floor, 0.0))
+            theirs = other.entries.get(item, (other.floor, other.floor, 0.0))
+            entries[item] = [mine[0] + theirs[0], mine[1] + theirs[1], mine[2] + theirs[2]]
+        self.entries = entries
+        self.floor += other.floor
+        self.capacity = max(self.capacity, other.capacity)
+        self.prune(2 * self.capacity)
+        return self
+
+    def top(self, n):
+        """[(item, count, error, mean score)] for the n largest counts."""
+        ranked = sorted(self.entries.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(item, count, error, score_sum / (count - error) if count > error else None)
+                for item, (count, error, score_sum) in ranked]
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "floor": self.floor,
+                "entries": [[item, *entry] for item, entry in self.entries.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["capacity"])
+        sketch.floor = data["floor"]
+        sketch.entries = {item: [count, error, score_sum] for item, count, error, score_sum in data["entries"]}
+        return sketch
+
+    def copy(self):
+        sketch = SpaceSaving(self.capacity)
+        sketch.floor = self.floor
+        sketch.entries = {item: list(entry) for item, entry in self.entries.items()}
+        return sketch
+
+
+class HyperLogLog:
+    """Distinct count estimate (Flajolet et al.) in 2**precision one-byte registers.
+
+    The standard error is about 1.04 / sqrt(2**precision), 1.6% at the
+    default precision of 12 (4 KiB).
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item):
+        h = hash64(item)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f"Can't merge HyperLogLog precision {other.precision} into {self.precision}")
+        merged = np.maximum(np.frombuffer(self.registers, np.uint8), np.frombuffer(other.registers, np.uint8))
+        self.registers = bytearray(merged.tobytes())
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        registers = np.frombuffer(self.registers, np.uint8)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.exp2(-registers.astype(np.float64))))
+        zeros = int(np.count_nonzero(registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return m * math.log(m / zeros)
+        return raw
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["precision"])
+        sketch.registers = bytearray(base64.b64decode(data["registers"]))
+        return sketch
+
+    def copy(self):
+        sketch = HyperLogLog(self.precision)
+        sketch.registers = bytearray(self.registers)
+        return sketch
@@ -16,13 +16,25 @@ resource "google_storage_bucket" "terraform_big_data_bucket" {
 }
 
 
-# GCS object to store code and model
+# GCS object to store code and model, built by package_function.py
 resource "google_storage_bucket_object" "object" {
   name   = var.gcs_object_name
   bucket = google_storage_bucket.terraform_big_data_bucket.name
   source = "../code_and_model.zip"
 }
 
+# The producer and the modules it imports, copied to the VM at startup
+locals {
+  producer_files = ["producer.py", "metrics.py", "payloads.py", "domains.py", "requirements-producer.txt"]
+}
+
+resource "google_storage_bucket_object" "producer_files" {
+  for_each = toset(local.producer_files)
+  name     = "producer/${each.value}"
+  bucket   = google_storage_bucket.terraform_big_data_bucket.name
+  source   = "../${each.value}"
+}
+
 resource "google_compute_firewall" "vm_egress" {
   name    = "${var.vm_name}-allow-egress"
   network = "default" # Make sure this is the network your VM is on
@@ -94,10 +106,11 @@ resource "google_compute_instance" "terraform_vm" {
     python3 -m venv /home/certstream_env
     source /home/certstream_env/bin/activate
     pip install --upgrade pip
-    pip install websocket-client google-cloud-pubsub
 
-    # Copy the producer script from GCS
-    gsutil cp gs://${var.gcs_bucket_name}/producer.py /home/producer.py
+    # Copy the producer and its modules from GCS
+    mkdir -p /home/producer
+    gsutil cp "gs://${var.gcs_bucket_name}/producer/*" /home/producer/
+    pip install -r /home/producer/requirements-producer.txt
 
     # Set PROJECT_ID
     export PROJECT_ID="${var.project}"
@@ -105,9 +118,12 @@ resource "google_compute_instance" "terraform_vm" {
     # Wait for certstream server to start
     sleep 10
 
-    # Run producer in background
-    nohup /home/certstream_env/bin/python -u /home/producer.py > /home/producer.log 2>&1 &
+    # Run producer in background, next to the modules it imports
+    cd /home/producer
+    nohup /home/certstream_env/bin/python -u producer.py > /home/producer.log 2>&1 &
   EOT
+
+  depends_on = [google_storage_bucket_object.producer_files]
 }
 
 
@@ -0,0 +1,121 @@
+"""crt.sh backfill against the local stub, plus the streaming parser and token bucket."""
+import json
+import threading
+
+import pytest
+
+import crtsh
+import crtsh_stub
+
+TERMS = ["%.com", "%.org"]
+
+
+@pytest.fixture
+def stub():
+    # Small chunks, so certificates straddle chunk boundaries
+    server = crtsh_stub.serve(port=0, synthetic=1200, chunk_size=777)
+    yield server, f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+def run_backfill(base_url, cursors, handled, flushes, passes=1):
+    backfill = crtsh.CrtShBackfill(
+        TERMS, cursors, handled.extend, lambda: flushes.append(len(handled)),
+        base_url=base_url, workers=2, rate=0, log=lambda message: None,
+    )
+    backfill.run(passes=passes)
+    backfill.session.close()
+
+
+def test_backfill_delivers_every_certificate_and_checkpoints(tmp_path, stub):
+    server, base_url = stub
+    path = str(tmp_path / "cursors.json")
+    handled, flushes = [], []
+    run_backfill(base_url, crtsh.CursorStore(path), handled, flushes)
+
+    expected = {term: crtsh_stub.synthetic_certs(term, 1200) for term in TERMS}
+    assert sorted(cert["id"] for cert in handled) == sorted(
+        cert["id"] for certs in expected.values() for cert in certs)
+    # One flush per term, after all of its certificates
+    assert len(flushes) == 2 and flushes[-1] == len(handled)
+    with open(path) as f:
+        saved = json.load(f)
+    assert saved["cursors"] == {term: certs[-1]["id"] for term, certs in expected.items()}
+
+
+def test_backfill_resumes_from_saved_cursors(tmp_path, stub):
+    server, base_url = stub
+    path = str(tmp_path / "cursors.json")
+    run_backfill(base_url, crtsh.CursorStore(path), [], [])
+
+    handled, flushes = [], []
+    run_backfill(base_url, crtsh.CursorStore(path), handled, flushes)
+    assert handled == [] and flushes == []
+    assert server.requests == 4
+
+
+def test_backfill_seeds_terms_from_single_cursor_file(tmp_path, stub):
+    server, base_url = stub
+    certs = crtsh_stub.synthetic_certs("%.com", 1200)
+    path = tmp_path / "cursors.json"
+    path.write_text(json.dumps({"max_cert_id": certs[1000]["id"]}))
+    handled = []
+    run_backfill(base_url, crtsh.CursorStore(str(path)), handled, [])
+
+    assert all(cert["id"] > certs[1000]["id"] for cert in handled)
+    assert [cert["id"] for cert in handled if cert["common_name"].endswith(".com")] == [
+        cert["id"] for cert in certs[1001:]]
+
+
+def test_backfill_keeps_cursors_when_flush_fails(tmp_path, stub):
+    server, base_url = stub
+    cursors = crtsh.CursorStore(str(tmp_path / "cursors.json"))
+    handled = []
+    backfill = crtsh.CrtShBackfill(
+        TERMS, cursors, handled.extend, lambda: False,
+        base_url=base_url, workers=2, rate=0, log=lambda message: None,
+    )
+    backfill.run(passes=1)
+    backfill.session.close()
+
+    assert len(handled) == 2400
+    assert all(cursors.get(term) is None for term in TERMS)
+    assert not (tmp_path / "cursors.json").exists()
+
+
+def test_iter_json_array_across_chunks():
+    values = [{"id": 12345, "name_value": "a.com\nb.com"}, 678, "x, ]", [1, 2.5], None]
+    text = json.dumps(values)
+    for size in (1, 2, 3, 7, len(text)):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert list(crtsh.iter_json_array(chunks)) == values
+    assert list(crtsh.iter_json_array([" [ ", "]"])) == []
+
+
+def test_iter_json_array_rejects_bad_input():
+    with pytest.raises(ValueError):
+        list(crtsh.iter_json_array(['{"id": 1}']))
+    with pytest.raises(ValueError):
+        list(crtsh.iter_json_array(['[{"id": 1}, {"id"']))
+
+
+def test_token_bucket_sleeps_outside_its_lock(monkeypatch):
+    bucket = crtsh.TokenBucket(rate=10, capacity=2)
+    sleeps = []
+
+    def sleep(seconds):
+        assert not bucket.lock.locked()
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(crtsh.time, "monotonic", lambda: 100.0)
+    monkeypatch.setattr(crtsh.time, "sleep", sleep)
+    bucket.updated = 100.0
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Two burst tokens, then each caller waits one interval longer than the last
+    assert sorted(sleeps) == pytest.approx([0.1, 0.2, 0.3])
@@ -0,0 +1,94 @@
+"""DomainDeduplicator and RotatingBloomFilter."""
+import pytest
+
+import dedup
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "time", lambda: now[0])
+    return now
+
+
+def test_filter_new_drops_repeats_within_and_across_calls():
+    dedup_ = dedup.DomainDeduplicator(window=10)
+    assert dedup_.filter_new(["a.com", "b.com", "a.com"]) == ["a.com", "b.com"]
+    assert dedup_.filter_new(["b.com", "c.com"]) == ["c.com"]
+    assert dedup_.stats() == {"recent": 3, "checked": 5, "duplicates": 2}
+
+
+def test_window_forgets_oldest_domains():
+    dedup_ = dedup.DomainDeduplicator(window=3)
+    dedup_.filter_new(["a.com", "b.com", "c.com", "d.com"])
+    assert len(dedup_) == 3
+    assert dedup_.filter_new(["a.com", "d.com"]) == ["a.com"]
+
+
+def test_ttl_expires_domains(clock):
+    dedup_ = dedup.DomainDeduplicator(window=100, ttl=60)
+    dedup_.filter_new(["a.com"])
+    clock[0] += 30
+    dedup_.filter_new(["b.com"])
+    assert dedup_.filter_new(["a.com", "b.com"]) == []
+    clock[0] += 45
+    assert dedup_.filter_new(["a.com", "b.com"]) == ["a.com"]
+
+
+def test_bloom_filter_extends_the_window():
+    dedup_ = dedup.DomainDeduplicator(window=10, bloom_capacity=1000)
+    domains = [f"host{i}.example.com" for i in range(500)]
+    assert dedup_.filter_new(domains) == domains
+    # Long gone from the exact window, still known to the filter
+    assert dedup_.filter_new(domains[:100]) == []
+    assert dedup_.stats()["bloom_duplicates"] == 100
+
+
+def test_bloom_generations_rotate():
+    bloom = dedup.RotatingBloomFilter(capacity=100, error_rate=0.001, generations=2)
+    old = [f"old{i}.com" for i in range(100)]
+    for key in old:
+        assert not bloom.add(key)
+    for i in range(200):
+        bloom.add(f"new{i}.com")
+    # Two generations later the first one has been cleared
+    assert sum(key in bloom for key in old) < 5
+    assert sum(f"new{i}.com" in bloom for i in range(100, 200)) == 100
+
+
+def test_bloom_false_positive_rate_near_target():
+    dedup_ = dedup.DomainDeduplicator(window=10, bloom_capacity=5000, bloom_error_rate=0.01)
+    dedup_.filter_new([f"host{i}.example.com" for i in range(5000)])
+    unseen = [f"other{i}.example.net" for i in range(5000)]
+    false_positives = sum(domain in dedup_.bloom for domain in unseen)
+    assert false_positives / len(unseen) < 0.03
+    assert 0 < dedup_.stats()["bloom_fp_estimated"] < 0.03
+    assert dedup_.stats()["bloom_probes"] == 50
+
+
+def test_save_and_load_round_trip(tmp_path, clock):
+    path = str(tmp_path / "dedup.npz")
+    dedup_ = dedup.DomainDeduplicator(window=5, bloom_capacity=100)
+    dedup_.filter_new([f"host{i}.com" for i in range(20)])
+    dedup_.save(path)
+
+    restored = dedup.DomainDeduplicator(window=5, bloom_capacity=100)
+    assert restored.load(path)
+    assert list(restored.recent) == list(dedup_.recent)
+    assert restored.filter_new(["host0.com", "host19.com", "new.com"]) == ["new.com"]
+
+
+def test_load_ignores_bloom_of_another_size(tmp_path):
+    path = str(tmp_path / "dedup.npz")
+    dedup_ = dedup.DomainDeduplicator(window=5, bloom_capacity=100)
+    dedup_.filter_new([f"host{i}.com" for i in range(20)])
+    dedup_.save(path)
+
+    restored = dedup.DomainDeduplicator(window=5, bloom_capacity=5000)
+    assert restored.load(path)
+    assert len(restored) == 5
+    assert restored.filter_new(["host0.com"]) == ["host0.com"]
+
+
+def test_load_without_file(tmp_path):
+    assert not dedup.DomainDeduplicator().load(str(tmp_path / "missing.npz"))
@@ -0,0 +1,57 @@
+"""Batched domain filtering, normalization and public suffixes."""
+import domains
+
+NAME_VALUES = [
+    "example.com", "*.example.com", "Sub.Example.COM.", "localhost",
+    "Terms of use at https://www.verisign.com/rpa (c)05", "(c)2024 Entrust, Inc.",
+    "see www.example.com", "copyright.example.org", "visit.example.org", "www.example.net",
+    "incits.org", "repository.example.org", "go.example.com",
+]
+
+
+def test_filter_domains_matches_per_domain_checks():
+    expected = [d for d in NAME_VALUES if domains.is_valid_domain(d)]
+    assert domains.filter_domains(NAME_VALUES) == expected
+    # Metadata words without a space reject any name containing them
+    assert expected == ["example.com", "Sub.Example.COM.", "www.example.net", "go.example.com"]
+
+
+def test_filter_domains_falls_back_for_odd_input():
+    # "İ" grows when lowercased, and an embedded newline breaks the joined scan
+    batch = ["İstanbul.example.com", "a.com\nb.com", "*.x.com", "x.com"]
+    assert domains.filter_domains(batch) == [d for d in batch if domains.is_valid_domain(d)]
+
+
+def test_filter_domains_without_invalid_substrings():
+    assert domains.filter_domains(["a.com", "nodot", "b.org"]) == ["a.com", "b.org"]
+    assert domains.filter_domains([]) == []
+
+
+def test_normalize_domains():
+    assert domains.normalize_domains([" Example.COM. ", "b.org"]) == ["example.com", "b.org"]
+    assert domains.normalize_domains(["Bücher.example", "a.com"]) == ["xn--bcher-kva.example", "a.com"]
+
+
+def test_public_suffix_rules():
+    psl = domains.PublicSuffixList(["com", "co.uk", "*.ck", "!www.ck"])
+    assert psl.public_suffix("a.b.example.co.uk") == "co.uk"
+    assert psl.registered_domain("a.b.example.co.uk") == "example.co.uk"
+    assert psl.registered_domain("foo.bar.ck") == "foo.bar.ck"
+    assert psl.registered_domain("www.ck") == "www.ck"
+    assert psl.registered_domain("co.uk") is None
+    assert psl.is_public_suffix("co.uk") and psl.is_public_suffix("bar.ck")
+    assert not psl.is_public_suffix("www.ck") and not psl.is_public_suffix("example.com")
+
+
+def test_public_suffix_list_file(tmp_path):
+    path = tmp_path / "public_suffix_list.dat"
+    path.write_text("// comment\ncom\n\nexample.com  // private\n")
+    psl = domains.PublicSuffixList.load(str(path))
+    assert psl.registered_domain("a.b.example.com") == "b.example.com"
+    assert domains.PublicSuffixList.load(str(tmp_path / "missing.dat")).rules == set(domains.DEFAULT_SUFFIXES)
+
+
+def test_clean_domains(monkeypatch):
+    monkeypatch.setattr(domains, "_public_suffixes", domains.PublicSuffixList())
+    batch = ["Example.COM.", "*.example.com", "co.uk", "shop.example.co.uk", "(c)2024 CA", "github.io"]
+    assert domains.clean_domains(batch) == ["example.com", "shop.example.co.uk"]
@@ -0,0 +1,55 @@
+"""encode_urls() against the model's own TextVectorization layer."""
+import os
+
+import numpy as np
+import pytest
+
+import evaluating_url
+
+URLS = [
+    "https://www.Example.com/Path?q=1&x=2",
+    "HTTP://WWW.UPPER.example/INDEX.HTML",
+    "http://login.bank.example/secure/update#account",
+    # Whitespace and characters the vectorizer strips
+    "tab\there and space/a b\nnew line",
+    "~user/[x]{y}|z\\'\"",
+    # Non-ASCII, mostly out of the vocabulary
+    "http://пример.рф/путь",
+    "ÜBER.de/straße",
+    "İstanbul.tr",
+    "日本語.jp/パス?😀",
+    # Longer than SEQUENCE_LENGTH ids, and than MAX_URL_CHARS characters
+    "http://long.example/" + "a1" * 150,
+    "x" * 600,
+    "",
+    "https://",
+]
+
+
+@pytest.fixture(scope="module")
+def vectorizer():
+    tf = pytest.importorskip("tensorflow")
+    if not os.path.exists(evaluating_url.MODEL_PATH):
+        pytest.skip(f"{evaluating_url.MODEL_PATH} not found")
+    model = tf.keras.models.load_model(evaluating_url.MODEL_PATH)
+    return next(layer for layer in model.layers if isinstance(layer, tf.keras.layers.TextVectorization))
+
+
+def test_encode_urls_matches_text_vectorization(vectorizer):
+    table = evaluating_url.build_lookup_table(vectorizer.get_vocabulary())
+    expected = vectorizer(np.array([evaluating_url.preprocess_url(url) for url in URLS])).numpy()
+    encoded = evaluating_url.encode_urls(URLS, table)
+
+    assert encoded.shape == (len(URLS), evaluating_url.SEQUENCE_LENGTH)
+    for url, want, got in zip(URLS, expected, encoded):
+        np.testing.assert_array_equal(got, want, err_msg=repr(url))
+    # The cases above do reach the out-of-vocabulary id, padding and truncation
+    assert (encoded == evaluating_url.OOV_ID).any()
+    assert (encoded[:, -1] == 0).any() and (encoded[:, -1] != 0).any()
+
+
+def test_encode_urls_falls_back_for_embedded_newlines(vectorizer):
+    table = evaluating_url.build_lookup_table(vectorizer.get_vocabulary())
+    urls = ["a\nb", "http://c.example/"]
+    np.testing.assert_array_equal(evaluating_url.encode_urls(urls, table),
+                                  vectorizer(np.array([evaluating_url.preprocess_url(url) for url in urls])).numpy())
@@ -0,0 +1,72 @@
+"""InferencePool against the in-process model, and respawning dead replicas."""
+import os
+import signal
+
+import numpy as np
+import pytest
+
+import evaluating_url
+import inference_pool
+
+URLS = [f"http://host{i}.example/{'path/' * (i % 7)}?q={i}" for i in range(300)] + [
+    "paypal-login.secure-update.example", "https://www.google.com/", "xn--80ak6aa92e.com"]
+
+
+@pytest.fixture(scope="module")
+def model():
+    pytest.importorskip("tensorflow")
+    if not os.path.exists(evaluating_url.MODEL_PATH):
+        pytest.skip(f"{evaluating_url.MODEL_PATH} not found")
+    predict, table = evaluating_url.get_predictor()
+    encoded = evaluating_url.encode_urls(URLS, table)
+    return encoded, predict(encoded)
+
+
+@pytest.fixture(scope="module")
+def pool(model):
+    # Small buffers, so a call is split into chunks across both replicas
+    pool = inference_pool.InferencePool(2, max_rows=64, sequence_length=evaluating_url.SEQUENCE_LENGTH,
+                                        log=lambda message: None)
+    yield pool
+    pool.close()
+
+
+def kill(replica):
+    os.kill(replica.process.pid, signal.SIGKILL)
+    replica.process.join(10)
+
+
+def test_pool_scores_match_the_in_process_model(model, pool):
+    encoded, expected = model
+    np.testing.assert_allclose(pool(encoded), expected, atol=1e-5)
+    assert pool(encoded[:0]).shape == (0, 1)
+
+
+def test_dead_replica_is_respawned_and_its_chunk_rescored(model, pool):
+    encoded, expected = model
+    respawns = pool.respawns
+    victim = pool.replicas[0]
+    kill(victim)
+
+    np.testing.assert_allclose(pool(encoded), expected, atol=1e-5)
+    assert pool.respawns == respawns + 1
+    assert len(pool.replicas) == 2 and victim not in pool.replicas
+    assert all(replica.process.is_alive() for replica in pool.replicas)
+
+
+def test_chunk_that_keeps_killing_replicas_raises(model, pool, monkeypatch):
+    encoded, expected = model
+    submit = inference_pool.Replica.submit
+
+    def submit_and_die(replica, chunk):
+        submit(replica, chunk)
+        kill(replica)
+
+    monkeypatch.setattr(inference_pool.Replica, "submit", submit_and_die)
+    with pytest.raises(inference_pool.ReplicaDied):
+        pool(encoded[:10])
+    monkeypatch.undo()
+
+    # The replicas it killed were respawned, and the pool still scores
+    assert len(pool.replicas) == 2
+    np.testing.assert_allclose(pool(encoded), expected, atol=1e-5)
@@ -0,0 +1,33 @@
+"""The Cloud Function zip holds every local module the scorer imports."""
+import subprocess
+import sys
+import zipfile
+
+import package_function
+
+PROBE = """
+import os, sys
+import evaluating_url, inference_pool, segments
+root = os.path.dirname(os.path.abspath(evaluating_url.__file__))
+for module in list(sys.modules.values()):
+    path = getattr(module, "__file__", None) or ""
+    if os.path.dirname(os.path.abspath(path)) == root:
+        print(os.path.basename(path))
+"""
+
+
+def test_function_files_cover_the_scorer_imports():
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=package_function.ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    assert set(output.split()) <= set(package_function.FUNCTION_FILES)
+
+
+def test_build(tmp_path):
+    output = tmp_path / "function.zip"
+    package_function.build(str(output))
+    with zipfile.ZipFile(output) as archive:
+        assert archive.namelist() == list(package_function.FUNCTION_FILES)
+        requirements = archive.read("requirements.txt").decode()
+    for line in requirements.splitlines():
+        if line.startswith("-r "):
+            assert line[3:] in package_function.FUNCTION_FILES
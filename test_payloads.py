@@ -0,0 +1,76 @@
+"""Payload codecs, DomainBatcher's flush triggers and decoding on the scorer side."""
+import gzip
+import json
+
+import pytest
+
+import evaluating_url
+import payloads
+
+URLS = ["a.example", "b.example", "пример.рф", "*.wild.example"]
+
+
+@pytest.mark.parametrize("compression, magic", [
+    ("none", b'{"urls"'), ("gzip", payloads.GZIP_MAGIC), ("zstd", payloads.ZSTD_MAGIC)])
+def test_round_trip(compression, magic):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    data = payloads.encode_payload(URLS, compression)
+    assert data.startswith(magic)
+    assert payloads.decode_payload(data) == URLS
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        payloads.encode_payload(URLS, "brotli")
+    with pytest.raises(ValueError):
+        payloads.DomainBatcher(compression="brotli")
+
+
+def test_scorer_decodes_single_certificate_messages():
+    # What the producer published before payloads were batched: one
+    # certificate's domains, wildcards included, as plain JSON
+    old = json.dumps({"urls": ["example.com", "*.example.com", "www.example.com"]}).encode("utf-8")
+    assert evaluating_url.decode_urls(old) == ["example.com", "www.example.com"]
+    assert evaluating_url.decode_urls(json.dumps({}).encode("utf-8")) == []
+    assert evaluating_url.decode_urls(gzip.compress(old)) == ["example.com", "www.example.com"]
+
+
+def test_batcher_flushes_on_url_count():
+    batcher = payloads.DomainBatcher(max_urls=3, linger=60)
+    assert batcher.add(["a.example", "b.example", "a.example"], cleaned=True) == []
+    [(data, count)] = batcher.add(["c.example", "d.example"], cleaned=True)
+    assert count == 3 and payloads.decode_payload(data) == ["a.example", "b.example", "c.example"]
+    assert batcher.flush() == (payloads.encode_payload(["d.example"]), 1)
+    assert batcher.flush() is None
+
+
+def test_batcher_flushes_on_size():
+    domain = "x" * 40 + ".example"
+    per_domain = len(domain) + payloads.DOMAIN_OVERHEAD_BYTES
+    batcher = payloads.DomainBatcher(max_urls=1000, max_bytes=payloads.PAYLOAD_OVERHEAD_BYTES + 3 * per_domain)
+    ready = batcher.add([f"{i}{domain}" for i in range(7)], cleaned=True)
+    assert [count for _, count in ready] == [3, 3]
+    # The estimate bounds the real encoded size
+    assert all(len(data) <= batcher.max_bytes + 3 for data, _ in ready)
+
+
+def test_batcher_flushes_on_linger():
+    batcher = payloads.DomainBatcher(linger=1.0)
+    assert batcher.deadline is None and batcher.poll() is None
+    batcher.add(["a.example"], cleaned=True)
+    deadline = batcher.deadline
+    assert batcher.poll(now=deadline - 0.01) is None
+    data, count = batcher.poll(now=deadline)
+    assert count == 1 and payloads.decode_payload(data) == ["a.example"]
+    assert batcher.deadline is None
+
+
+def test_batcher_cleans_domains():
+    batcher = payloads.DomainBatcher(compression="gzip")
+    batcher.add(["Good.Example.", "*.wild.example", "not a domain", "good.example"])
+    data, count = batcher.flush()
+    assert data.startswith(payloads.GZIP_MAGIC)
+    assert payloads.decode_payload(data) == ["good.example"] and count == 1
+    # The duplicate is merged, not filtered
+    assert batcher.filtered == 2
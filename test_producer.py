@@ -0,0 +1,88 @@
+"""The producer's rate limit and its queue drop policies."""
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("websockets")
+pytest.importorskip("google.cloud.pubsub_v1")
+
+import producer
+
+
+def test_default_policy_blocks():
+    assert producer.DROP_POLICY == "block"
+
+
+def test_token_bucket_bursts_then_paces():
+    async def scenario():
+        bucket = producer.TokenBucket(rate=200, capacity=5)
+        started = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(10):
+            await bucket.acquire()
+        return burst, time.monotonic() - started
+
+    burst, total = asyncio.run(scenario())
+    assert burst < 0.02
+    # Ten more tokens at 200 per second
+    assert 0.045 <= total < 0.5
+
+
+def test_token_bucket_without_rate_never_waits():
+    async def scenario():
+        bucket = producer.TokenBucket(rate=0, capacity=1)
+        started = time.monotonic()
+        for _ in range(1000):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.1
+
+
+def full_queue():
+    queue = asyncio.Queue(maxsize=2)
+    queue.put_nowait("first")
+    queue.put_nowait("second")
+    return queue
+
+
+def drain(queue):
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+
+def test_offer_drop_newest():
+    async def scenario():
+        queue, stats = full_queue(), producer.ProducerStats()
+        await producer.offer(queue, "third", stats, "drop-newest")
+        return drain(queue), stats.dropped
+
+    assert asyncio.run(scenario()) == (["first", "second"], 1)
+
+
+def test_offer_drop_oldest():
+    async def scenario():
+        queue, stats = full_queue(), producer.ProducerStats()
+        await producer.offer(queue, "third", stats, "drop-oldest")
+        # The dropped payload counts as done, so join() doesn't wait for it
+        for _ in range(queue.qsize()):
+            queue.task_done()
+        await asyncio.wait_for(queue.join(), 1)
+        return drain(queue), stats.dropped
+
+    assert asyncio.run(scenario()) == (["second", "third"], 1)
+
+
+def test_offer_block_waits_for_room():
+    async def scenario():
+        queue, stats = full_queue(), producer.ProducerStats()
+        offered = asyncio.create_task(producer.offer(queue, "third", stats, "block"))
+        await asyncio.sleep(0.01)
+        assert not offered.done()
+        assert queue.get_nowait() == "first"
+        await asyncio.wait_for(offered, 1)
+        return drain(queue), stats.dropped
+
+    assert asyncio.run(scenario()) == (["second", "third"], 0)
@@ -0,0 +1,96 @@
+"""The crt.sh producer's publishing: failed publishes hold the cursor and are retried."""
+import os
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("google.cloud.pubsub_v1")
+
+import crtsh
+import crtsh_stub
+import payloads
+from dedup import DomainDeduplicator
+
+# The publisher client is built on import; the emulator setting spares it credentials
+with pytest.MonkeyPatch.context() as patch:
+    patch.setenv("PUBSUB_EMULATOR_HOST", os.environ.get("PUBSUB_EMULATOR_HOST", "localhost:1"))
+    import reserved_producer
+
+threading.Thread(target=reserved_producer.publish_loop, name="publisher", daemon=True).start()
+
+
+class FakePublisher:
+    """Resolves each publish at once, failing while `failing` is set."""
+
+    def __init__(self, failing="future"):
+        self.failing = failing
+        self.published = []
+
+    def publish(self, topic, data, **attributes):
+        if self.failing == "raise":
+            raise RuntimeError("publish rejected")
+        future = Future()
+        if self.failing == "future":
+            future.set_exception(RuntimeError("publish failed"))
+        else:
+            self.published.append(data)
+            future.set_result(str(len(self.published)))
+        return future
+
+
+@pytest.fixture
+def producer(monkeypatch, tmp_path):
+    publisher = FakePublisher()
+    monkeypatch.setattr(reserved_producer, "publisher", publisher)
+    monkeypatch.setattr(reserved_producer, "publish_bucket", crtsh.TokenBucket(0))
+    monkeypatch.setattr(reserved_producer, "batcher", payloads.DomainBatcher(max_urls=100))
+    monkeypatch.setattr(reserved_producer, "recent_domains", DomainDeduplicator(100_000))
+    monkeypatch.setattr(reserved_producer, "DEDUP_STATE_FILE", str(tmp_path / "dedup.npz"))
+    monkeypatch.setattr(reserved_producer, "failed_payloads", [])
+    monkeypatch.setattr(reserved_producer, "outstanding", [])
+    return publisher
+
+
+def published_domains(publisher):
+    return {domain for data in publisher.published for domain in payloads.decode_payload(data)}
+
+
+@pytest.mark.parametrize("failing", ["future", "raise"])
+def test_failed_publish_is_retried_on_the_next_flush(producer, failing):
+    producer.failing = failing
+    reserved_producer.handle_certs([{"name_value": "a.example\nb.example", "common_name": "a.example"}])
+    assert reserved_producer.flush_batches() is False
+    assert len(reserved_producer.failed_payloads) == 1
+
+    producer.failing = None
+    assert reserved_producer.flush_batches() is True
+    assert published_domains(producer) == {"a.example", "b.example"}
+    assert reserved_producer.failed_payloads == []
+
+
+def test_backfill_with_failing_publisher_keeps_cursors(producer, tmp_path):
+    server = crtsh_stub.serve(port=0, synthetic=300)
+    try:
+        cursors = crtsh.CursorStore(str(tmp_path / "cursors.json"))
+        backfill = crtsh.CrtShBackfill(
+            ["%.com"], cursors, reserved_producer.handle_certs, reserved_producer.flush_batches,
+            base_url=f"http://127.0.0.1:{server.server_address[1]}/", rate=0, log=lambda message: None,
+        )
+        backfill.run(passes=1)
+        assert cursors.get("%.com") is None and producer.published == []
+
+        # The second poll fetches the same certificates; the dedup window
+        # drops them, and the retried payloads carry them instead
+        producer.failing = None
+        backfill.next_due["%.com"] = 0
+        backfill.run(passes=1)
+        backfill.session.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    certs = crtsh_stub.synthetic_certs("%.com", 300)
+    assert cursors.get("%.com") == certs[-1]["id"]
+    assert published_domains(producer) == {
+        domain for cert in certs for domain in reserved_producer.cert_domains(cert)}
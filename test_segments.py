@@ -0,0 +1,96 @@
+"""Hourly segments: writes, and merges that never show a row twice."""
+import datetime
+import glob
+import os
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+import segments
+
+HOUR = datetime.datetime(2026, 1, 2, 3, tzinfo=datetime.timezone.utc)
+
+
+def table(writer, *urls, minute=0):
+    moment = HOUR + datetime.timedelta(minutes=minute)
+    return pa.Table.from_pylist([{"url": url, "score": 0.5, "classification": "BENIGN", "time_added": moment}
+                                 for url in urls], schema=writer.schema)
+
+
+def visible_urls(root):
+    """The rows a *.parquet scan sees, as the dashboard's DuckDB backend globs them."""
+    paths = glob.glob(os.path.join(root, "**", "*.parquet"), recursive=True)
+    return sorted(url for path in paths for url in pq.read_table(path).column("url").to_pylist())
+
+
+def test_merge_replaces_the_segments_of_an_hour(tmp_path):
+    writer = segments.SegmentWriter(str(tmp_path), "test", compact_after=0)
+    writer.write(table(writer, "http://b/", minute=5), HOUR)
+    writer.write(table(writer, "http://a/", minute=1), HOUR)
+    assert writer.compact() == (1, [])
+
+    paths = list(tmp_path.glob("date=2026-01-02/hour=03/*"))
+    assert len(paths) == 1 and paths[0].name.startswith(writer.writer_id) and paths[0].suffix == ".parquet"
+    merged = pq.read_table(paths[0])
+    assert merged.column("url").to_pylist() == ["http://a/", "http://b/"]
+    assert writer.open_hours == set()
+
+    # Late rows start a new segment, merged with the first merge
+    writer.write(table(writer, "http://c/", minute=2), HOUR)
+    writer.compact()
+    assert visible_urls(tmp_path) == ["http://a/", "http://b/", "http://c/"]
+    assert len(list(tmp_path.glob("**/*.parquet"))) == 1
+
+
+def test_open_hours_wait_for_compact_after(tmp_path):
+    writer = segments.SegmentWriter(str(tmp_path), "test", compact_after=10 ** 9)
+    writer.write(table(writer, "http://a/"), HOUR)
+    writer.write(table(writer, "http://b/"), HOUR)
+    assert writer.compact() == (0, [])
+    assert len(list(tmp_path.glob("**/*.parquet"))) == 2
+
+
+def test_failed_remove_never_doubles_rows(tmp_path, monkeypatch):
+    writer = segments.SegmentWriter(str(tmp_path), "test", compact_after=0)
+    writer.write(table(writer, "http://a/"), HOUR)
+    writer.write(table(writer, "http://b/"), HOUR)
+
+    remove = os.remove
+    calls = []
+
+    def flaky_remove(path):
+        calls.append(path)
+        if len(calls) == 2:
+            raise PermissionError(path)
+        remove(path)
+
+    monkeypatch.setattr(segments.os, "remove", flaky_remove)
+    merged, failed = writer.compact()
+    assert merged == 0 and isinstance(failed[0][1], PermissionError)
+    # The merge waits under a name the scan skips; the second segment is still there
+    assert len(list(tmp_path.glob("**/*.parquet" + segments.MERGING))) == 1
+    assert visible_urls(tmp_path) == ["http://b/"]
+
+    monkeypatch.setattr(segments.os, "remove", remove)
+    assert writer.compact() == (1, [])
+    assert visible_urls(tmp_path) == ["http://a/", "http://b/"]
+    files = [path for path in tmp_path.glob("**/*") if path.is_file()]
+    assert len(files) == 1 and files[0].suffix == ".parquet"
+
+
+def test_merge_left_by_a_crash_is_finished_on_open(tmp_path, monkeypatch):
+    crashed = segments.SegmentWriter(str(tmp_path), "test", compact_after=0)
+    crashed.write(table(crashed, "http://a/"), HOUR)
+    crashed.write(table(crashed, "http://b/"), HOUR)
+    # Stops right after the merge is written
+    monkeypatch.setattr(crashed, "finish", lambda path: None)
+    crashed.compact()
+    assert visible_urls(tmp_path) == ["http://a/", "http://b/"]
+    assert len(list(tmp_path.glob("**/*.parquet"))) == 2
+
+    segments.SegmentWriter(str(tmp_path), "test")
+    assert visible_urls(tmp_path) == ["http://a/", "http://b/"]
+    assert len(list(tmp_path.glob("**/*.parquet"))) == 1
+    assert not list(tmp_path.glob("**/*" + segments.MERGING))
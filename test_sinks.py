@@ -0,0 +1,304 @@
+"""Local sinks and BufferedWriter, end to end without GCP."""
+import datetime
+import json
+import sqlite3
+
+import numpy as np
+import pytest
+
+import sinks
+
+# 2026-01-02 03:04:05 UTC
+BASE_MICROS = 1767323045 * 1000000
+
+
+def make_columns(urls, offset_micros=0, trace_ids=None):
+    count = len(urls)
+    columns = {
+        "url": np.array(urls, dtype=object),
+        "score": np.linspace(0.1, 0.9, count),
+        "classification": np.array(["benign", "malicious"] * count, dtype=object)[:count],
+        "time_added": np.full(count, BASE_MICROS + offset_micros, dtype=np.int64),
+    }
+    if trace_ids is not None:
+        columns[sinks.TRACE_COLUMN] = np.array(trace_ids, dtype=object)
+    return columns
+
+
+class FlakySink:
+    """Fails the first `failures` writes, then records the batches."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = 0
+        self.batches = []
+
+    def write_batch(self, columns):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise sinks.SinkError(f"attempt {self.attempts} failed")
+        self.batches.append(columns)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the writer's backoff delays instead of sleeping."""
+    delays = []
+    monkeypatch.setattr(sinks.time, "sleep", delays.append)
+    return delays
+
+
+def run_writer(sink, batches, tmp_path, **kwargs):
+    """Submits batches, flushes, closes; returns (writer, statuses)."""
+    statuses = []
+    writer = sinks.BufferedWriter(sink, dead_letter_path=str(tmp_path / "dead.ndjson"),
+                                  log=lambda message: None, **kwargs)
+    for columns in batches:
+        writer.submit(columns, on_done=statuses.append)
+    assert writer.flush(timeout=10)
+    writer.close(timeout=10)
+    return writer, statuses
+
+
+def test_file_sink_writes_ndjson(tmp_path):
+    path = tmp_path / "rows.ndjson"
+    sink = sinks.FileSink(str(path))
+    sink.write_batch(make_columns(["http://a.example/", 'http://b.example/"q"']))
+    sink.write_batch(make_columns(["http://c.example/"], trace_ids=["t-1"]))
+
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [row["url"] for row in rows] == ["http://a.example/", 'http://b.example/"q"', "http://c.example/"]
+    assert rows[0]["time_added"] == "2026-01-02T03:04:05+00:00"
+    assert "trace_id" not in rows[0]
+    assert rows[2]["trace_id"] == "t-1"
+
+
+def test_sqlite_sink_rows_read_back(tmp_path):
+    path = str(tmp_path / "rows.db")
+    sink = sinks.SQLiteSink(path)
+    sink.write_batch(make_columns(["http://a.example/", "http://b.example/"]))
+    sink.write_batch(make_columns(["http://c.example/"], trace_ids=["t-1"]))
+    sink.close()
+
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT url, score, classification, time_added, trace_id "
+                            "FROM classified_urls ORDER BY url").fetchall()
+    assert rows == [
+        ("http://a.example/", 0.1, "benign", "2026-01-02T03:04:05+00:00", None),
+        ("http://b.example/", 0.9, "malicious", "2026-01-02T03:04:05+00:00", None),
+        ("http://c.example/", 0.1, "benign", "2026-01-02T03:04:05+00:00", "t-1"),
+    ]
+
+
+def test_sqlite_sink_adds_trace_column_to_old_table(tmp_path):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE classified_urls (url TEXT, score REAL, classification TEXT, time_added TEXT)")
+    sink = sinks.SQLiteSink(path)
+    sink.write_batch(make_columns(["http://a.example/"], trace_ids=["t-1"]))
+    sink.close()
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT url, trace_id FROM classified_urls").fetchall() == [("http://a.example/", "t-1")]
+
+
+def test_parquet_sink_partitions_by_hour(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = sinks.ParquetSink(str(tmp_path))
+    columns = sinks.concat_columns([
+        make_columns(["http://late.example/"], offset_micros=sinks.HOUR_MICROS),
+        make_columns(["http://b.example/", "http://a.example/"]),
+    ])
+    sink.write_batch(columns)
+
+    paths = sorted(tmp_path.glob("date=*/hour=*/*.parquet"))
+    assert [path.parent.relative_to(tmp_path).as_posix() for path in paths] == [
+        "date=2026-01-02/hour=03", "date=2026-01-02/hour=04"]
+    rows = pq.read_table(paths[0]).to_pylist()
+    assert [row["url"] for row in rows] == ["http://b.example/", "http://a.example/"]
+    assert rows[0]["time_added"] == datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    assert rows[0]["trace_id"] is None
+    assert pq.read_table(paths[1]).column("url").to_pylist() == ["http://late.example/"]
+
+
+def test_parquet_sink_compacts_closed_hours(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = sinks.ParquetSink(str(tmp_path), compact_after=0)
+    sink.write_batch(make_columns(["http://a.example/"], offset_micros=1))
+    sink.write_batch(make_columns(["http://b.example/"]))
+
+    # The hour ended years ago, so the second batch merges both segments
+    paths = list(tmp_path.glob("date=*/hour=*/*.parquet"))
+    assert len(paths) == 1
+    assert pq.read_table(paths[0]).column("url").to_pylist() == ["http://b.example/", "http://a.example/"]
+    assert not list(tmp_path.glob("**/*.tmp"))
+
+
+def test_buffered_writer_coalesces_batches(tmp_path, sleeps):
+    sink = FlakySink(failures=0)
+    writer, statuses = run_writer(sink, [make_columns(["http://a.example/"]), make_columns(["http://b.example/"])],
+                                  tmp_path, max_latency=60)
+
+    assert statuses == [sinks.WRITTEN, sinks.WRITTEN]
+    assert len(sink.batches) == 1
+    assert sink.batches[0]["url"].tolist() == ["http://a.example/", "http://b.example/"]
+    assert writer.stats()["rows_written"] == 2
+    assert sleeps == []
+
+
+def test_buffered_writer_retries_with_backoff(tmp_path, sleeps):
+    sink = FlakySink(failures=2)
+    writer, statuses = run_writer(sink, [make_columns(["http://a.example/"])], tmp_path, backoff=0.5)
+
+    assert statuses == [sinks.WRITTEN]
+    assert sink.attempts == 3
+    assert sleeps == [0.5, 1.0]
+    assert writer.stats()["retries"] == 2
+    assert not (tmp_path / "dead.ndjson").exists()
+
+
+def test_buffered_writer_dead_letters_after_max_attempts(tmp_path, sleeps):
+    sink = FlakySink(failures=10)
+    writer, statuses = run_writer(sink, [make_columns(["http://a.example/", "http://b.example/"])],
+                                  tmp_path, max_attempts=3, backoff=0.25)
+
+    assert statuses == [sinks.DEAD_LETTER]
+    assert sink.attempts == 3
+    assert sleeps == [0.25, 0.5]
+    rows = [json.loads(line) for line in (tmp_path / "dead.ndjson").read_text().splitlines()]
+    assert [row["url"] for row in rows] == ["http://a.example/", "http://b.example/"]
+    assert writer.stats()["rows_dead_lettered"] == 2
+
+
+def test_buffered_writer_reports_failed_when_spill_fails(tmp_path, sleeps):
+    sink = FlakySink(failures=10)
+    statuses = []
+    # A directory cannot be opened for appending
+    writer = sinks.BufferedWriter(sink, max_attempts=2, dead_letter_path=str(tmp_path), log=lambda message: None)
+    writer.submit(make_columns(["http://a.example/"]), on_done=statuses.append)
+    writer.close(timeout=10)
+
+    assert statuses == [sinks.FAILED]
+    assert writer.stats()["rows_dead_lettered"] == 0
+
+
+def test_buffered_writer_writes_to_sqlite_end_to_end(tmp_path, sleeps):
+    path = str(tmp_path / "rows.db")
+    batches = [make_columns([f"http://{i}.example/"]) for i in range(5)]
+    writer, statuses = run_writer(sinks.SQLiteSink(path), batches, tmp_path, max_rows=2)
+
+    assert statuses == [sinks.WRITTEN] * 5
+    assert writer.stats()["batches_written"] == 3
+    with sqlite3.connect(path) as conn:
+        urls = [row[0] for row in conn.execute("SELECT url FROM classified_urls ORDER BY rowid")]
+    assert urls == [f"http://{i}.example/" for i in range(5)]
+
+
+def test_open_sink_specs(tmp_path):
+    assert isinstance(sinks.open_sink(f"file:///{tmp_path}/rows.ndjson", "p", "d", "t"), sinks.FileSink)
+    assert isinstance(sinks.open_sink(f"sqlite:///{tmp_path}/rows.db", "p", "d", "t"), sinks.SQLiteSink)
+    with pytest.raises(ValueError):
+        sinks.open_sink("kafka://broker", "p", "d", "t")
+
+
+class FakeWriteClient:
+    """Committed streams that keep their rows and check append offsets."""
+
+    def __init__(self):
+        self.streams = {}
+
+    def table_path(self, project, dataset, table):
+        return f"projects/{project}/datasets/{dataset}/tables/{table}"
+
+    def create_write_stream(self, parent, write_stream):
+        name = f"{parent}/streams/{len(self.streams)}"
+        self.streams[name] = []
+        return type("WriteStream", (), {"name": name})()
+
+
+class FakeAppendRowsStream:
+    """Appends on send(); `lose` answers of the next appends time out."""
+
+    lose = 0
+
+    def __init__(self, client, template):
+        self.client = client
+        self.name = template.write_stream
+
+    def send(self, request):
+        from concurrent.futures import Future
+        from google.api_core import exceptions
+
+        rows = self.client.streams[self.name]
+        future = Future()
+        if request.offset < len(rows):
+            future.set_exception(exceptions.AlreadyExists("offset already written"))
+            return future
+        rows.extend(request.proto_rows.rows.serialized_rows)
+        if FakeAppendRowsStream.lose:
+            FakeAppendRowsStream.lose -= 1
+            future.set_exception(TimeoutError("answer lost"))
+        else:
+            future.set_result(type("Response", (), {"row_errors": []})())
+        return future
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def storage_sink(monkeypatch):
+    pytest.importorskip("google.cloud.bigquery_storage_v1")
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import writer
+
+    client = FakeWriteClient()
+    monkeypatch.setattr(bigquery_storage_v1, "BigQueryWriteClient", lambda: client)
+    monkeypatch.setattr(writer, "AppendRowsStream", FakeAppendRowsStream)
+    monkeypatch.setattr(FakeAppendRowsStream, "lose", 0)
+    return sinks.BigQueryStorageSink("project", "dataset", "table"), client
+
+
+def test_storage_sink_retry_after_lost_answer_writes_once(tmp_path, sleeps, storage_sink):
+    sink, client = storage_sink
+    FakeAppendRowsStream.lose = 1
+    batches = [make_columns(["http://a.example/", "http://b.example/"])]
+    writer, statuses = run_writer(sink, batches, tmp_path)
+    writer, more = run_writer(sink, [make_columns(["http://c.example/"])], tmp_path)
+
+    assert statuses + more == [sinks.WRITTEN, sinks.WRITTEN]
+    assert len(sleeps) == 1
+    [rows] = client.streams.values()
+    assert [sink.row_class.FromString(row).url for row in rows] == [
+        "http://a.example/", "http://b.example/", "http://c.example/"]
+
+
+def test_storage_sink_moves_on_after_unconfirmed_batch(tmp_path, sleeps, storage_sink):
+    sink, client = storage_sink
+    FakeAppendRowsStream.lose = 1
+    writer, statuses = run_writer(sink, [make_columns(["http://a.example/"])], tmp_path, max_attempts=1)
+    writer, more = run_writer(sink, [make_columns(["http://b.example/"])], tmp_path)
+
+    # The first batch landed but was dead-lettered; the next one is not lost
+    assert statuses + more == [sinks.DEAD_LETTER, sinks.WRITTEN]
+    urls = [[sink.row_class.FromString(row).url for row in rows] for rows in client.streams.values()]
+    assert urls == [["http://a.example/"], ["http://b.example/"]]
+
+
+@pytest.mark.parametrize("trace_ids", [None, ["t-1", "", "t-1"]])
+def test_proto_rows_match_the_message_class(storage_sink, trace_ids):
+    # storage_sink stands in for the client
+    sink = sinks.BigQueryStorageSink("project", "dataset", "table", trace_ids=trace_ids is not None)
+    urls = ["http://a.example/", "http://пример.рф/" + "x" * 300, ""]
+    columns = make_columns(urls, trace_ids=trace_ids)
+    columns["score"] = np.array([0.0, 0.25, 1.0])
+    columns["classification"] = np.array(["BENIGN", "MALICIOUS", "BENIGN"])
+    columns["time_added"] = columns["time_added"] + np.array([0, 1, 2 ** 40])
+
+    names = sinks.column_names(columns)
+    expected = [sink.row_class(**dict(zip(names, row))).SerializeToString()
+                for row in zip(*(columns[name].tolist() for name in names))]
+    assert sinks.proto_rows(columns) == expected
@@ -0,0 +1,95 @@
+"""SpaceSaving and HyperLogLog: bounds, merges and copies."""
+import json
+
+import pytest
+
+from summaries import HyperLogLog, SpaceSaving, hash64
+
+
+def stream(counts):
+    """Items in an interleaved order, each repeated its count."""
+    items = []
+    for round_ in range(max(counts.values())):
+        items += [item for item, count in counts.items() if count > round_]
+    return items
+
+
+def test_hash64_is_stable():
+    assert hash64("example.com") == hash64("example.com") < 2 ** 64
+    assert hash64("example.com") != hash64("example.org")
+
+
+def test_space_saving_exact_under_capacity():
+    sketch = SpaceSaving(capacity=10)
+    for item in stream({"a": 5, "b": 3, "c": 1}):
+        sketch.add(item, score_sum=0.5)
+    assert sketch.top(2) == [("a", 5, 0, 0.5), ("b", 3, 0, 0.5)]
+
+
+def test_space_saving_counts_overestimate_within_error():
+    counts = {f"d{i}": 1 + (i * 7919) % 50 for i in range(400)}
+    counts.update(heavy=500, heavier=800)
+    sketch = SpaceSaving(capacity=20)
+    for item in stream(counts):
+        sketch.add(item)
+    assert len(sketch.entries) <= 40
+    assert [item for item, *_ in sketch.top(2)] == ["heavier", "heavy"]
+    for item, count, error, _ in sketch.top(20):
+        assert count - error <= counts[item] <= count
+
+
+def test_space_saving_merge_adds_counts_and_errors():
+    left, right = SpaceSaving(capacity=2), SpaceSaving(capacity=2)
+    for item in stream({"a": 4, "b": 2, "c": 1, "d": 1, "e": 1}):
+        left.add(item)
+    for item in stream({"a": 1, "f": 3}):
+        right.add(item)
+    floor = left.floor
+    left.merge(right)
+    assert left.floor == floor + right.floor
+    assert dict((item, count) for item, count, _, _ in left.top(10))["a"] == 5
+    # Missing from left, so counted as left's floor with that much error
+    assert left.entries["f"] == [floor + 3, floor, 0.0]
+
+
+def test_space_saving_copy_shares_nothing():
+    sketch = SpaceSaving(capacity=5)
+    sketch.add("a", 2, 1.0)
+    copy = sketch.copy()
+    copy.add("a", 3, 1.0)
+    copy.merge(sketch)
+    assert sketch.entries == {"a": [2, 0, 1.0]}
+
+
+def test_space_saving_round_trip():
+    sketch = SpaceSaving(capacity=3)
+    for item in stream({"a": 3, "b": 2, "c": 2, "d": 1, "e": 1, "f": 1, "g": 1}):
+        sketch.add(item, score_sum=0.25)
+    loaded = SpaceSaving.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert (loaded.capacity, loaded.floor, loaded.entries) == (sketch.capacity, sketch.floor, sketch.entries)
+
+
+@pytest.mark.parametrize("distinct", [10, 1000, 50000])
+def test_hyperloglog_estimate(distinct):
+    sketch = HyperLogLog()
+    for i in range(distinct):
+        sketch.add(f"domain{i}.example")
+        sketch.add(f"domain{i}.example")
+    assert sketch.estimate() == pytest.approx(distinct, rel=0.05)
+
+
+def test_hyperloglog_merge_is_the_union():
+    left, right, union = HyperLogLog(10), HyperLogLog(10), HyperLogLog(10)
+    for i in range(3000):
+        (left if i % 3 else right).add(str(i))
+        union.add(str(i))
+    for i in range(1000):
+        right.add(str(i))
+    registers = bytes(left.registers)
+    copy = left.copy().merge(right)
+    assert bytes(left.registers) == registers
+    assert copy.registers == union.registers
+    assert HyperLogLog.from_dict(copy.to_dict()).estimate() == copy.estimate()
+    with pytest.raises(ValueError):
+        left.merge(HyperLogLog(12))
+
@@ -0,0 +1,86 @@
+"""The long-lived worker loop, driven through its local inbox."""
+import queue
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import evaluating_url
+from payloads import encode_payload
+
+
+class RecordingSink:
+    def __init__(self):
+        self.urls = []
+        self.closed = False
+
+    def write_batch(self, columns):
+        self.urls += columns["url"].tolist()
+
+    def close(self):
+        self.closed = True
+
+
+class FailOnce:
+    """A predict that raises on its first call."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, encoded):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError("predict failed")
+        return np.full((len(encoded), 1), 0.9, dtype=np.float32)
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def worker(monkeypatch, tmp_path):
+    predict = FailOnce()
+    table = evaluating_url.build_lookup_table(["", "[UNK]"] + list("abcdefghijklmnopqrstuvwxyz."))
+    monkeypatch.setattr(evaluating_url, "get_predictor", lambda: (predict, table))
+    monkeypatch.setattr(evaluating_url, "get_verdict_cache", lambda: None)
+    monkeypatch.setattr(evaluating_url, "get_prefilter", lambda: None)
+    monkeypatch.setattr(evaluating_url, "SKETCH_DIR", "")
+    monkeypatch.setattr(evaluating_url, "DEAD_LETTER_PATH", str(tmp_path / "dead.ndjson"))
+    monkeypatch.setattr(evaluating_url, "log", lambda message: None)
+
+    inbox, sink, stop = queue.Queue(), RecordingSink(), threading.Event()
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(stats=evaluating_url.run_worker(
+        inbox, sink, stop, max_urls=100, max_latency_ms=1, report_interval=3600)))
+    thread.start()
+    yield inbox, sink, predict
+    stop.set()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert sink.closed
+
+
+def send(inbox, *urls):
+    message = evaluating_url.LocalMessage(encode_payload(list(urls)))
+    evaluating_url.enqueue(inbox, message)
+    return message
+
+
+def test_failed_batch_is_nacked_and_the_worker_goes_on(worker):
+    inbox, sink, predict = worker
+    failed_before = evaluating_url.failed_batches.value()
+
+    first = send(inbox, "first.example")
+    wait_until(lambda: first.nacked)
+    assert not first.acked and predict.calls == 1
+    assert evaluating_url.failed_batches.value() == failed_before + 1
+
+    second = send(inbox, "second.example", "third.example")
+    wait_until(lambda: second.acked)
+    assert not second.nacked
+    assert sink.urls == ["second.example", "third.example"]
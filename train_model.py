@@ -0,0 +1,395 @@
+"""Trains the URL classifier from the benign and malicious URL lists.
+
+The scripted version of src_model/train_model.ipynb, for lists that don't
+fit in memory. "prepare" converts the lists once into sharded TFRecord
+files of precomputed character ids:
+
+    python train_model.py prepare --benign benign.txt --malicious malicious.txt --out url_records
+
+It reads the lists twice, holding only a 64-bit hash per URL: the first
+pass drops duplicate URLs and counts characters for the vocabulary (what
+TextVectorization.adapt() did), the second encodes URLs with
+evaluating_url.encode_urls() and scatters them over the shards at random.
+Each shard is then shuffled in memory and written as records of
+SEQUENCE_LENGTH uint8 ids and a label. A URL's split (train, val, test)
+follows from its hash, so it stays in the same split when the lists grow.
+
+"train" reads the shards through tf.data: interleaved parallel reads,
+an optional cache of the records, shuffling, batched parsing in parallel
+and prefetching. It trains the notebook's CNN on the ids, resumes from
+--checkpoint-dir after an interruption, evaluates on the test split and
+saves a model that takes URL strings, as evaluating_url.py loads it:
+
+    python train_model.py train --data url_records --output url_classifier_model.keras
+    python train_model.py train --data url_records --input-only
+
+Each epoch logs samples/s and step time percentiles; a slow input pipeline
+shows up as a gap between the two, and --input-only measures what the
+pipeline alone delivers.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from evaluating_url import (SEQUENCE_LENGTH, SPLIT_CHARS, STRIPPED_CHARS, build_lookup_table,
+                            encode_normalized, normalize_urls)
+from summaries import hash64
+
+SPLITS = ("train", "val", "test")
+# TextVectorization's tokens: padding and out-of-vocabulary, then characters
+RESERVED_TOKENS = ["", "[UNK]"]
+METADATA_FILE = "metadata.json"
+READ_CHUNK_LINES = 100000
+# Bytes per record in the temporary shards: the ids, then the label
+RECORD_BYTES = SEQUENCE_LENGTH + 1
+
+
+def read_chunks(path, size=READ_CHUNK_LINES):
+    """Non-empty stripped lines of path, in lists of up to size."""
+    chunk = []
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            url = line.strip()
+            if url:
+                chunk.append(url)
+                if len(chunk) == size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+def count_chars(normalized, counts):
+    codes = np.frombuffer("".join(normalized).encode("utf-32-le"), dtype=np.uint32)
+    counts += np.bincount(codes, minlength=len(counts))[:len(counts)]
+
+
+def build_vocabulary(counts, max_tokens):
+    """The reserved tokens, then the most frequent characters TextVectorization keeps."""
+    dropped = {ord(char) for char in STRIPPED_CHARS + SPLIT_CHARS}
+    ranked = [code for code in np.argsort(-counts, kind="stable") if counts[code] and code not in dropped]
+    return RESERVED_TOKENS + [chr(code) for code in ranked[:max_tokens - len(RESERVED_TOKENS)]]
+
+
+def model_vocabulary(path):
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(path)
+    vectorizer = next(layer for layer in model.layers if isinstance(layer, tf.keras.layers.TextVectorization))
+    return [str(token) for token in vectorizer.get_vocabulary()]
+
+
+def assign_splits(hashes, val_size, test_size):
+    """0, 1 or 2 (train, val, test) per URL hash."""
+    fraction = (hashes % np.uint64(1 << 20)).astype(np.float64) / (1 << 20)
+    return np.where(fraction < test_size, 2, np.where(fraction < test_size + val_size, 1, 0))
+
+
+def write_shard(tf, source, path, seed, compression):
+    """Shuffles a temporary shard and writes it as TFRecords; returns (rows, malicious)."""
+    records = np.fromfile(source, dtype=np.uint8).reshape(-1, RECORD_BYTES)
+    records = records[np.random.default_rng(seed).permutation(len(records))]
+    with tf.io.TFRecordWriter(path, options=tf.io.TFRecordOptions(compression_type=compression)) as writer:
+        for record in records:
+            writer.write(tf.train.Example(features=tf.train.Features(feature={
+                "ids": tf.train.Feature(bytes_list=tf.train.BytesList(value=[record[:SEQUENCE_LENGTH].tobytes()])),
+                "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(record[SEQUENCE_LENGTH])])),
+            })).SerializeToString())
+    return len(records), int(records[:, SEQUENCE_LENGTH].sum())
+
+
+def prepare(args):
+    import tensorflow as tf
+
+    sources = ((args.benign, 0), (args.malicious, 1))
+    started = time.perf_counter()
+
+    # Pass 1: hashes for deduplication and splits, character counts
+    counts = np.zeros(0x110000, dtype=np.int64)
+    hashes = []
+    for path, _ in sources:
+        file_hashes = []
+        for chunk in read_chunks(path):
+            file_hashes.append(np.fromiter(map(hash64, chunk), dtype=np.uint64, count=len(chunk)))
+            if not args.vocabulary_from:
+                count_chars(normalize_urls(chunk), counts)
+        hashes.append(np.concatenate(file_hashes) if file_hashes else np.zeros(0, dtype=np.uint64))
+        print(f"Read {len(hashes[-1]):,} URLs from {path}", flush=True)
+    # The first occurrence of a URL is kept, so benign wins over malicious
+    # as in the notebook
+    all_hashes = np.concatenate(hashes)
+    keep = np.zeros(len(all_hashes), dtype=bool)
+    keep[np.unique(all_hashes, return_index=True)[1]] = True
+    splits = assign_splits(all_hashes, args.val_size, args.test_size)
+    del all_hashes
+
+    vocabulary = model_vocabulary(args.vocabulary_from) if args.vocabulary_from else \
+        build_vocabulary(counts, args.max_tokens)
+    if len(vocabulary) > 256:
+        raise SystemExit(f"{len(vocabulary)} tokens don't fit in the uint8 ids of the records.")
+    table = build_lookup_table(vocabulary)
+    print(f"{int(keep.sum()):,} distinct URLs, {len(keep) - int(keep.sum()):,} duplicates dropped, "
+          f"{len(vocabulary)} tokens", flush=True)
+
+    # Pass 2: encode, scattering rows over temporary shards at random
+    os.makedirs(args.out, exist_ok=True)
+    temporary = os.path.join(args.out, "tmp")
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    rng = np.random.default_rng(args.seed)
+    files = {(split, shard): open(os.path.join(temporary, f"{split}-{shard:05d}.bin"), "wb")
+             for split in range(len(SPLITS)) for shard in range(args.shards)}
+    try:
+        offset = 0
+        for path, label in sources:
+            for chunk in read_chunks(path):
+                chunk_keep = keep[offset:offset + len(chunk)]
+                chunk_splits = splits[offset:offset + len(chunk)][chunk_keep]
+                offset += len(chunk)
+                ids = encode_normalized(normalize_urls([url for url, kept in zip(chunk, chunk_keep) if kept]), table)
+                records = np.empty((len(ids), RECORD_BYTES), dtype=np.uint8)
+                records[:, :SEQUENCE_LENGTH] = ids
+                records[:, SEQUENCE_LENGTH] = label
+                shards = rng.integers(args.shards, size=len(records))
+                for (split, shard), f in files.items():
+                    f.write(records[(chunk_splits == split) & (shards == shard)].tobytes())
+    finally:
+        for f in files.values():
+            f.close()
+
+    # Pass 3: shuffle each shard and write it as TFRecords
+    extension = ".tfrecord.gz" if args.compression == "GZIP" else ".tfrecord"
+    metadata = {"vocabulary": vocabulary, "sequence_length": SEQUENCE_LENGTH, "compression": args.compression,
+                "splits": {}}
+    for split, name in enumerate(SPLITS):
+        rows = malicious = 0
+        paths = []
+        for shard in range(args.shards):
+            path = os.path.join(args.out, f"{name}-{shard:05d}-of-{args.shards:05d}{extension}")
+            shard_rows, shard_malicious = write_shard(tf, os.path.join(temporary, f"{split}-{shard:05d}.bin"),
+                                                      path, args.seed + shard, args.compression)
+            rows += shard_rows
+            malicious += shard_malicious
+            paths.append(os.path.basename(path))
+        metadata["splits"][name] = {"files": paths, "rows": rows, "malicious": malicious}
+        print(f"{name}: {rows:,} rows ({malicious:,} malicious) in {args.shards} shards", flush=True)
+    shutil.rmtree(temporary)
+    with open(os.path.join(args.out, METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+    print(f"Prepared {args.out} in {time.perf_counter() - started:.0f}s", flush=True)
+
+
+def load_metadata(directory):
+    with open(os.path.join(directory, METADATA_FILE), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def make_dataset(tf, directory, metadata, split, batch_size, training, cache="", shuffle_buffer=100000,
+                 cycle_length=8, seed=42):
+    """Batches of (ids, label) from a split's shards.
+
+    Records are parsed a batch at a time after batching, one vectorized
+    op instead of one per record.
+    """
+    paths = [os.path.join(directory, name) for name in metadata["splits"][split]["files"]]
+    compression = metadata["compression"]
+    autotune = tf.data.AUTOTUNE
+    records = tf.data.Dataset.from_tensor_slices(paths)
+    if training:
+        records = records.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    records = records.interleave(
+        lambda path: tf.data.TFRecordDataset(path, compression_type=compression),
+        cycle_length=min(cycle_length, len(paths)), num_parallel_calls=autotune, deterministic=not training)
+    if cache == "memory":
+        records = records.cache()
+    elif cache:
+        records = records.cache(f"{cache}-{split}")
+    if training:
+        records = records.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    features = {
+        "ids": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(serialized):
+        parsed = tf.io.parse_example(serialized, features)
+        ids = tf.reshape(tf.io.decode_raw(parsed["ids"], tf.uint8), (-1, SEQUENCE_LENGTH))
+        return tf.cast(ids, tf.int32), tf.cast(parsed["label"], tf.float32)
+
+    batches = records.batch(batch_size, drop_remainder=training)
+    batches = batches.map(parse, num_parallel_calls=autotune, deterministic=not training)
+    return batches.prefetch(autotune)
+
+
+def build_model(tf, vocabulary, embedding_dim=64):
+    """The notebook's CNN, taking URL strings through a TextVectorization layer with a fixed vocabulary."""
+    layers = tf.keras.layers
+    input_layer = layers.Input(shape=(1,), dtype=tf.string, name="input_url")
+    vectorizer = layers.TextVectorization(max_tokens=len(vocabulary), output_mode="int",
+                                          output_sequence_length=SEQUENCE_LENGTH,
+                                          vocabulary=vocabulary[len(RESERVED_TOKENS):])
+    x = vectorizer(input_layer)
+    x = layers.Embedding(input_dim=len(vocabulary), output_dim=embedding_dim, mask_zero=True)(x)
+    x = layers.SpatialDropout1D(0.2)(x)
+    branches = []
+    for kernel_size in (3, 5, 7):
+        branch = layers.Conv1D(filters=128, kernel_size=kernel_size, activation="relu", padding="same")(x)
+        branches.append(layers.BatchNormalization()(branch))
+    x = layers.Concatenate()(branches)
+    x = layers.GlobalMaxPooling1D()(x)
+    x = layers.Dense(256, activation="relu")(x)
+    x = layers.BatchNormalization()(x)
+    x = layers.Dropout(0.5)(x)
+    x = layers.Dense(128, activation="relu")(x)
+    x = layers.BatchNormalization()(x)
+    x = layers.Dropout(0.3)(x)
+    output_layer = layers.Dense(1, activation="sigmoid", name="output")(x)
+    return tf.keras.Model(inputs=input_layer, outputs=output_layer), vectorizer
+
+
+def make_throughput_callback(tf, batch_size):
+    class Throughput(tf.keras.callbacks.Callback):
+        """Logs training samples/s and step time percentiles per epoch.
+
+        A step's time runs from the end of the previous step, so it includes
+        waiting for the input pipeline: stalls show up as a long tail.
+        """
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.began = self.last = time.perf_counter()
+            self.steps = []
+
+        def on_train_batch_end(self, batch, logs=None):
+            now = time.perf_counter()
+            self.steps.append(now - self.last)
+            self.last = now
+
+        def on_epoch_end(self, epoch, logs=None):
+            if not self.steps:
+                return
+            elapsed = self.last - self.began
+            p50, p99 = np.percentile(self.steps, [50, 99]) * 1000
+            print(f"Epoch {epoch + 1}: {len(self.steps) * batch_size / elapsed:,.0f} samples/s over "
+                  f"{len(self.steps)} steps in {elapsed:.1f}s, step p50={p50:.1f}ms p99={p99:.1f}ms "
+                  f"max={max(self.steps) * 1000:.1f}ms (first step {self.steps[0] * 1000:.0f}ms), "
+                  f"validation {time.perf_counter() - self.last:.1f}s", flush=True)
+
+    return Throughput()
+
+
+def measure_input(dataset, batch_size):
+    """Reads one epoch of a dataset without training, for the pipeline's own samples/s."""
+    began = time.perf_counter()
+    steps = 0
+    for _ in dataset:
+        steps += 1
+    elapsed = time.perf_counter() - began
+    print(f"Input pipeline alone: {steps * batch_size / elapsed:,.0f} samples/s over {steps} batches "
+          f"in {elapsed:.1f}s", flush=True)
+
+
+def train(args):
+    import tensorflow as tf
+
+    metadata = load_metadata(args.data)
+    if metadata["sequence_length"] != SEQUENCE_LENGTH:
+        raise SystemExit(f"{args.data} holds sequences of {metadata['sequence_length']} ids, "
+                         f"evaluating_url.py uses {SEQUENCE_LENGTH}.")
+    tf.keras.utils.set_random_seed(args.seed)
+    dataset_options = {"cache": args.cache, "shuffle_buffer": args.shuffle_buffer,
+                       "cycle_length": args.cycle_length, "seed": args.seed}
+    train_data = make_dataset(tf, args.data, metadata, "train", args.batch_size, training=True, **dataset_options)
+    if args.input_only:
+        for _ in range(args.epochs):
+            measure_input(train_data, args.batch_size)
+        return
+    val_data = make_dataset(tf, args.data, metadata, "val", args.batch_size, training=False, **dataset_options)
+    test_data = make_dataset(tf, args.data, metadata, "test", args.batch_size, training=False)
+
+    model, vectorizer = build_model(tf, metadata["vocabulary"], embedding_dim=args.embedding_dim)
+    # Trained on the precomputed ids: the same layers, from the embedding on,
+    # as get_encoder() in evaluating_url.py serves them
+    encoded_model = tf.keras.Model(inputs=vectorizer.output, outputs=model.output)
+    encoded_model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate),
+        loss="binary_crossentropy",
+        metrics=["accuracy", tf.keras.metrics.Precision(name="precision"),
+                 tf.keras.metrics.Recall(name="recall")],
+    )
+
+    train_split = metadata["splits"]["train"]
+    malicious = train_split["malicious"]
+    benign = train_split["rows"] - malicious
+    if not benign or not malicious:
+        raise SystemExit(f"The training split needs both classes ({benign} benign, {malicious} malicious).")
+    # "balanced" class weights, as compute_class_weight in the notebook
+    class_weight = {0: train_split["rows"] / (2 * benign), 1: train_split["rows"] / (2 * malicious)}
+    print(f"Training on {train_split['rows']:,} URLs, validating on {metadata['splits']['val']['rows']:,}, "
+          f"class weights {class_weight}", flush=True)
+
+    callbacks = [
+        # Saves the model, optimizer and epoch after each epoch and restores
+        # them when a run is started again after an interruption; removed
+        # once training completes
+        tf.keras.callbacks.BackupAndRestore(args.checkpoint_dir),
+        tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=args.patience, restore_best_weights=True,
+                                         verbose=1),
+        tf.keras.callbacks.ReduceLROnPlateau(monitor="val_loss", factor=0.5, patience=2, min_lr=1e-7, verbose=1),
+        make_throughput_callback(tf, args.batch_size),
+    ]
+    encoded_model.fit(train_data, validation_data=val_data, epochs=args.epochs, class_weight=class_weight,
+                      callbacks=callbacks, verbose=args.verbose)
+
+    loss, accuracy, precision, recall = encoded_model.evaluate(test_data, verbose=0)
+    print(f"Test: loss {loss:.4f}, accuracy {accuracy:.2%}, precision {precision:.2%}, recall {recall:.2%}",
+          flush=True)
+    model.save(args.output)
+    print(f"Saved {args.output}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = commands.add_parser("prepare", help="convert the URL lists to TFRecord shards")
+    prepare_parser.add_argument("--benign", required=True, help="benign URL list, one per line")
+    prepare_parser.add_argument("--malicious", required=True, help="malicious URL list, one per line")
+    prepare_parser.add_argument("--out", default="url_records")
+    prepare_parser.add_argument("--shards", type=int, default=16, help="files per split")
+    prepare_parser.add_argument("--val-size", type=float, default=0.16)
+    prepare_parser.add_argument("--test-size", type=float, default=0.2)
+    prepare_parser.add_argument("--max-tokens", type=int, default=128, help="vocabulary size, with the 2 reserved")
+    prepare_parser.add_argument("--vocabulary-from", help="use this model's vocabulary instead of counting")
+    prepare_parser.add_argument("--compression", choices=("", "GZIP"), default="")
+    prepare_parser.add_argument("--seed", type=int, default=42)
+
+    train_parser = commands.add_parser("train", help="train on prepared shards")
+    train_parser.add_argument("--data", default="url_records")
+    train_parser.add_argument("--output", default="url_classifier_model.keras")
+    train_parser.add_argument("--checkpoint-dir", default="training_checkpoints")
+    train_parser.add_argument("--epochs", type=int, default=20)
+    train_parser.add_argument("--batch-size", type=int, default=512)
+    train_parser.add_argument("--learning-rate", type=float, default=0.001)
+    train_parser.add_argument("--embedding-dim", type=int, default=64)
+    train_parser.add_argument("--patience", type=int, default=3, help="epochs without val_loss improvement")
+    train_parser.add_argument("--shuffle-buffer", type=int, default=100000, help="records")
+    train_parser.add_argument("--cycle-length", type=int, default=8, help="shards read at once")
+    train_parser.add_argument("--cache", default="",
+                              help="cache the records after the first epoch: 'memory' or a file path prefix")
+    train_parser.add_argument("--input-only", action="store_true", help="only time the input pipeline")
+    train_parser.add_argument("--verbose", type=int, default=2, help="Keras fit verbosity")
+    train_parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.command == "prepare":
+        prepare(args)
+    else:
+        train(args)
+
+
+if __name__ == "__main__":
+    main()
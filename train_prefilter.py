@@ -0,0 +1,113 @@
+"""Trains the lexical pre-filter and measures what tiered scoring costs.
+
+Samples the --benign/--malicious URL lists and splits off a validation set
+before fitting prefilter.LexicalModel on the rest, so every reported
+number comes from URLs the pre-filter never saw. The validation set is
+scored with both the pre-filter and the CNN. For each uncertain band it
+reports the share of URLs still sent to the CNN and the precision, recall
+and accuracy of the tiered scores against the CNN alone and the test-set
+numbers saved in src_model/results. If the lists are the ones the CNN was
+trained on, its own numbers on the validation set are optimistic:
+
+    python train_prefilter.py --benign benign.txt --malicious malicious.txt
+    PREFILTER_PATH=prefilter.npz PREFILTER_LOW=0.02 python evaluating_url.py
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from convert_tflite import load_reference_metrics, sample_lines
+from evaluating_url import THRESHOLD, get_predictor, normalize_urls, score_urls
+from prefilter import fit, in_band
+
+# (low, high) bands; high=1.0 never short-circuits the malicious side
+DEFAULT_BANDS = "0.005:1.0,0.01:1.0,0.02:1.0,0.05:1.0,0.1:1.0,0.02:0.98,0.05:0.95"
+
+
+def parse_bands(spec):
+    return [tuple(float(bound) for bound in band.split(":")) for band in spec.split(",")]
+
+
+def metrics(scores, labels):
+    predicted = scores > THRESHOLD
+    positives = labels == 1
+    return {
+        "accuracy": float((predicted == positives).mean()),
+        "precision": float(positives[predicted].mean()) if predicted.any() else 0.0,
+        "recall": float(predicted[positives].mean()),
+    }
+
+
+def split_urls(urls, labels, validation_size, seed):
+    """Deduplicates normalized URLs, then shuffles them into a training and a validation split.
+
+    Lines that only differ in scheme or www normalize to the same URL; one
+    copy is kept, so none can sit on both sides of the split.
+    """
+    unique = {}
+    for url, label in zip(urls, labels.tolist()):
+        unique.setdefault(url, label)
+    urls = list(unique)
+    labels = np.array(list(unique.values()))
+    order = np.random.default_rng(seed).permutation(len(urls))
+    split = int(len(urls) * (1 - validation_size))
+    train, validation = order[:split], order[split:]
+    return ([urls[i] for i in train], labels[train]), ([urls[i] for i in validation], labels[validation])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benign", required=True, help="benign URL list, one per line")
+    parser.add_argument("--malicious", required=True, help="malicious URL list, one per line")
+    parser.add_argument("--output", default="prefilter.npz")
+    parser.add_argument("--sample", type=int, default=200000, help="URLs sampled per class")
+    parser.add_argument("--validation-size", type=float, default=0.2,
+                        help="share of URLs held out of fitting and used for every reported metric")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--bands", default=DEFAULT_BANDS, help="comma-separated low:high bands")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    benign = sample_lines(args.benign, args.sample, rng)
+    malicious = sample_lines(args.malicious, args.sample, rng)
+    labels = np.array([0] * len(benign) + [1] * len(malicious))
+    (train_urls, train_labels), (validation_urls, validation_labels) = split_urls(
+        normalize_urls(benign + malicious), labels, args.validation_size, args.seed)
+
+    print(f"Training on {len(train_urls)} URLs, validating on {len(validation_urls)}...", flush=True)
+    model = fit(train_urls, train_labels, epochs=args.epochs, seed=args.seed)
+    model.save(args.output)
+    print(f"Saved {args.output}", flush=True)
+
+    predict, table = get_predictor()
+    if predict is None:
+        raise SystemExit("Model not available.")
+    start = time.perf_counter()
+    lexical = model.predict(validation_urls)
+    lexical_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cnn = score_urls(validation_urls, predict, table)[:, 0]
+    cnn_seconds = time.perf_counter() - start
+
+    count = len(validation_urls)
+    reference = load_reference_metrics()
+    cnn_metrics = metrics(cnn, validation_labels)
+    print(f"\nLexical pre-filter alone, validation set: {metrics(lexical, validation_labels)}")
+    print(f"Scoring time: pre-filter {count / lexical_seconds:,.0f} URL/s, "
+          f"CNN {count / cnn_seconds:,.0f} URL/s")
+    print(f"Saved test set recall {reference['recall']:.4f}, CNN on the validation set {cnn_metrics['recall']:.4f}\n")
+    print(f"{'band':<14}{'CNN calls':>10}{'precision':>11}{'recall':>9}{'lost':>9}{'accuracy':>10}")
+    for low, high in parse_bands(args.bands):
+        uncertain = in_band(lexical, low, high)
+        tiered = np.where(uncertain, cnn, lexical)
+        tiered_metrics = metrics(tiered, validation_labels)
+        lost = cnn_metrics["recall"] - tiered_metrics["recall"]
+        print(f"[{low}, {high}]".ljust(14) + f"{uncertain.mean():>10.1%}{tiered_metrics['precision']:>11.4f}"
+              f"{tiered_metrics['recall']:>9.4f}{lost:>+9.4f}{tiered_metrics['accuracy']:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Verdict cache for the URL scorer.
+
+Certificate Transparency traffic repeats the same domains over and over
+(renewals, multi-SAN certificates, several CT logs), so scores are cached
+by normalized URL. VerdictCache is an in-process LRU with a TTL. It can sit
+in front of a shared store (SQLite file or Redis) so several worker
+instances reuse each other's verdicts.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SQLiteVerdictStore:
+    """Verdicts shared through a SQLite file, e.g. on a volume all workers mount."""
+
+    # SQLite limits the number of bound parameters per statement
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts "
+                "(url TEXT PRIMARY KEY, score REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get_many(self, keys):
+        found = {}
+        conn = self.connection()
+        now = time.time()
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i + self.CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT url, score FROM verdicts WHERE expires_at > ? AND url IN ({placeholders})",
+                [now, *chunk],
+            )
+            found.update(rows)
+        return found
+
+    def put_many(self, verdicts):
+        expires_at = time.time() + self.ttl
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO verdicts (url, score, expires_at) VALUES (?, ?, ?)",
+                [(url, score, expires_at) for url, score in verdicts.items()],
+            )
+
+    def purge_expired(self):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM verdicts WHERE expires_at <= ?", (time.time(),))
+
+
+class RedisVerdictStore:
+    """Verdicts shared through Redis, with the TTL handled by key expiry."""
+
+    def __init__(self, url, ttl, prefix="verdict:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: float(value) for key, value in zip(keys, values) if value is not None}
+
+    def put_many(self, verdicts):
+        pipeline = self.client.pipeline(transaction=False)
+        for url, score in verdicts.items():
+            pipeline.set(self.prefix + url, score, ex=max(int(self.ttl), 1))
+        pipeline.execute()
+
+    def purge_expired(self):
+        pass
+
+
+def open_store(spec, ttl):
+    """Opens a shared store from "sqlite:///path/to/file.db" or "redis://host:port/db"."""
+    if not spec:
+        return None
+    if spec.startswith("sqlite:///"):
+        return SQLiteVerdictStore(spec[len("sqlite:///"):], ttl)
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisVerdictStore(spec, ttl)
+    raise ValueError(f"Unsupported verdict cache backend: {spec}")
+
+
+class VerdictCache:
+    """Bounded LRU of url -> score with a TTL, optionally backed by a shared store.
+
+    Lookups check the in-process entries first, then the shared store;
+    shared hits are copied into the local LRU.
+    """
+
+    def __init__(self, max_entries=100000, ttl=3600, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.store_errors = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        """Returns {key: score} for the keys with a live verdict."""
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if entry[1] > now:
+                        self.entries.move_to_end(key)
+                        found[key] = entry[0]
+                        continue
+                    del self.entries[key]
+                    self.expirations += 1
+                missing.append(key)
+
+        if missing and self.store is not None:
+            try:
+                shared = self.store.get_many(missing)
+            except Exception:
+                self.store_errors += 1
+                shared = {}
+            if shared:
+                self._put_local(shared)
+                found.update(shared)
+            with self.lock:
+                self.shared_hits += len(shared)
+
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, verdicts):
+        """Stores {key: score} locally and in the shared store."""
+        if not verdicts:
+            return
+        self._put_local(verdicts)
+        if self.store is not None:
+            try:
+                self.store.put_many(verdicts)
+            except Exception:
+                self.store_errors += 1
+
+    def _put_local(self, verdicts):
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for key, score in verdicts.items():
+                self.entries[key] = (score, expires_at)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "store_errors": self.store_errors,
+        }